@@ -0,0 +1,235 @@
+# ========================================================================
+# Copyright 2022 Emory University
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ========================================================================
+import os
+import time
+from typing import Dict, List, Tuple, Mapping, Sequence, Any
+
+import numpy as np
+
+from src.vector_space_models import CSRMatrix, as_vectors, as_queries, most_similar_batch
+
+
+def _mix(x: np.ndarray) -> np.ndarray:
+    # splitmix64 finalizer: a cheap, well-distributed hash of uint64 values
+    x = (x ^ (x >> np.uint64(30))) * np.uint64(0xbf58476d1ce4e5b9)
+    x = (x ^ (x >> np.uint64(27))) * np.uint64(0x94d049bb133111eb)
+    return x ^ (x >> np.uint64(31))
+
+
+class CosineLSH:
+    """
+    Approximate cosine nearest-neighbour search with random-hyperplane (SimHash) signatures.
+    Each document gets bands * rows sign bits of random projections of its vector; two documents become
+    candidates if all bits of at least one band agree, so more bands raise recall and more rows per band raise speed.
+    The hyperplanes are derived from term ids, so queries must share the vocabulary of the indexed documents.
+    """
+    def __init__(self, docs: Mapping[str, Dict[str, float]], bands: int = 64, rows: int = 10, seed: int = 0, rerank: bool = True, max_values: int = 1 << 12):
+        """
+        :param docs: the document vectors to index (see as_vectors).
+        :param bands: the number of bands; a candidate must match all bits of at least one band.
+        :param rows: the number of bits per band (at most 64).
+                     The default 64 x 10 keeps about 7% of the documents as candidates of a query and finds the exact match
+                     for about 95% of the near-duplicate queries of benchmark_similarity; less similar matches need shorter bands.
+        :param seed: the seed of the random hyperplanes.
+        :param rerank: if True, candidates are ranked by their exact cosine similarities;
+                       otherwise, by the similarities estimated from the Hamming distances of their signatures.
+        :param max_values: the maximum number of stored values projected at a time, which bounds the memory of the dense blocks.
+        """
+        if not 0 < rows <= 64: raise ValueError('rows must be in [1, 64]: {}'.format(rows))
+        self.docs = as_vectors(docs).normalize()
+        self.bands, self.rows, self.seed = bands, rows, seed
+        self.rerank = rerank
+        self.max_values = max_values
+
+        # the buckets of all bands in one table sorted by the hash of (band, key), so that all bands of all queries are looked up at once
+        self.keys = self.band_keys(self.docs.matrix)
+        hashes = self._bucket_hashes(self.keys).ravel()
+        self.order = np.argsort(hashes, kind='stable')
+        self.sorted_hashes = hashes[self.order]
+
+    @property
+    def n_bits(self) -> int:
+        return self.bands * self.rows
+
+    def bits(self, X: CSRMatrix) -> np.ndarray:
+        """
+        :return: the sign bits of the random projections of the rows in X in the shape of [len(X), n_bits].
+        """
+        out = np.zeros((len(X), self.n_bits), dtype=bool)
+        if len(X.data) == 0: return out
+
+        # the hyperplane signs of every distinct term are the bits of n_bits / 64 hashes, unpacked block by block
+        salt = np.uint64(self.seed) * np.uint64(0x9e3779b97f4a7c15)
+        n_words = (self.n_bits + 63) // 64
+        terms, inverse = np.unique(X.indices, return_inverse=True)
+        words = _mix(terms.astype(np.uint64)[:, None] * np.uint64(n_words) + np.arange(n_words, dtype=np.uint64)[None, :] + salt)
+        row_ids = X.row_ids()
+
+        bs = 0
+        while bs < len(X):
+            # extend the block of rows until it holds about max_values stored values
+            be = min(len(X), int(np.searchsorted(X.indptr, X.indptr[bs] + self.max_values, 'right')) - 1)
+            be = max(be, bs + 1)
+            s, e = X.indptr[bs], X.indptr[be]
+            # the rows are projected as a dense matrix over the terms of the block
+            local, cols = np.unique(inverse[s:e], return_inverse=True)
+            dense = np.zeros((be - bs, len(local)), dtype=np.float32)
+            dense[row_ids[s:e] - bs, cols] = X.data[s:e]
+            signs = np.unpackbits(words[local].view(np.uint8), axis=1, count=self.n_bits, bitorder='little').astype(np.float32) * 2 - 1
+            out[bs:be] = dense @ signs > 0
+            bs = be
+
+        return out
+
+    def band_keys(self, X: CSRMatrix) -> np.ndarray:
+        """
+        :return: the bucket key of every band for the rows in X in the shape of [len(X), bands].
+        """
+        bits = self.bits(X).reshape(len(X), self.bands, self.rows).astype(np.uint64)
+        return (bits << np.arange(self.rows, dtype=np.uint64)).sum(axis=2, dtype=np.uint64)
+
+    def candidates(self, keys: np.ndarray) -> np.ndarray:
+        """
+        :param keys: the band keys of one query.
+        :return: the ids of the documents sharing at least one bucket with the query.
+        """
+        return self.candidate_pairs(keys[None, :])[1]
+
+    def _bucket_hashes(self, keys: np.ndarray) -> np.ndarray:
+        # the hash of (band, key) for the band keys in the shape of [..., bands]
+        salt = _mix(np.arange(self.bands, dtype=np.uint64) + np.uint64(self.seed) * np.uint64(0x9e3779b97f4a7c15))
+        return _mix(keys ^ salt)
+
+    def candidate_pairs(self, keys: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        :param keys: the band keys of the queries in the shape of [n_queries, bands].
+        :return: a pair of (query ids, document ids) of every query and document sharing at least one bucket, sorted by query then document.
+        """
+        hashes = self._bucket_hashes(keys).ravel()
+        lo, hi = np.searchsorted(self.sorted_hashes, hashes, 'left'), np.searchsorted(self.sorted_hashes, hashes, 'right')
+        lengths = hi - lo
+        offsets = np.cumsum(lengths) - lengths
+        entries = self.order[np.repeat(lo - offsets, lengths) + np.arange(lengths.sum(), dtype=np.int64)]
+        cells = np.repeat(np.arange(len(hashes), dtype=np.int64), lengths)
+        docs, queries = entries // self.bands, cells // self.bands
+        # a bucket is shared only if the band and the key agree, not just their hash
+        same = (entries % self.bands == cells % self.bands) & (self.keys.ravel()[entries] == keys.ravel()[cells])
+        n = len(self.docs)
+        pairs = np.unique(queries[same] * n + docs[same])
+        return pairs // n, pairs % n
+
+    def _cosines(self, X: CSRMatrix, norms: np.ndarray, queries: np.ndarray, cand: np.ndarray) -> np.ndarray:
+        # exact cosine similarities of the (query, candidate) pairs, looking up the terms of the candidates in the dense normalized queries
+        Y = self.docs.matrix
+        dense = np.zeros(len(X) * Y.n_cols)
+        rows = X.row_ids()
+        dense[rows * Y.n_cols + X.indices] = X.data / np.maximum(norms, 1e-300)[rows]
+        positions, lengths = Y.positions(cand)
+        owners = np.repeat(np.arange(len(cand)), lengths)
+        values = dense[queries[owners] * Y.n_cols + Y.indices[positions]]
+        return np.bincount(owners, weights=Y.data[positions] * values, minlength=len(cand))
+
+    def search_batch(self, X: Mapping[str, Dict[str, float]], k: int = 1, max_cells: int = 1 << 22) -> Dict[str, List[Tuple[str, float]]]:
+        """
+        :param X: the query vectors (see as_vectors); their terms are mapped onto the vocabulary of the indexed documents (see as_queries).
+        :param k: the number of documents to retrieve per query.
+        :param max_cells: the maximum number of cells of the dense queries reranked together.
+        :return: a dictionary of (query key, list of (document key, cosine similarity)) sorted from the most similar;
+                 a query may get fewer than k documents if not enough documents share a bucket with it.
+        """
+        X = as_queries(X, self.docs)
+        keys = self.band_keys(X.matrix)
+        norms = X.row_norms()
+        out = {key: [] for key in X.keys}
+        size = max(1, max_cells // max(self.docs.matrix.n_cols, 1))
+
+        for bs in range(0, len(X), size):
+            be = min(bs + size, len(X))
+            queries, cand = self.candidate_pairs(keys[bs:be])
+            keep = norms[bs + queries] > 0
+            queries, cand = queries[keep], cand[keep]
+
+            if self.rerank:
+                scores = self._cosines(X.matrix.slice_rows(bs, be), norms[bs:be], queries, cand)
+            else:
+                hamming = (self.bits_of(keys[bs + queries]) != self.bits_of(self.keys[cand])).sum(axis=1)
+                scores = np.cos(np.pi * hamming / self.n_bits)
+
+            # the first k pairs of every query ordered by score, then by document id
+            order = np.lexsort((cand, -scores, queries))
+            queries, cand, scores = queries[order], cand[order], scores[order]
+            top = np.arange(len(queries)) - np.searchsorted(queries, queries, 'left') < k
+            for q, d, s in zip(queries[top].tolist(), cand[top].tolist(), scores[top].tolist()):
+                out[X.keys[bs + q]].append((self.docs.keys[d], s))
+
+        return out
+
+    def bits_of(self, keys: np.ndarray) -> np.ndarray:
+        """
+        :param keys: band keys in the shape of [..., bands].
+        :return: the signature bits in the shape of [..., n_bits].
+        """
+        bits = (keys[..., None] >> np.arange(self.rows, dtype=np.uint64)) & np.uint64(1)
+        return bits.reshape(keys.shape[:-1] + (self.n_bits,)).astype(bool)
+
+
+def benchmark(X: Mapping[str, Dict[str, float]], Y: Mapping[str, Dict[str, float]], settings: Sequence[Dict[str, Any]],
+              gold: Dict[str, str] = None) -> List[Dict[str, Any]]:
+    """
+    Compares approximate search against the exact cosine search of X in Y.
+    :param settings: the keyword arguments of CosineLSH to benchmark, e.g., [{'bands': 16, 'rows': 8}].
+    :param gold: if given, a dictionary of (query key, correct document key) to report accuracy against.
+    :return: one row per setting (plus the exact search first) with build/query seconds, recall@1 against the exact search,
+             the fraction of the documents that are candidates of a query on average, and accuracy.
+    """
+    Y = as_vectors(Y)
+    t = time.perf_counter()
+    exact = {k: m[0][0] if m else None for k, m in most_similar_batch(Y, as_queries(X, Y), metric='cosine').items()}
+    results = [{'engine': 'exact', 'build': 0.0, 'query': time.perf_counter() - t, 'recall@1': 1.0, 'candidates': 1.0}]
+
+    for kwargs in settings:
+        t = time.perf_counter()
+        lsh = CosineLSH(Y, **kwargs)
+        build = time.perf_counter() - t
+        t = time.perf_counter()
+        approx = {k: m[0][0] if m else None for k, m in lsh.search_batch(X).items()}
+        query = time.perf_counter() - t
+        recall = sum(approx[k] == exact[k] for k in exact) / max(len(exact), 1)
+        queries, _ = lsh.candidate_pairs(lsh.band_keys(as_queries(X, lsh.docs).matrix))
+        candidates = len(queries) / max(len(X) * len(Y), 1)
+        results.append(dict(engine='lsh', **kwargs, build=build, query=query, candidates=candidates, **{'recall@1': recall}))
+        results[-1]['matches'] = approx
+
+    results[0]['matches'] = exact
+    if gold:
+        for r in results:
+            r['accuracy'] = sum(r['matches'].get(k) == v for k, v in gold.items()) / len(gold)
+    for r in results: del r['matches']
+    return results
+
+
+if __name__ == '__main__':
+    from src.quiz.quiz2 import FM, vectorize
+    from src.vector_space_models import read_fables
+
+    path = os.path.join(os.path.dirname(__file__), 'quiz', 'res', 'vsm')
+    v_fables = vectorize(read_fables(os.path.join(path, 'aesopfables.json')))
+    v_fables_alt = vectorize(read_fables(os.path.join(path, 'aesopfables-alt.json')))
+
+    settings = [dict(bands=b, rows=r, rerank=rerank) for b, r in [(32, 8), (64, 8), (64, 10), (96, 12), (64, 6)] for rerank in [True, False]]
+    for r in benchmark(v_fables_alt, v_fables, settings, FM):
+        print('{:<6}{:>7}{:>6}{:>8}  build: {:7.4f}s  query: {:7.4f}s  candidates: {:5.3f}  recall@1: {:5.3f}  FM accuracy: {:5.3f}'.format(
+            r['engine'], r.get('bands', ''), r.get('rows', ''), str(r.get('rerank', '')), r['build'], r['query'], r['candidates'], r['recall@1'], r['accuracy']))
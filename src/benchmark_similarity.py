@@ -0,0 +1,306 @@
+# ========================================================================
+# Copyright 2022 Emory University
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ========================================================================
+import argparse
+import json
+import os
+import time
+import tracemalloc
+from types import SimpleNamespace
+from typing import Dict, List, Tuple, Iterator, Callable, Any, Optional, Mapping
+
+import numpy as np
+
+from src.approximate_search import CosineLSH
+from src.vector_space_models import Vocabulary, DocumentVectors, TfIdfMatrix, InvertedIndex, BM25, vectorize_tf_idfs, tf_idfs, top_k, read_fables, fable_key, \
+    as_vectors, as_queries, most_similar
+from src.quiz import quiz2
+
+
+def synthetic_fables(n_docs: int, vocab_size: int = 50000, doc_length: int = 100, zipf: float = 1.1, seed: int = 0) -> Iterator[Dict[str, str]]:
+    """
+    Generates fables whose tokens follow a Zipfian distribution over the vocabulary.
+    :param n_docs: the number of fables.
+    :param vocab_size: the number of distinct terms that can be drawn.
+    :param doc_length: the average number of tokens per fable (Poisson).
+    :param zipf: the exponent s of p(rank) ~ 1 / rank^s.
+    :return: an iterator of fables with the 'source' and 'tokens' fields.
+    """
+    rng = np.random.default_rng(seed)
+    p = 1.0 / np.arange(1, vocab_size + 1) ** zipf
+    cdf = np.cumsum(p / p.sum())
+    terms = np.array(['w{}'.format(i) for i in range(vocab_size)])
+
+    for i in range(n_docs):
+        ranks = np.minimum(np.searchsorted(cdf, rng.random(max(1, rng.poisson(doc_length)))), vocab_size - 1)
+        yield {'source': 'synthetic&d{}'.format(i), 'tokens': ' '.join(terms[ranks])}
+
+
+def noisy_queries(fables: List[Dict[str, str]], noise: float = 0.3, seed: int = 1) -> Tuple[List[Dict[str, str]], Dict[str, str]]:
+    """
+    Creates a query from every fable by replacing a fraction of its tokens with tokens of another random fable.
+    :return: a pair of (query fables, dictionary of (query key, key of the fable it was made from)).
+    """
+    rng = np.random.default_rng(seed)
+    queries, gold = [], dict()
+    for i, fable in enumerate(fables):
+        tokens = fable['tokens'].split()
+        other = fables[int(rng.integers(len(fables)))]['tokens'].split()
+        tokens = [other[int(rng.integers(len(other)))] if rng.random() < noise else t for t in tokens]
+        key = 'q{}'.format(i)
+        queries.append({'source': 'query&' + key, 'tokens': ' '.join(tokens)})
+        gold[key] = fable_key(fable['source'])
+    return queries, gold
+
+
+def _queries(Q: DocumentVectors, Y: DocumentVectors, fables: List[Dict[str, str]]) -> List[SimpleNamespace]:
+    # every representation a query may need, prepared before timing; the matrix rows use the term ids of Y
+    M = as_queries(Q, Y)
+    return [SimpleNamespace(key=key, matrix=M.matrix.slice_rows(i, i + 1), norm=M.norms[i:i + 1], vector=Q.vector(key), tokens=fable['tokens'])
+            for i, (key, fable) in enumerate(zip(Q.keys, fables))]
+
+
+def _batch(metric: str) -> Callable[[DocumentVectors], Callable[[SimpleNamespace], str]]:
+    def build(Y: DocumentVectors):
+        Yt = Y.matrix.transpose()
+        def query(q: SimpleNamespace) -> str:
+            ids, _ = top_k(q.matrix, Y.matrix, 1, metric, x_norms=q.norm, y_norms=Y.norms, Yt=Yt)
+            return Y.keys[ids[0, 0]] if ids.size else None
+        return query
+    return build
+
+
+def _inverted_index(Y: DocumentVectors):
+    index = InvertedIndex(Y)
+    def query(q: SimpleNamespace) -> str:
+        t = index.search(q.vector, 1)
+        return t[0][0] if t else None
+    return query
+
+
+def _lsh(Y: DocumentVectors):
+    lsh = CosineLSH(Y)
+    def query(q: SimpleNamespace) -> str:
+        t = lsh.search_batch({q.key: q.vector}, 1)[q.key]
+        return t[0][0] if t else None
+    return query
+
+
+def _bm25(Y: TfIdfMatrix):
+    bm25 = BM25(Y)
+    def query(q: SimpleNamespace) -> str:
+        t = bm25.search(q.tokens, 1)
+        return t[0][0] if t else None
+    return query
+
+
+def _dict_loop(most_similar: Callable[[Mapping[str, Dict[str, float]], Dict[str, float]], str]):
+    def build(Y: DocumentVectors):
+        # plain dictionaries, since the quiz2 functions score a DocumentView against its matrix instead of looping
+        vectors = {key: Y.vector(key) for key in Y.keys}
+        return lambda q: most_similar(vectors, q.vector)
+    return build
+
+
+def _view(most_similar: Callable[[Mapping[str, Dict[str, float]], Dict[str, float]], str]):
+    def build(Y: DocumentVectors):
+        view = Y.to_dict()
+        return lambda q: most_similar(view, q.vector)
+    return build
+
+
+def _similar_documents(Y: DocumentVectors):
+    view = Y.to_dict()
+    return lambda q: quiz2.similar_documents({q.key: q.vector}, view)[q.key]
+
+
+# name -> function that builds the engine over the document vectors and returns the function answering one query.
+# cosine-index answers a query with MaxScore, whose per-term loop costs more than the one vectorized product of cosine-batch
+# until the corpus is large enough for skipping postings to pay off; see crossovers.
+ENGINES = {
+    'cosine-batch': _batch('cosine'),
+    'euclidean-batch': _batch('euclidean'),
+    'cosine-index': _inverted_index,
+    'cosine-lsh': _lsh,
+    'bm25': _bm25,
+    'cosine-loop': _dict_loop(quiz2.most_similar1),
+    'euclidean-loop': _dict_loop(most_similar),
+    'cosine-view': _view(quiz2.most_similar1),
+    'euclidean-view': _view(most_similar),
+    'similar-documents': _similar_documents,
+}
+
+# engines that score every pair in Python, run only on corpora up to loop_max documents
+LOOPS = {'cosine-loop', 'euclidean-loop'}
+
+# engines built over the raw term counts instead of the weighted vectors
+COUNTS = {'bm25'}
+
+# name -> function that vectorizes a stream of fables
+VECTORIZERS = {
+    'vectorize_tf_idfs': vectorize_tf_idfs,
+    'tf_idfs': tf_idfs,
+    'quiz2.vectorize': quiz2.vectorize,
+}
+
+
+def measure_build(build: Callable[[], Any], memory: bool = False) -> Tuple[Any, float, Optional[float]]:
+    """
+    Runs the build once.
+    :param memory: if True, the build is traced to measure its peak memory, which also slows down the timed run.
+    :return: a tuple of (the built object, seconds, peak megabytes allocated while building or None if not traced).
+    """
+    if memory: tracemalloc.start()
+    t = time.perf_counter()
+    out = build()
+    seconds = time.perf_counter() - t
+    peak = None
+    if memory:
+        peak = tracemalloc.get_traced_memory()[1] / 2 ** 20
+        tracemalloc.stop()
+    return out, seconds, peak
+
+
+def run_engines(Y: DocumentVectors, queries: List[SimpleNamespace], gold: Dict[str, str], engines: List[str], loop_max: int, memory: bool = False,
+                stats: Optional[TfIdfMatrix] = None) -> List[Dict[str, Any]]:
+    """
+    :param Y: the document vectors the engines are built over.
+    :param stats: the term counts of the documents for the engines in COUNTS; Y if not given, and these engines are skipped if Y has no counts.
+    """
+    if stats is None and isinstance(Y, TfIdfMatrix): stats = Y
+    results = []
+    for name in engines:
+        if name in LOOPS and len(Y) > loop_max: continue
+        if name in COUNTS and stats is None: continue
+        query, seconds, peak = measure_build(lambda: ENGINES[name](stats if name in COUNTS else Y), memory)
+        latencies, correct = [], 0
+        for q in queries:
+            t = time.perf_counter()
+            match = query(q)
+            latencies.append(time.perf_counter() - t)
+            correct += match == gold.get(q.key)
+        ms = np.array(latencies) * 1000
+        results.append({'engine': name, 'build_s': seconds, 'build_mb': peak,
+                        'p50_ms': float(np.percentile(ms, 50)), 'p90_ms': float(np.percentile(ms, 90)), 'p99_ms': float(np.percentile(ms, 99)),
+                        'accuracy': correct / max(len(gold), 1)})
+    return results
+
+
+def benchmark_synthetic(n_docs: int, n_queries: int, engines: List[str], loop_max: int, seed: int = 0, memory: bool = False, **kwargs) -> Dict[str, Any]:
+    """
+    Builds a synthetic corpus of n_docs fables, measures every vectorizer on it,
+    and measures every engine on n_queries noisy copies of its fables over the vectors of vectorize_tf_idfs.
+    :param memory: if True, the peak memory of every vectorizer and of building every engine is traced as well.
+    :param kwargs: the parameters of synthetic_fables.
+    """
+    rng = np.random.default_rng(seed)
+    picked = set(rng.choice(n_docs, size=min(n_queries, n_docs), replace=False).tolist())
+    sampled = []
+
+    def fables():
+        # the sampled fables are kept while the corpus is streamed into the first vectorizer
+        for i, fable in enumerate(synthetic_fables(n_docs, seed=seed, **kwargs)):
+            if i in picked and len(sampled) < len(picked): sampled.append(fable)
+            yield fable
+
+    vocab = Vocabulary()
+    Y, seconds, peak = measure_build(lambda: vectorize_tf_idfs(fables(), vocab), memory)
+    vectorizers = {'vectorize_tf_idfs': {'seconds': seconds, 'mb': peak}}
+    for name, vectorize in VECTORIZERS.items():
+        if name in vectorizers: continue
+        _, seconds, peak = measure_build(lambda: vectorize(fables()), memory)
+        vectorizers[name] = {'seconds': seconds, 'mb': peak}
+
+    query_fables, gold = noisy_queries(sampled, seed=seed + 1)
+    Q = vectorize_tf_idfs(query_fables, vocab)
+    return {'docs': n_docs, 'nnz': int(len(Y.matrix.indices)), 'vectorizers': vectorizers,
+            'engines': run_engines(Y, _queries(Q, Y, query_fables), gold, engines, loop_max, memory)}
+
+
+def benchmark_aesop(engines: List[str]) -> Dict[str, float]:
+    """
+    Vectorizes the fables and the alternative fables separately with quiz2.vectorize, as quiz2 does.
+    :return: the accuracy of quiz2.similar_documents and of every engine against the gold mapping FM on the bundled Aesop fables, as a regression check.
+    """
+    path = os.path.join(os.path.dirname(__file__), 'quiz', 'res', 'vsm')
+    fables = list(read_fables(os.path.join(path, 'aesopfables.json')))
+    query_fables = list(read_fables(os.path.join(path, 'aesopfables-alt.json')))
+    Y, X = quiz2.vectorize(fables), quiz2.vectorize(query_fables)
+
+    matches = quiz2.similar_documents(X, Y)
+    out = {'similar_documents': sum(matches.get(k) == v for k, v in quiz2.FM.items()) / len(quiz2.FM)}
+    # BM25 scores the raw counts, so it is built over the plain statistics of the same fables
+    Y, Q = as_vectors(Y), as_vectors(X)
+    stats = vectorize_tf_idfs(fables) if COUNTS & set(engines) else None
+    out.update((r['engine'], r['accuracy']) for r in run_engines(Y, _queries(Q, Y, query_fables), quiz2.FM, engines, len(Y), stats=stats))
+    return out
+
+
+def crossovers(synthetic: List[Dict[str, Any]], baseline: str = 'cosine-batch') -> Dict[str, Optional[int]]:
+    """
+    :param synthetic: the results of benchmark_synthetic over increasing corpus sizes.
+    :return: for every other engine, the smallest number of documents from which its median latency stays below the baseline's,
+             or None if it is slower on the largest corpus it ran on.
+    """
+    p50 = dict()
+    for r in synthetic:
+        times = {e['engine']: e['p50_ms'] for e in r['engines']}
+        if baseline not in times: continue
+        for name, ms in times.items():
+            if name != baseline: p50.setdefault(name, []).append((r['docs'], ms < times[baseline]))
+
+    out = dict()
+    for name, wins in p50.items():
+        out[name] = None
+        for docs, faster in sorted(wins, reverse=True):
+            if not faster: break
+            out[name] = docs
+    return out
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmarks the document similarity engines on synthetic Zipfian corpora.')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000, 100000, 1000000], help='numbers of documents')
+    parser.add_argument('--queries', type=int, default=200, help='number of queries per corpus')
+    parser.add_argument('--vocab', type=int, default=50000, help='vocabulary size')
+    parser.add_argument('--length', type=int, default=100, help='average number of tokens per document')
+    parser.add_argument('--zipf', type=float, default=1.1, help='Zipf exponent of the term distribution')
+    parser.add_argument('--engines', nargs='+', default=list(ENGINES), choices=list(ENGINES))
+    parser.add_argument('--loop-max', type=int, default=10000, help='largest corpus for the per-pair dictionary loop')
+    parser.add_argument('--memory', action='store_true', help='trace the peak memory of every build, which slows down the timed builds')
+    parser.add_argument('--json', help='if set, the results are also saved to this file')
+    args = parser.parse_args()
+
+    aesop = benchmark_aesop(args.engines)
+    print('Aesop accuracy against FM with quiz2.vectorize: ' + ', '.join('{}: {:.3f}'.format(k, v) for k, v in aesop.items()))
+
+    results = {'aesop': aesop, 'synthetic': []}
+    mb = lambda peak: '-' if peak is None else '{:.1f}'.format(peak)
+    for n in args.sizes:
+        r = benchmark_synthetic(n, args.queries, args.engines, args.loop_max, memory=args.memory, vocab_size=args.vocab, doc_length=args.length, zipf=args.zipf)
+        results['synthetic'].append(r)
+        print('\n{:,} docs ({:,} non-zeros): '.format(r['docs'], r['nnz']) +
+              ', '.join('{} {:.2f}s, {}MB'.format(k, v['seconds'], mb(v['mb'])) for k, v in r['vectorizers'].items()))
+        print('{:<18}{:>10}{:>11}{:>10}{:>10}{:>10}{:>10}'.format('engine', 'build(s)', 'build(MB)', 'p50(ms)', 'p90(ms)', 'p99(ms)', 'acc'))
+        for e in r['engines']:
+            print('{:<18}{:>10.3f}{:>11}{:>10.3f}{:>10.3f}{:>10.3f}{:>10.3f}'.format(
+                e['engine'], e['build_s'], mb(e['build_mb']), e['p50_ms'], e['p90_ms'], e['p99_ms'], e['accuracy']))
+
+    results['crossovers'] = crossovers(results['synthetic'])
+    if results['crossovers']:
+        print('\nFaster than cosine-batch (p50) from: ' + ', '.join(
+            '{}: {}'.format(k, 'never' if v is None else '{:,} docs'.format(v)) for k, v in results['crossovers'].items()))
+
+    if args.json: json.dump(results, open(args.json, 'w'), indent=2)
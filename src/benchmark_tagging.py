@@ -0,0 +1,80 @@
+# ========================================================================
+# Copyright 2022 Emory University
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ========================================================================
+import argparse
+import json
+import os
+import time
+from typing import List, Tuple, Dict, Optional, Any
+
+from src.pos_models import TaggerModel
+
+
+def accuracy(data: List[List[Tuple[str, str]]], outputs: List[List[Tuple[str, float]]]) -> float:
+    """
+    :return: the accuracy (%) of the outputs against the gold tags of the data.
+    """
+    total = sum(len(sentence) for sentence in data)
+    correct = sum(g == p for sentence, output in zip(data, outputs) for (_, g), (p, _) in zip(sentence, output))
+    return 100.0 * correct / max(total, 1)
+
+
+def benchmark_decoding(model: TaggerModel, data: List[List[Tuple[str, str]]], widths: List[Optional[int]], repeat: int = 3) -> List[Dict[str, Any]]:
+    """
+    Measures the throughput and accuracy of greedy, beam, and Viterbi decoding with and without pruning the tags by the 'cw' table.
+    :param widths: the beam widths to measure; 1 is greedy and None is Viterbi.
+    :param repeat: the throughput is the best of this many runs.
+    :return: one row per setting, starting with the per-sentence predict as the baseline.
+    """
+    sentences = [[w for w, _ in sentence] for sentence in data]
+    n_tokens = sum(len(s) for s in sentences)
+
+    def measure(name: str, width: Optional[int], prune: Optional[bool], decode) -> Dict[str, Any]:
+        seconds = []
+        for _ in range(repeat):
+            t = time.perf_counter()
+            outputs = decode()
+            seconds.append(time.perf_counter() - t)
+        return {'decoder': name, 'width': width, 'prune': prune, 'tokens/s': n_tokens / min(seconds), 'accuracy': accuracy(data, outputs)}
+
+    results = [measure('predict', 1, False, lambda: [model.predict(s) for s in sentences])]
+    for width in widths:
+        name = 'greedy' if width == 1 else 'viterbi' if width is None else 'beam'
+        for prune in (False, True):
+            results.append(measure(name, width, prune, lambda: model.predict_batch(sentences, width, prune)))
+    return results
+
+
+if __name__ == '__main__':
+    from src.quiz.quiz3 import read_data, train
+
+    path = os.path.join(os.path.dirname(__file__), 'quiz', 'res', 'pos')
+    parser = argparse.ArgumentParser(description='Benchmarks the decoding modes of the quiz3 tagger: tokens/sec against accuracy.')
+    parser.add_argument('--trn', default=os.path.join(path, 'wsj-pos.trn.gold.tsv'))
+    parser.add_argument('--dev', default=os.path.join(path, 'wsj-pos.dev.gold.tsv'))
+    parser.add_argument('--widths', nargs='+', default=['1', '2', '4', '8', 'viterbi'], help="beam widths; 'viterbi' for no limit")
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--json', help='if set, the results are also saved to this file')
+    args = parser.parse_args()
+
+    dev_data = read_data(args.dev)
+    model = train(read_data(args.trn), dev_data)
+    widths = [None if w == 'viterbi' else int(w) for w in args.widths]
+    results = benchmark_decoding(model, dev_data, widths, args.repeat)
+
+    print('{:<10}{:>8}{:>8}{:>12}{:>10}'.format('decoder', 'width', 'prune', 'tokens/s', 'acc'))
+    for r in results:
+        print('{:<10}{:>8}{:>8}{:>12,.0f}{:>10.3f}'.format(r['decoder'], str(r['width'] or '-'), str(r['prune']), r['tokens/s'], r['accuracy']))
+    if args.json: json.dump(results, open(args.json, 'w'), indent=2)
@@ -0,0 +1,146 @@
+# ========================================================================
+# Copyright 2022 Emory University
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ========================================================================
+from collections import OrderedDict
+from typing import List, Tuple, Dict, Any, Hashable, Optional, Sequence
+
+from src.pos_models import DUMMY, UNKNOWN_ID, TaggerModel
+
+
+class LRUCache:
+    """
+    Bounded mapping that evicts the least recently used entry, counting its hits and misses.
+    It is not thread-safe; every thread or process should keep its own.
+    """
+    def __init__(self, maxsize: int):
+        """
+        :param maxsize: the maximum number of entries; nothing is kept if 0.
+        """
+        self.maxsize = maxsize
+        self.entries: OrderedDict = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        """
+        :return: the value of the key, which becomes the most recently used; default if the key is not cached.
+        """
+        value = self.entries.get(key, self)
+        if value is self:
+            self.misses += 1
+            return default
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def put(self, key: Hashable, value: Any):
+        if self.maxsize <= 0: return
+        self.entries[key] = value
+        self.entries.move_to_end(key)
+        if len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+
+    def clear(self):
+        self.entries.clear()
+        self.hits = self.misses = self.evictions = 0
+
+    @property
+    def hit_rate(self) -> float:
+        return self.hits / max(self.hits + self.misses, 1)
+
+    def stats(self) -> Dict[str, Any]:
+        return {'size': len(self), 'maxsize': self.maxsize, 'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions, 'hit_rate': self.hit_rate}
+
+
+class CachedTagger:
+    """
+    Greedy tagger with two levels of LRU caches in front of the model:
+    - the outputs of whole sentences keyed by their tokens;
+    - the (tag id, score) of single positions keyed by (previous tag id, previous word, current word, next word),
+      which is exact because no template looks beyond these slots.
+    Positions missing from the cache are scored by the model; the templates without the previous POS are then looked up once for the whole sentence.
+    """
+    def __init__(self, model: TaggerModel, sentence_size: int = 1 << 14, position_size: int = 1 << 18):
+        """
+        :param model: the tagger to cache.
+        :param sentence_size: the maximum number of cached sentences; 0 disables the sentence cache.
+        :param position_size: the maximum number of cached positions; 0 disables the position cache.
+        """
+        self.model = model
+        self.sentences = LRUCache(sentence_size)
+        self.positions = LRUCache(position_size)
+
+    def predict(self, tokens: Sequence[str]) -> List[Tuple[str, float]]:
+        """
+        :param tokens: a list of tokens.
+        :return: the same output as TaggerModel.predict.
+        """
+        key = tuple(tokens)
+        output = self.sentences.get(key)
+        if output is not None: return list(output)
+
+        model, n = self.model, len(tokens)
+        output, ctx, static = [], None, None
+        prev_pos = model.tags.get(DUMMY, UNKNOWN_ID)
+
+        for i in range(n):
+            position = (prev_pos, tokens[i - 1] if i > 0 else DUMMY, tokens[i], tokens[i + 1] if i + 1 < n else DUMMY)
+            value = self.positions.get(position)
+            if value is None:
+                if static is None:
+                    ctx = model.contexts(tokens)
+                    static = model._static_scores(ctx)
+                value = model._decode_position(i, prev_pos, ctx, *static)
+                self.positions.put(position, value)
+            prev_pos, score = value
+            output.append((model.tags.terms[prev_pos] if prev_pos != UNKNOWN_ID else 'XX', score))
+
+        self.sentences.put(key, output)
+        return list(output)
+
+    def predict_batch(self, sentences: Sequence[Sequence[str]], width: Optional[int] = 1, prune: bool = False) -> List[List[Tuple[str, float]]]:
+        """
+        Looks up the sentence cache first and tags the rest together with TaggerModel.predict_batch, whose outputs fill both caches.
+        Decoding other than greedy (see TaggerModel.predict_batch) bypasses the caches.
+        """
+        model = self.model
+        if width != 1 or prune: return model.predict_batch(sentences, width, prune)
+
+        keys = [tuple(tokens) for tokens in sentences]
+        outputs = [self.sentences.get(key) for key in keys]
+        misses = [i for i, output in enumerate(outputs) if output is None]
+        dummy = model.tags.get(DUMMY, UNKNOWN_ID)
+
+        for i, output in zip(misses, model.predict_batch([sentences[i] for i in misses]) if misses else []):
+            tokens, prev_pos = keys[i], dummy
+            for j, (pos, score) in enumerate(output):
+                tag = model.tags.get(pos, UNKNOWN_ID)
+                self.positions.put((prev_pos, tokens[j - 1] if j > 0 else DUMMY, tokens[j], tokens[j + 1] if j + 1 < len(tokens) else DUMMY), (tag, score))
+                prev_pos = tag
+            self.sentences.put(keys[i], output)
+            outputs[i] = output
+
+        return [list(output) for output in outputs]
+
+    def stats(self) -> Dict[str, Dict[str, Any]]:
+        """
+        :return: the counters of the sentence and the position caches (see LRUCache.stats).
+        """
+        return {'sentence': self.sentences.stats(), 'position': self.positions.stats()}
@@ -0,0 +1,673 @@
+# ========================================================================
+# Copyright 2022 Emory University
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ========================================================================
+import itertools
+from functools import cached_property
+from typing import List, Tuple, Dict, Any, Sequence, Iterable, Iterator, Optional, Union
+
+import numpy as np
+
+from src.vector_space_models import Vocabulary, CSRMatrix
+
+DUMMY = '!@#$'
+
+# A feature template is named by its context slots joined with '_' (e.g., 'pw_cw_nw'), in the order of the tuple keys of quiz3.
+# The ids of the slots are packed into one int64 key of KEY_BITS bits per slot; the largest id is reserved for unknown words/tags.
+KEY_BITS = 21
+UNKNOWN_ID = (1 << KEY_BITS) - 1
+SLOTS = ('pw', 'cw', 'nw', 'pp')
+TEMPLATES = ('cw', 'pp', 'pw', 'nw', 'cw_pw', 'cw_nw', 'cw_pp', 'pw_cw_nw', 'pp_cw_nw')
+
+# greedy batches of fewer sentences than this are tagged one sentence at a time, since decoding a position across the batch
+# costs a fixed number of array operations that only pays off once they are shared by a few sentences
+MIN_BATCH = 4
+
+
+def read_sentences(filename: str) -> Iterator[List[Tuple[str, str]]]:
+    """
+    Reads sentences one at a time from a TSV file where every line is a (word, pos) pair and sentences are separated by blank lines.
+    :param filename: the path to the TSV file.
+    :return: an iterator of sentences, each a list of (word, pos) pairs; the last sentence is kept even if the file does not end with a blank line.
+    """
+    sentence = []
+    with open(filename) as fin:
+        for line in fin:
+            l = line.split()
+            if l:
+                sentence.append((l[0], l[1]))
+            elif sentence:
+                yield sentence
+                sentence = []
+    if sentence: yield sentence
+
+
+def batches(items: Iterable[Any], size: int) -> Iterator[List[Any]]:
+    """
+    :return: an iterator of lists of the next size items; the last list may be shorter.
+    """
+    it = iter(items)
+    while True:
+        batch = list(itertools.islice(it, size))
+        if not batch: return
+        yield batch
+
+
+def template_slots(template: str) -> Tuple[str, ...]:
+    """
+    :param template: the name of a feature template, e.g., 'pp_cw_nw'.
+    :return: the context slots of the template, e.g., ('pp', 'cw', 'nw').
+    """
+    slots = tuple(template.split('_'))
+    if not 0 < len(slots) <= 3 or any(s not in SLOTS for s in slots):
+        raise ValueError('Invalid feature template: {}'.format(template))
+    return slots
+
+
+def pack(ids: Sequence[Union[int, np.ndarray]]) -> Union[int, np.ndarray]:
+    """
+    :param ids: the ids of the slots of a template, either scalars or arrays of the same length.
+    :return: the packed key(s).
+    """
+    key = 0
+    for i in ids: key = (key << KEY_BITS) | i
+    return key
+
+
+def unpack(keys: np.ndarray, n_slots: int) -> List[np.ndarray]:
+    """
+    :return: the ids of the slots packed into the keys.
+    """
+    return [(keys >> (KEY_BITS * (n_slots - 1 - j))) & UNKNOWN_ID for j in range(n_slots)]
+
+
+def contexts(cw: np.ndarray, starts: np.ndarray, dummy: int) -> Dict[str, np.ndarray]:
+    """
+    :param cw: the word ids of the tokens in consecutive sentences.
+    :param starts: True for the first token of every sentence.
+    :param dummy: the word id of DUMMY, used before the first and after the last token of every sentence.
+    :return: the word ids of the 'pw', 'cw', 'nw' slots of every token.
+    """
+    ends = np.roll(starts, -1)
+    if len(ends): ends[-1] = True
+    return {'pw': np.where(starts, dummy, np.roll(cw, 1)), 'cw': cw, 'nw': np.where(ends, dummy, np.roll(cw, -1))}
+
+
+class FeatureTable:
+    """
+    Tag distributions of one feature template: row i of the matrix holds the (tag id, probability) pairs of the context keys[i]
+    in descending order of probability, where keys are the packed contexts sorted in ascending order.
+    """
+    def __init__(self, keys: np.ndarray, matrix: CSRMatrix):
+        self.keys = keys
+        self.matrix = matrix
+
+    def __len__(self) -> int:
+        return len(self.keys)
+
+    @property
+    def nbytes(self) -> int:
+        M = self.matrix
+        return self.keys.nbytes + M.indptr.nbytes + M.indices.nbytes + M.data.nbytes
+
+    def find(self, keys: np.ndarray) -> np.ndarray:
+        """
+        :return: the row of every key; -1 if the key does not exist.
+        """
+        if len(self.keys) == 0: return np.full(len(keys), -1, dtype=np.int64)
+        rows = np.minimum(np.searchsorted(self.keys, keys), len(self.keys) - 1)
+        return np.where(self.keys[rows] == keys, rows, -1)
+
+    def get(self, key: int) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        :return: a pair of (tag ids, probabilities) of the key; both are empty if the key does not exist.
+        """
+        i = int(np.searchsorted(self.keys, key))
+        if i < len(self.keys) and self.keys[i] == key: return self.matrix.row(i)
+        return self.matrix.indices[:0], self.matrix.data[:0]
+
+    @staticmethod
+    def from_dict(model: Dict[Any, List[Tuple[str, float]]], slots: Tuple[str, ...], words: Vocabulary, tags: Vocabulary) -> 'FeatureTable':
+        """
+        :param model: a dictionary created by one of the quiz3.create_*_dict functions; the keys are tuples if there are multiple slots.
+        :param slots: the context slots of the keys in the model.
+        :param words: the vocabulary of words, extended with the words in the model.
+        :param tags: the vocabulary of tags, extended with the tags in the model.
+        """
+        keys, rows = [], []
+        for context, ts in model.items():
+            if len(slots) == 1: context = (context,)
+            keys.append(pack([tags.add(c) if s == 'pp' else words.add(c) for s, c in zip(slots, context)]))
+            rows.append((np.array([tags.add(t) for t, _ in ts], dtype=np.int32), np.array([p for _, p in ts])))
+
+        keys = np.array(keys, dtype=np.int64)
+        order = np.argsort(keys)
+        return FeatureTable(keys[order], CSRMatrix.from_rows([rows[i] for i in order], len(tags)))
+
+
+def _key_starts(keys: np.ndarray) -> np.ndarray:
+    # the index of the first entry of every key in sorted keys
+    return np.nonzero(np.concatenate(([True], keys[1:] != keys[:-1])))[0] if len(keys) else np.zeros(0, dtype=np.int64)
+
+
+def _count(keys: np.ndarray, tags: np.ndarray, counts: np.ndarray, first: np.ndarray) -> Tuple[np.ndarray, ...]:
+    # sums the counts and takes the first occurrences of the same (key, tag) pairs, sorted by key then tag
+    order = np.lexsort((tags, keys))
+    keys, tags, counts, first = keys[order], tags[order], counts[order], first[order]
+    starts = np.nonzero(np.concatenate(([True], (keys[1:] != keys[:-1]) | (tags[1:] != tags[:-1]))))[0] if len(keys) else np.zeros(0, dtype=np.int64)
+    return keys[starts], tags[starts], np.add.reduceat(counts, starts) if len(keys) else counts, np.minimum.reduceat(first, starts) if len(keys) else first
+
+
+class FeatureCounts:
+    """
+    Tag counts of multiple feature templates collected in one pass over the data: the contexts of every token are extracted once
+    and the counts of all templates are updated together, a chunk of tokens at a time.
+    Each template keeps sorted runs of (key, tag, count, first occurrence) arrays that are merged like a binary counter,
+    so the cost of merging stays proportional to the number of distinct entries.
+    """
+    def __init__(self, templates: Sequence[str] = TEMPLATES, words: Vocabulary = None, tags: Vocabulary = None, chunk_size: int = 1 << 16):
+        """
+        :param templates: the names of the feature templates to count (see template_slots).
+        :param words: the vocabulary of words to extend; a new one is created if not given.
+        :param tags: the vocabulary of tags to extend; a new one is created if not given.
+        :param chunk_size: the number of tokens whose contexts are extracted at a time.
+        """
+        self.words = words if words is not None else Vocabulary()
+        self.tags = tags if tags is not None else Vocabulary()
+        self.words.add(DUMMY)
+        self.tags.add(DUMMY)
+        self.slots = {name: template_slots(name) for name in templates}
+        self.chunk_size = chunk_size
+        self.runs: Dict[str, List[Tuple[np.ndarray, ...]]] = {name: [] for name in templates}
+        self.n_tokens = 0
+        self._words, self._tags, self._starts = [], [], []
+
+    def update(self, sentence: Sequence[Tuple[str, str]]):
+        """
+        :param sentence: a list of (word, pos) pairs.
+        """
+        if not sentence: return
+        self._starts.append(len(self._words))
+        for word, pos in sentence:
+            self._words.append(self.words.add(word))
+            self._tags.append(self.tags.add(pos))
+        if len(self._words) >= self.chunk_size: self._flush()
+
+    def update_all(self, data: Iterable[Sequence[Tuple[str, str]]]) -> 'FeatureCounts':
+        for sentence in data: self.update(sentence)
+        return self
+
+    def _flush(self):
+        if not self._words: return
+        n = len(self._words)
+        cw, tags = np.array(self._words, dtype=np.int64), np.array(self._tags, dtype=np.int64)
+        starts = np.zeros(n, dtype=bool)
+        starts[self._starts] = True
+        ctx = contexts(cw, starts, self.words.get(DUMMY))
+        ctx['pp'] = np.where(starts, self.tags.get(DUMMY), np.roll(tags, 1))
+        first = np.arange(self.n_tokens, self.n_tokens + n, dtype=np.int64)
+        ones = np.ones(n, dtype=np.int64)
+
+        for name, slots in self.slots.items():
+            runs = self.runs[name]
+            runs.append(_count(pack([ctx[s] for s in slots]), tags, ones, first))
+            while len(runs) > 1 and len(runs[-2][0]) <= 2 * len(runs[-1][0]):
+                b, a = runs.pop(), runs.pop()
+                runs.append(_count(*(np.concatenate((x, y)) for x, y in zip(a, b))))
+
+        self.n_tokens += n
+        self._words, self._tags, self._starts = [], [], []
+
+    def counts(self, template: str) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+        """
+        :return: the (keys, tag ids, counts, first occurrences) arrays of the template sorted by key then tag.
+        """
+        self._flush()
+        runs = self.runs[template]
+        if len(runs) != 1:
+            empty = np.zeros(0, dtype=np.int64)
+            runs[:] = [_count(*(np.concatenate(x) for x in zip(*runs))) if runs else (empty,) * 4]
+        return runs[0]
+
+    def _rows(self, template: str) -> Tuple[np.ndarray, ...]:
+        # entries ordered by key, descending count, then first occurrence like Counter.most_common, with the start of every key
+        keys, tags, counts, first = self.counts(template)
+        order = np.lexsort((first, -counts, keys))
+        keys, tags, counts, first = keys[order], tags[order], counts[order], first[order]
+        starts = _key_starts(keys)
+        totals = np.add.reduceat(counts, starts) if len(keys) else counts
+        probs = counts / np.repeat(totals, np.diff(np.append(starts, len(keys))))
+        return keys, tags, counts, probs, first, starts
+
+    def _backoff(self, template: str, keys: np.ndarray, tags: np.ndarray, counts: np.ndarray) -> np.ndarray:
+        # the probability of every entry given the current word alone if the template has it besides other slots, otherwise the prior of the tag
+        slots = self.slots[template]
+        if 'cw' in slots and len(slots) > 1 and 'cw' in self.slots:
+            cw_keys, cw_tags, cw_counts, _ = self.counts('cw')
+            starts = _key_starts(cw_keys)
+            totals = np.repeat(np.add.reduceat(cw_counts, starts), np.diff(np.append(starts, len(cw_keys)))) if len(cw_keys) else cw_counts
+            # every (word, tag) pair of the template was counted by 'cw' as well
+            pairs = (cw_keys << KEY_BITS) | cw_tags
+            i = np.searchsorted(pairs, (unpack(keys, len(slots))[slots.index('cw')] << KEY_BITS) | tags)
+            return cw_counts[i] / totals[i]
+        prior = np.bincount(tags, weights=counts)
+        return prior[tags] / max(prior.sum(), 1)
+
+    def _keep(self, template: str, min_count: int, top_k: int, min_divergence: float) -> Tuple[np.ndarray, ...]:
+        # the entries of _rows that survive pruning
+        keys, tags, counts, probs, first, starts = self._rows(template)
+        group = np.repeat(np.arange(len(starts)), np.diff(np.append(starts, len(keys))))
+        totals = np.add.reduceat(counts, starts) if len(keys) else counts
+        keep = totals[group] >= min_count
+        if top_k > 0: keep &= np.arange(len(keys)) - starts[group] < top_k
+        if min_divergence > 0:
+            divergence = np.bincount(group, weights=probs * np.log(probs / self._backoff(template, keys, tags, counts)), minlength=len(starts))
+            keep &= (totals * divergence)[group] >= min_divergence
+        keys, tags, counts, probs, first = keys[keep], tags[keep], counts[keep], probs[keep], first[keep]
+        return keys, tags, counts, probs, first, _key_starts(keys)
+
+    def table(self, template: str, min_count: int = 1, top_k: int = 0, min_divergence: float = 0.0) -> FeatureTable:
+        """
+        :param template: the name of the template.
+        :param min_count: the contexts seen fewer times than this are dropped.
+        :param top_k: if positive, only the k most frequent tags of every context are kept.
+        :param min_divergence: the contexts whose count times the KL divergence (in nats) of their tag distribution from the backoff
+                               distribution is below this are dropped, where the backoff is the 'cw' distribution of the same word
+                               for the templates with the current word and other slots, and the tag prior for the others.
+        :return: the feature table of the template whose probabilities are the relative frequencies of the tags given each context;
+                 the probabilities of the tags kept by top_k are not renormalized.
+        """
+        keys, tags, _, probs, _, starts = self._keep(template, min_count, top_k, min_divergence)
+        indptr = np.append(starts, len(keys)).astype(np.int64)
+        return FeatureTable(keys[starts], CSRMatrix(indptr, tags.astype(np.int32), probs, len(self.tags)))
+
+    def tables(self, min_count: Union[int, Dict[str, int]] = 1, top_k: Union[int, Dict[str, int]] = 0,
+               min_divergence: Union[float, Dict[str, float]] = 0.0) -> Dict[str, FeatureTable]:
+        """
+        :param min_count: see table; either one value for all templates or a dictionary of (template name, value).
+        :param top_k: see table; either one value for all templates or a dictionary of (template name, value).
+        :param min_divergence: see table; either one value for all templates or a dictionary of (template name, value).
+        :return: a dictionary of (template name, feature table).
+        """
+        def setting(value, name: str, default):
+            return value.get(name, default) if isinstance(value, dict) else value
+
+        return {name: self.table(name, setting(min_count, name, 1), setting(top_k, name, 0), setting(min_divergence, name, 0.0)) for name in self.slots}
+
+    def to_dict(self, template: str, min_count: int = 1, top_k: int = 0) -> Dict[Any, List[Tuple[str, float]]]:
+        """
+        :param min_count: see table.
+        :param top_k: see table.
+        :return: the same dictionary as the corresponding quiz3.create_*_dict function:
+                 (context, list of (POS, probability) in descending order) where the context is a tuple if the template has multiple slots.
+        """
+        keys, tags, _, probs, first, starts = self._keep(template, min_count, top_k, 0.0)
+        slots = self.slots[template]
+        ids = [a.tolist() for a in unpack(keys[starts], len(slots))]
+        names = [self.tags.terms if s == 'pp' else self.words.terms for s in slots]
+        contexts = [names[0][c] for c in ids[0]] if len(slots) == 1 else list(zip(*([n[i] for i in c] for n, c in zip(names, ids))))
+        tag_names, probs = [self.tags.terms[t] for t in tags.tolist()], probs.tolist()
+        bounds = np.append(starts, len(keys)).tolist()
+
+        model = dict()
+        # contexts are inserted in the order of their first occurrences
+        for g in np.argsort(np.minimum.reduceat(first, starts), kind='stable').tolist() if len(keys) else []:
+            s, e = bounds[g], bounds[g + 1]
+            model[contexts[g]] = list(zip(tag_names[s:e], probs[s:e]))
+        return model
+
+
+class TaggerModel:
+    """
+    Interpolated POS tagger over array-backed feature tables: the score of a tag is the sum of its probabilities
+    given the contexts of all templates times the template weights, decoded greedily from left to right.
+    """
+    def __init__(self, words: Vocabulary, tags: Vocabulary, tables: Dict[str, FeatureTable], weights: Dict[str, float]):
+        """
+        :param words: the vocabulary of words including DUMMY.
+        :param tags: the vocabulary of tags including DUMMY.
+        :param tables: a dictionary of (template name, feature table).
+        :param weights: a dictionary of (template name, weight).
+        """
+        if max(len(words), len(tags)) >= UNKNOWN_ID: raise ValueError('Too many words or tags to pack into keys.')
+        self.words = words
+        self.tags = tags
+        self.tables = tables
+        self.weights = weights
+        self.slots = {name: template_slots(name) for name in tables}
+
+    @property
+    def nbytes(self) -> int:
+        return sum(t.nbytes for t in self.tables.values())
+
+    def word_ids(self, tokens: Sequence[str]) -> np.ndarray:
+        """
+        :return: the ids of the tokens; UNKNOWN_ID for the tokens out of the vocabulary.
+        """
+        # vocabularies loaded from files (see pos_store) look up all tokens together
+        if hasattr(self.words, 'get_all'): return self.words.get_all(tokens, UNKNOWN_ID).astype(np.int64)
+        get = self.words.get
+        return np.array([get(t, UNKNOWN_ID) for t in tokens], dtype=np.int64)
+
+    def contexts(self, tokens: Sequence[str]) -> Dict[str, np.ndarray]:
+        """
+        :return: the word ids of the 'pw', 'cw', 'nw' slots of every token.
+        """
+        cw = self.word_ids(tokens)
+        dummy = np.array([self.words.get(DUMMY, UNKNOWN_ID)], dtype=np.int64)
+        return {'pw': np.concatenate((dummy, cw[:-1])), 'cw': cw, 'nw': np.concatenate((cw[1:], dummy))}
+
+    def predict(self, tokens: Sequence[str]) -> List[Tuple[str, float]]:
+        """
+        :param tokens: a list of tokens.
+        :return: a list of tuple where each tuple represents a pair of (POS, score) of the corresponding token.
+        """
+        if len(tokens) == 0: return []
+        ctx = self.contexts(tokens)
+        static = self._static_scores(ctx)
+        output = []
+        prev_pos = self.tags.get(DUMMY, UNKNOWN_ID)
+
+        for i in range(len(tokens)):
+            prev_pos, score = self._decode_position(i, prev_pos, ctx, *static)
+            output.append((self.tags.terms[prev_pos] if prev_pos != UNKNOWN_ID else 'XX', score))
+
+        return output
+
+    def _static_scores(self, ctx: Dict[str, np.ndarray]) -> Tuple[np.ndarray, np.ndarray, List[Tuple[str, FeatureTable]]]:
+        # the scores of the templates without the previous POS, looked up for all tokens at once, and the templates with it
+        n, T = len(ctx['cw']), len(self.tags)
+        scores, touched = np.zeros((n, T)), np.zeros((n, T), dtype=bool)
+        dynamic = []
+
+        for name, table in self.tables.items():
+            if 'pp' in self.slots[name]:
+                dynamic.append((name, table))
+                continue
+            rows = table.find(pack([ctx[s] for s in self.slots[name]]))
+            tokens_found = np.nonzero(rows >= 0)[0]
+            positions, lengths = table.matrix.positions(rows[tokens_found])
+            i, t = np.repeat(tokens_found, lengths), table.matrix.indices[positions]
+            scores[i, t] += table.matrix.data[positions] * self.weights[name]
+            touched[i, t] = True
+
+        return scores, touched, dynamic
+
+    def _decode_position(self, i: int, prev_pos: int, ctx: Dict[str, np.ndarray], scores: np.ndarray, touched: np.ndarray,
+                         dynamic: List[Tuple[str, FeatureTable]]) -> Tuple[int, float]:
+        # the best tag id of the i'th token given the previous tag id and its score; UNKNOWN_ID if no template has any tag for the token
+        for name, table in dynamic:
+            ids = [prev_pos if s == 'pp' else int(ctx[s][i]) for s in self.slots[name]]
+            t, probs = table.get(pack(ids))
+            scores[i, t] += probs * self.weights[name]
+            touched[i, t] = True
+
+        if not touched[i].any(): return UNKNOWN_ID, 0.0
+        best = int(np.argmax(np.where(touched[i], scores[i], -np.inf)))
+        return best, float(scores[i, best])
+
+    def predict_batch(self, sentences: Sequence[Sequence[str]], width: Optional[int] = 1, prune: bool = False) -> List[List[Tuple[str, float]]]:
+        """
+        Tags all sentences together: the tokens are mapped to ids and the contexts of all templates are looked up at once,
+        and only the templates with the previous POS are decoded one position of every sentence at a time.
+        :param sentences: lists of tokens.
+        :param width: the beam width (see TokenFeatures.search); 1 decodes greedily, None decodes with Viterbi.
+                      Wider beams trade throughput for searching more tag sequences.
+        :param prune: if True, the tags of every known word are restricted to its tags in the 'cw' table.
+        :return: a list of (POS, score) pairs for every sentence; the same output as predict with the defaults.
+        """
+        greedy = width == 1 and not prune
+        if greedy and len(sentences) < MIN_BATCH: return [self.predict(tokens) for tokens in sentences]
+        features = TokenFeatures(self, sentences, dynamic_rows=False)
+        tags, scores = features.decode(self.weights) if greedy else features.search(self.weights, width, prune)
+        terms = self.tags.terms
+        pairs = [(terms[t] if t != UNKNOWN_ID else 'XX', s) for t, s in zip(tags.tolist(), scores.tolist())]
+        offsets = np.cumsum([0] + [len(s) for s in sentences]).tolist()
+        return [pairs[offsets[i]:offsets[i + 1]] for i in range(len(sentences))]
+
+    @staticmethod
+    def from_counts(counts: FeatureCounts, weights: Dict[str, float], **pruning: Any) -> 'TaggerModel':
+        """
+        :param counts: the counts of the templates to use.
+        :param weights: a dictionary of (template name, weight).
+        :param pruning: min_count, top_k, and min_divergence passed to FeatureCounts.tables.
+        """
+        return TaggerModel(counts.words, counts.tags, counts.tables(**pruning), weights)
+
+    @staticmethod
+    def from_dicts(models: Dict[str, Dict[Any, List[Tuple[str, float]]]], weights: Dict[str, float]) -> 'TaggerModel':
+        """
+        :param models: a dictionary of (template name, dictionary created by the corresponding quiz3.create_*_dict function).
+        :param weights: a dictionary of (template name, weight).
+        """
+        words, tags = Vocabulary(), Vocabulary()
+        words.add(DUMMY)
+        tags.add(DUMMY)
+        tables = {name: FeatureTable.from_dict(model, template_slots(name), words, tags) for name, model in models.items()}
+        for table in tables.values(): table.matrix.n_cols = len(tags)
+        return TaggerModel(words, tags, tables, weights)
+
+
+class TokenFeatures:
+    """
+    The lookups of all templates for a batch of sentences, done once so that the sentences can be decoded with any weights:
+    - the entries of the templates without the previous POS are kept as (cell, probability, template) arrays,
+      where cell = token * len(tags) + tag, so that their weighted sums are one bincount over all tokens;
+    - the templates with the previous POS keep the row of every (token, previous tag) pair if dynamic_rows is True,
+      so that greedy decoding gathers rows for all sentences at the same position instead of packing and searching keys;
+      otherwise, only the keys of the tags actually predicted are packed and searched, once per position for all sentences.
+    Looking up all previous tags pays off when the same sentences are decoded many times (e.g., weight tuning), not for a single decoding.
+    """
+    def __init__(self, model: TaggerModel, sentences: Sequence[Sequence[str]], dynamic_rows: bool = True, max_cells: int = 1 << 22):
+        """
+        :param model: the model whose tables are looked up; its weights are not used.
+        :param sentences: lists of tokens.
+        :param dynamic_rows: if True, the templates with the previous POS are looked up for all previous tags in advance.
+        :param max_cells: the maximum number of (token, previous tag) keys searched at a time, which bounds the memory of the lookups.
+        """
+        self.model = model
+        self.lengths = np.array([len(s) for s in sentences], dtype=np.int64)
+        self.offsets = np.concatenate(([0], np.cumsum(self.lengths))).astype(np.int64)
+        self.n_tokens, T = int(self.offsets[-1]), len(model.tags)
+
+        cw = model.word_ids([t for s in sentences for t in s])
+        starts = np.zeros(self.n_tokens, dtype=bool)
+        starts[self.offsets[:-1][self.lengths > 0]] = True
+        ctx = self.ctx = contexts(cw, starts, model.words.get(DUMMY, UNKNOWN_ID))
+
+        cells, probs, template_ids = [], [], []
+        self.templates = list(model.tables)
+        self.dynamic: List[Tuple[int, Optional[np.ndarray]]] = []
+
+        for j, name in enumerate(self.templates):
+            table, slots = model.tables[name], model.slots[name]
+            if 'pp' in slots:
+                self.dynamic.append((j, self._dynamic_rows(table, slots, ctx, max_cells) if dynamic_rows else None))
+                continue
+            rows = table.find(pack([ctx[s] for s in slots]))
+            found = np.nonzero(rows >= 0)[0]
+            positions, lengths = table.matrix.positions(rows[found])
+            cells.append(np.repeat(found, lengths) * T + table.matrix.indices[positions])
+            probs.append(table.matrix.data[positions])
+            template_ids.append(np.full(len(positions), j, dtype=np.int32))
+
+        self.cells = np.concatenate(cells) if cells else np.zeros(0, dtype=np.int64)
+        self.probs = np.concatenate(probs) if probs else np.zeros(0)
+        self.template_ids = np.concatenate(template_ids) if template_ids else np.zeros(0, dtype=np.int32)
+        self.touched = np.zeros(self.n_tokens * T, dtype=bool)
+        self.touched[self.cells] = True
+
+        # sentences sorted by descending length so that the sentences still decoding at position i are a prefix
+        self.order = np.argsort(-self.lengths, kind='stable')
+        self.counts = np.searchsorted(-self.lengths[self.order], -np.arange(int(self.lengths.max(initial=0))), 'left')
+
+    def _dynamic_rows(self, table: FeatureTable, slots: Tuple[str, ...], ctx: Dict[str, np.ndarray], max_cells: int) -> np.ndarray:
+        # rows[token, previous tag]; a single row is shared by all tokens if the template only has the previous POS,
+        # and the extra last column stands for a previous token without any tag
+        T = len(self.model.tags)
+        n = self.n_tokens if any(s != 'pp' for s in slots) else 1
+        rows = np.full((n, T + 1), -1, dtype=np.int32)
+        prev = np.arange(T, dtype=np.int64)[None, :]
+        step = max(1, max_cells // T)
+        for s in range(0, n, step):
+            e = min(n, s + step)
+            keys = np.broadcast_to(pack([prev if x == 'pp' else ctx[x][s:e, None] for x in slots]), (e - s, T))
+            rows[s:e, :T] = table.find(keys.ravel()).reshape(e - s, T)
+        return rows
+
+    def static_scores(self, weights: np.ndarray) -> np.ndarray:
+        """
+        :param weights: the weight of every template in the order of self.templates.
+        :return: the weighted sums of the templates without the previous POS in the shape of [n_tokens, len(tags)].
+        """
+        T = len(self.model.tags)
+        return np.bincount(self.cells, weights=self.probs * weights[self.template_ids], minlength=self.n_tokens * T).reshape(self.n_tokens, T)
+
+    def _weights(self, weights: Union[Dict[str, float], np.ndarray]) -> np.ndarray:
+        return np.array([weights[name] for name in self.templates]) if isinstance(weights, dict) else weights
+
+    def _add_dynamic(self, idx: np.ndarray, prev: np.ndarray, weights: np.ndarray, s: np.ndarray, t: np.ndarray):
+        # adds the weighted entries of the templates with the previous POS to the scores s of the tokens idx given their previous tags,
+        # and marks the scored tags in t
+        p = np.where(prev == UNKNOWN_ID, len(self.model.tags), prev)
+        for j, rows in self.dynamic:
+            table = self.model.tables[self.templates[j]]
+            if rows is None: r = table.find(pack([prev if x == 'pp' else self.ctx[x][idx] for x in self.model.slots[self.templates[j]]]))
+            else: r = rows[idx, p] if len(rows) > 1 else rows[0, p]
+            hit = np.nonzero(r >= 0)[0]
+            M = table.matrix
+            positions, lengths = M.positions(r[hit])
+            a, b = np.repeat(hit, lengths), M.indices[positions]
+            s[a, b] += M.data[positions] * weights[j]
+            t[a, b] = True
+
+    def decode(self, weights: Union[Dict[str, float], np.ndarray]) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Decodes all sentences greedily from left to right, one position of every sentence at a time.
+        :param weights: a dictionary of (template name, weight) or the weights in the order of self.templates.
+        :return: a pair of (the tag id of every token, its score); the tag id is UNKNOWN_ID for tokens without any scored tag.
+        """
+        weights = self._weights(weights)
+        T = len(self.model.tags)
+        scores, touched = self.static_scores(weights), self.touched.reshape(self.n_tokens, T)
+        pred, pred_scores = np.full(self.n_tokens, UNKNOWN_ID, dtype=np.int64), np.zeros(self.n_tokens)
+        prev = np.full(len(self.order), self.model.tags.get(DUMMY, UNKNOWN_ID), dtype=np.int64)
+        starts = self.offsets[self.order]
+
+        for i, c in enumerate(self.counts.tolist()):
+            idx = starts[:c] + i
+            s, t = scores[idx], touched[idx]
+            self._add_dynamic(idx, prev[:c], weights, s, t)
+            best = np.argmax(np.where(t, s, -np.inf), axis=1)
+            found = t.any(axis=1)
+            pred[idx] = prev[:c] = np.where(found, best, UNKNOWN_ID)
+            pred_scores[idx] = np.where(found, s[np.arange(c), best], 0.0)
+
+        return pred, pred_scores
+
+    @cached_property
+    def candidates(self) -> np.ndarray:
+        """
+        :return: a boolean matrix in the shape of [n_tokens, len(tags)] that allows only the tags of every known word in the 'cw' table,
+                 and all tags for the words not in the table (or for all words if the model has no 'cw' table).
+        """
+        T = len(self.model.tags)
+        table = self.model.tables.get('cw')
+        if table is None: return np.ones((self.n_tokens, T), dtype=bool)
+        rows = table.find(self.ctx['cw'])
+        found = np.nonzero(rows >= 0)[0]
+        allowed = np.zeros((self.n_tokens, T), dtype=bool)
+        allowed[rows < 0] = True
+        positions, lengths = table.matrix.positions(rows[found])
+        allowed[np.repeat(found, lengths), table.matrix.indices[positions]] = True
+        return allowed
+
+    def search(self, weights: Union[Dict[str, float], np.ndarray], width: Optional[int] = None, prune: bool = True, log: bool = True) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Finds the tag sequences with the highest path scores by beam search over all sentences at the same position.
+        Since the scores depend only on the previous tag, states ending in the same tag are recombined into the best one,
+        so width=None keeps the best state of every tag, which is exact Viterbi decoding.
+        :param weights: a dictionary of (template name, weight) or the weights in the order of self.templates.
+        :param width: the maximum number of states kept per sentence; None for Viterbi decoding.
+        :param prune: if True, the tags of every token are restricted to self.candidates.
+        :param log: if True, the path score is the sum of the logs of the token scores (their product); otherwise, the sum of the token scores.
+        :return: the same as decode, where the score of a token is its own score given the previous tag on the best path.
+        """
+        weights = self._weights(weights)
+        T = len(self.model.tags)
+        scores, touched = self.static_scores(weights), self.touched.reshape(self.n_tokens, T)
+        starts, lengths = self.offsets[self.order], self.lengths[self.order]
+
+        # the states of the active sentences, grouped by sentence in the sorted order: (sentence, tag, path score, history id)
+        sent = np.arange(len(self.order), dtype=np.int64)
+        tag = np.full(len(sent), self.model.tags.get(DUMMY, UNKNOWN_ID), dtype=np.int64)
+        score, hist = np.zeros(len(sent)), np.full(len(sent), -1, dtype=np.int64)
+        # every kept state is recorded with its tag, token score, and the history id of its previous state
+        h_tag, h_score, h_back, n_hist = [], [], [], 0
+        final = np.full(len(sent), -1, dtype=np.int64)
+
+        for i, c in enumerate(self.counts.tolist()):
+            keep = sent < c
+            sent, tag, score, hist = sent[keep], tag[keep], score[keep], hist[keep]
+            idx = starts[sent] + i
+            s, t = scores[idx], touched[idx]
+            self._add_dynamic(idx, tag, weights, s, t)
+            if prune: t &= self.candidates[idx]
+
+            # every (state, tag) pair with a score; a state without any scored tag moves on to the unknown tag with the score of 0
+            a, b = np.nonzero(t)
+            none = np.nonzero(~t.any(axis=1))[0]
+            prev_state = np.concatenate((a, none))
+            next_tag = np.concatenate((b, np.full(len(none), UNKNOWN_ID, dtype=np.int64)))
+            token_score = np.concatenate((s[a, b], np.zeros(len(none))))
+            total = score[prev_state] + (np.log(np.maximum(token_score, 1e-300)) if log else token_score)
+            next_sent = sent[prev_state]
+            col = np.minimum(next_tag, T)
+
+            # recombination: the best state per (sentence, tag), where ties go to the earlier state
+            order = np.lexsort((prev_state, -total, col, next_sent))
+            firsts = np.concatenate(([True], (next_sent[order][1:] != next_sent[order][:-1]) | (col[order][1:] != col[order][:-1])))
+            sel = order[firsts]
+
+            # beam: the best width states per sentence, where ties go to the smaller tag id
+            sel = sel[np.lexsort((col[sel], -total[sel], next_sent[sel]))]
+            if width is not None:
+                group = np.concatenate(([True], next_sent[sel][1:] != next_sent[sel][:-1]))
+                first = np.maximum.accumulate(np.where(group, np.arange(len(sel)), 0))
+                sel = sel[np.arange(len(sel)) - first < width]
+            group = np.concatenate(([True], next_sent[sel][1:] != next_sent[sel][:-1]))
+
+            h_tag.append(next_tag[sel])
+            h_score.append(token_score[sel])
+            h_back.append(hist[prev_state[sel]])
+            sent, tag, score = next_sent[sel], next_tag[sel], total[sel]
+            hist = np.arange(n_hist, n_hist + len(sel), dtype=np.int64)
+            n_hist += len(sel)
+
+            # the sentences ending at this position keep their best state, the first of their group
+            ends = group & (lengths[sent] == i + 1)
+            final[sent[ends]] = hist[ends]
+
+        pred, pred_scores = np.full(self.n_tokens, UNKNOWN_ID, dtype=np.int64), np.zeros(self.n_tokens)
+        if n_hist == 0: return pred, pred_scores
+        h_tag, h_score, h_back = np.concatenate(h_tag), np.concatenate(h_score), np.concatenate(h_back)
+
+        # follows the back pointers of all sentences together, from their last tokens
+        cur = final
+        for j, c in enumerate(self.counts.tolist()):
+            idx = starts[:c] + lengths[:c] - 1 - j
+            pred[idx], pred_scores[idx] = h_tag[cur[:c]], h_score[cur[:c]]
+            cur = h_back[cur[:c]]
+
+        return pred, pred_scores
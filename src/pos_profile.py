@@ -0,0 +1,161 @@
+# ========================================================================
+# Copyright 2022 Emory University
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ========================================================================
+import json
+import time
+from typing import List, Tuple, Dict, Any, Sequence
+
+import numpy as np
+
+from src.pos_models import DUMMY, UNKNOWN_ID, FeatureTable, TaggerModel, pack
+
+
+class _TimedTable:
+    # a feature table that counts its lookups and hits and the time spent in them into stats
+    def __init__(self, table: FeatureTable, stats: Dict[str, float]):
+        self.table = table
+        self.stats = stats
+
+    def __getattr__(self, name: str) -> Any:
+        return getattr(self.table, name)
+
+    def find(self, keys: np.ndarray) -> np.ndarray:
+        start = time.perf_counter()
+        rows = self.table.find(keys)
+        self.stats['seconds'] += time.perf_counter() - start
+        self.stats['lookups'] += len(keys)
+        self.stats['hits'] += int(np.count_nonzero(rows >= 0))
+        return rows
+
+    def get(self, key: int) -> Tuple[np.ndarray, np.ndarray]:
+        start = time.perf_counter()
+        tags, probs = self.table.get(key)
+        self.stats['seconds'] += time.perf_counter() - start
+        self.stats['lookups'] += 1
+        self.stats['hits'] += int(len(tags) > 0)
+        return tags, probs
+
+
+class TaggerProfiler:
+    """
+    Opt-in instrumentation of TaggerModel.predict: tags through the same model while recording, for every template,
+    the number of lookups, the hit rate, the time spent in the lookups, and how often the template changes the final argmax,
+    i.e., how many tokens would get another tag if only that template were left out, given the same previous tags.
+    The model itself is not changed, so predictions without the profiler pay nothing.
+    """
+    def __init__(self, model: TaggerModel):
+        self.model = model
+        self.stats = {name: {'lookups': 0, 'hits': 0, 'seconds': 0.0, 'changes': 0} for name in model.tables}
+        self.timed = TaggerModel(model.words, model.tags, {name: _TimedTable(table, self.stats[name]) for name, table in model.tables.items()}, model.weights)
+        self.n_tokens = 0
+        self.seconds = 0.0
+
+    def predict(self, tokens: Sequence[str]) -> List[Tuple[str, float]]:
+        """
+        :param tokens: a list of tokens.
+        :return: the same output as TaggerModel.predict.
+        """
+        start = time.perf_counter()
+        output = self.timed.predict(tokens)
+        self.seconds += time.perf_counter() - start
+        self.n_tokens += len(tokens)
+        if output: self._count_changes(tokens, [self.model.tags.get(pos, UNKNOWN_ID) if pos != 'XX' else UNKNOWN_ID for pos, _ in output])
+        return output
+
+    def predict_batch(self, sentences: Sequence[Sequence[str]], width: int = 1, prune: bool = False) -> List[List[Tuple[str, float]]]:
+        """
+        Profiles every sentence with predict; only greedy decoding is supported.
+        """
+        if width != 1 or prune: raise ValueError('Only greedy decoding can be profiled.')
+        return [self.predict(tokens) for tokens in sentences]
+
+    def _count_changes(self, tokens: Sequence[str], pred: List[int]):
+        # the contribution of every template is looked up again for all tokens at once with the predicted previous tags
+        model, n = self.model, len(tokens)
+        ctx = model.contexts(tokens)
+        pred = np.array(pred, dtype=np.int64)
+        ctx['pp'] = np.roll(pred, 1)
+        ctx['pp'][0] = model.tags.get(DUMMY, UNKNOWN_ID)
+
+        shape = (n, len(model.tags))
+        total, touched = np.zeros(shape), np.zeros(shape, dtype=np.int64)
+        contributions = dict()
+        for name, table in model.tables.items():
+            rows = table.find(pack([ctx[s] for s in model.slots[name]]))
+            found = np.nonzero(rows >= 0)[0]
+            positions, lengths = table.matrix.positions(rows[found])
+            i, t = np.repeat(found, lengths), table.matrix.indices[positions]
+            scores, mask = np.zeros(shape), np.zeros(shape, dtype=np.int64)
+            scores[i, t] = table.matrix.data[positions] * model.weights[name]
+            mask[i, t] = 1
+            total += scores
+            touched += mask
+            contributions[name] = (scores, mask)
+
+        for name, (scores, mask) in contributions.items():
+            others = touched - mask > 0
+            alt = np.argmax(np.where(others, total - scores, -np.inf), axis=1)
+            alt = np.where(others.any(axis=1), alt, UNKNOWN_ID)
+            self.stats[name]['changes'] += int(np.count_nonzero(alt != pred))
+
+    def summary(self) -> List[Dict[str, Any]]:
+        """
+        :return: one row per template with its lookups, hits, hit rate, lookup time, share of the tagging time,
+                 and the number and rate (per token) of the tokens whose argmax the template changes.
+        """
+        rows = []
+        for name, s in self.stats.items():
+            rows.append({'template': name, 'lookups': s['lookups'], 'hits': s['hits'], 'hit_rate': s['hits'] / max(s['lookups'], 1),
+                         'seconds': s['seconds'], 'time_share': s['seconds'] / max(self.seconds, 1e-12),
+                         'changes': s['changes'], 'change_rate': s['changes'] / max(self.n_tokens, 1)})
+        return rows
+
+    def to_json(self) -> str:
+        return json.dumps({'tokens': self.n_tokens, 'seconds': self.seconds, 'templates': self.summary()}, indent=2)
+
+    def table(self) -> str:
+        """
+        :return: the summary as a text table.
+        """
+        lines = ['{:<10}{:>10}{:>8}{:>10}{:>8}{:>10}{:>9}'.format('template', 'lookups', 'hit%', 'ms', 'time%', 'changes', 'change%')]
+        for r in self.summary():
+            lines.append('{:<10}{:>10,}{:>8.1f}{:>10.1f}{:>8.1f}{:>10,}{:>9.3f}'.format(
+                r['template'], r['lookups'], 100 * r['hit_rate'], 1000 * r['seconds'], 100 * r['time_share'], r['changes'], 100 * r['change_rate']))
+        lines.append('{:,} tokens in {:.3f} seconds'.format(self.n_tokens, self.seconds))
+        return '\n'.join(lines)
+
+
+if __name__ == '__main__':
+    import argparse
+    import os
+    from src.pos_store import load_model
+    from src.quiz.quiz3 import read_data, train
+
+    path = os.path.join(os.path.dirname(__file__), 'quiz', 'res', 'pos')
+    parser = argparse.ArgumentParser(description='Profiles the feature templates of the quiz3 tagger on the development set.')
+    parser.add_argument('--trn', default=os.path.join(path, 'wsj-pos.trn.gold.tsv'))
+    parser.add_argument('--dev', default=os.path.join(path, 'wsj-pos.dev.gold.tsv'))
+    parser.add_argument('--model', help='the model saved by pos_store.save_model; trained on --trn if not given')
+    parser.add_argument('--json', help='if set, the profile is also saved to this file')
+    args = parser.parse_args()
+
+    dev_data = read_data(args.dev)
+    model = load_model(args.model) if args.model else train(read_data(args.trn), dev_data)
+    profiler = TaggerProfiler(model)
+    for sentence in dev_data: profiler.predict([w for w, _ in sentence])
+
+    print(profiler.table())
+    if args.json:
+        with open(args.json, 'w') as fout: fout.write(profiler.to_json())
@@ -0,0 +1,133 @@
+# ========================================================================
+# Copyright 2022 Emory University
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ========================================================================
+import argparse
+import json
+import os
+from typing import List, Tuple, Dict, Any, Sequence, Callable
+
+from src.benchmark_tagging import accuracy
+from src.pos_models import FeatureCounts, TaggerModel
+
+# the settings tried for every template by select_pruning, from the mildest to the most aggressive
+LADDER = tuple({'min_divergence': v} for v in (0.5, 1.0, 2.0, 4.0, 8.0, 16.0))
+
+
+def prune(counts: FeatureCounts, weights: Dict[str, float], settings: Dict[str, Dict[str, Any]]) -> TaggerModel:
+    """
+    :param counts: the counts of the templates.
+    :param weights: a dictionary of (template name, weight).
+    :param settings: a dictionary of (template name, keyword arguments of FeatureCounts.table); the other templates are not pruned.
+    :return: the tagger over the pruned tables.
+    """
+    tables = {name: counts.table(name, **settings.get(name, {})) for name in counts.slots}
+    return TaggerModel(counts.words, counts.tags, tables, weights)
+
+
+def model_size(model: TaggerModel) -> Dict[str, int]:
+    """
+    :return: the number of contexts, the number of (context, tag) entries, and the bytes of the tables of the model.
+    """
+    return {'contexts': sum(len(t) for t in model.tables.values()), 'entries': sum(len(t.matrix.data) for t in model.tables.values()), 'bytes': model.nbytes}
+
+
+def select_pruning(counts: FeatureCounts, weights: Dict[str, float], data: Sequence[Sequence[Tuple[str, str]]], max_loss: float = 0.1,
+                   ladder: Sequence[Dict[str, Any]] = LADDER, callback: Callable[[str, Dict[str, Any], float], None] = None) -> Tuple[Dict[str, Dict[str, Any]], float]:
+    """
+    Accuracy-aware pruning: starting from the largest table, every template climbs the ladder while the accuracy on the data
+    stays within max_loss of the unpruned model, given the settings already chosen for the other templates.
+    :param counts: the counts of the templates.
+    :param weights: a dictionary of (template name, weight).
+    :param data: the development set, sentences of (word, pos) pairs.
+    :param max_loss: the largest drop of accuracy (in points) allowed.
+    :param ladder: the keyword arguments of FeatureCounts.table tried for every template in order.
+    :param callback: called with (template name, setting, accuracy) of every evaluated setting.
+    :return: a pair of (the settings of the pruned templates, the accuracy with all of them).
+    """
+    sentences = [[w for w, _ in sentence] for sentence in data]
+    tables = counts.tables()
+
+    def evaluate() -> float:
+        return accuracy(data, TaggerModel(counts.words, counts.tags, tables, weights).predict_batch(sentences))
+
+    baseline = best = evaluate()
+    settings = dict()
+    for name in sorted(tables, key=lambda n: -tables[n].nbytes):
+        for setting in ladder:
+            previous = tables[name]
+            tables[name] = counts.table(name, **setting)
+            acc = evaluate()
+            if callback: callback(name, setting, acc)
+            if baseline - acc > max_loss:
+                tables[name] = previous
+                break
+            settings[name], best = setting, acc
+    return settings, best
+
+
+def pruning_report(counts: FeatureCounts, weights: Dict[str, float], data: Sequence[Sequence[Tuple[str, str]]],
+                   settings: Sequence[Tuple[str, Dict[str, Dict[str, Any]]]]) -> List[Dict[str, Any]]:
+    """
+    Measures the size and the accuracy of the model under every setting.
+    :param settings: a list of (label, settings of prune); the unpruned model is always measured first as the baseline.
+    :return: one row per setting with its size (see model_size), accuracy, and loss of accuracy against the baseline.
+    """
+    sentences = [[w for w, _ in sentence] for sentence in data]
+    results = []
+    for label, setting in [('none', {})] + list(settings):
+        model = prune(counts, weights, setting)
+        acc = accuracy(data, model.predict_batch(sentences))
+        results.append(dict(setting=label, **model_size(model), accuracy=acc, loss=results[0]['accuracy'] - acc if results else 0.0))
+    return results
+
+
+if __name__ == '__main__':
+    from src.pos_models import TEMPLATES, read_sentences
+    from src.pos_store import save_model
+    from src.quiz.quiz3 import read_data, train
+
+    path = os.path.join(os.path.dirname(__file__), 'quiz', 'res', 'pos')
+    parser = argparse.ArgumentParser(description='Reports the size of the pruned quiz3 tagger against its accuracy on the development set.')
+    parser.add_argument('--trn', default=os.path.join(path, 'wsj-pos.trn.gold.tsv'))
+    parser.add_argument('--dev', default=os.path.join(path, 'wsj-pos.dev.gold.tsv'))
+    parser.add_argument('--max-loss', type=float, default=0.1, help='the accuracy (in points) the selected pruning may lose')
+    parser.add_argument('--json', help='if set, the report is also saved to this file')
+    parser.add_argument('--save', help='if set, the model with the selected pruning is saved to this file (see pos_store)')
+    args = parser.parse_args()
+
+    dev_data = read_data(args.dev)
+    counts = FeatureCounts(TEMPLATES).update_all(read_sentences(args.trn))
+    weights = train(None, dev_data, counts=counts).weights
+    trigrams = ('pw_cw_nw', 'pp_cw_nw')
+
+    settings = [('min_count=2 (trigrams)', {name: {'min_count': 2} for name in trigrams}),
+                ('min_count=2', {name: {'min_count': 2} for name in TEMPLATES}),
+                ('top_k=1', {name: {'top_k': 1} for name in TEMPLATES}),
+                ('top_k=3', {name: {'top_k': 3} for name in TEMPLATES}),
+                ('divergence>=1', {name: {'min_divergence': 1.0} for name in TEMPLATES}),
+                ('divergence>=4', {name: {'min_divergence': 4.0} for name in TEMPLATES})]
+    selected, _ = select_pruning(counts, weights, dev_data, args.max_loss)
+    settings.append(('selected (loss<={})'.format(args.max_loss), selected))
+    results = pruning_report(counts, weights, dev_data, settings)
+
+    print('{:<28}{:>10}{:>10}{:>10}{:>10}{:>8}'.format('setting', 'contexts', 'entries', 'MB', 'acc', 'loss'))
+    for r in results:
+        print('{:<28}{:>10,}{:>10,}{:>10.2f}{:>10.3f}{:>8.3f}'.format(r['setting'], r['contexts'], r['entries'], r['bytes'] / 1e6, r['accuracy'], r['loss']))
+    print('selected: {}'.format(selected))
+    if args.json: json.dump({'results': results, 'selected': selected}, open(args.json, 'w'), indent=2)
+
+    if args.save:
+        save_model(prune(counts, weights, selected), args.save)
+        print('saved: {} ({:,} bytes)'.format(args.save, os.path.getsize(args.save)))
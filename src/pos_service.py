@@ -0,0 +1,334 @@
+# ========================================================================
+# Copyright 2022 Emory University
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ========================================================================
+import asyncio
+import collections
+import json
+import multiprocessing
+import time
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from typing import List, Tuple, Dict, Any, Optional, Set, Union
+
+import numpy as np
+
+from src.pos_cache import CachedTagger
+from src.pos_models import TaggerModel
+from src.pos_store import load_model
+
+# the tagger of a worker, loaded once per process; the pages of the model file are shared by all workers (see pos_store)
+_tagger: Optional[Union[TaggerModel, CachedTagger]] = None
+
+
+def _init_worker(model_path: str, cache: bool):
+    global _tagger
+    model = load_model(model_path)
+    _tagger = CachedTagger(model) if cache else model
+
+
+def _tag_batch(sentences: List[List[str]]) -> List[List[Tuple[str, float]]]:
+    return _tagger.predict_batch(sentences)
+
+
+class ServiceStats:
+    """
+    Counters of the service: requests, sentences, tokens, and batches since the start, and the latencies of the most recent requests.
+    """
+    def __init__(self, window: int = 10000):
+        """
+        :param window: the number of recent latencies kept for the percentiles.
+        """
+        self.start = time.perf_counter()
+        self.latencies = collections.deque(maxlen=window)
+        self.requests = 0
+        self.errors = 0
+        self.sentences = 0
+        self.tokens = 0
+        self.batches = 0
+        self.batched_sentences = 0
+
+    def record(self, seconds: float, sentences: List[List[str]]):
+        self.latencies.append(seconds)
+        self.requests += 1
+        self.sentences += len(sentences)
+        self.tokens += sum(len(s) for s in sentences)
+
+    def summary(self) -> Dict[str, Any]:
+        elapsed = time.perf_counter() - self.start
+        p50, p90, p99 = np.percentile(self.latencies, [50, 90, 99]).tolist() if self.latencies else (0.0, 0.0, 0.0)
+        return {'uptime': elapsed, 'requests': self.requests, 'errors': self.errors, 'sentences': self.sentences, 'tokens': self.tokens,
+                'batches': self.batches, 'mean_batch_size': self.batched_sentences / max(self.batches, 1),
+                'requests/s': self.requests / elapsed, 'tokens/s': self.tokens / elapsed,
+                'latency_ms': {'p50': 1000 * p50, 'p90': 1000 * p90, 'p99': 1000 * p99}}
+
+
+class TaggingService:
+    """
+    Tags the sentences of concurrent requests in micro-batches: requests wait in a queue until max_batch_size sentences
+    are gathered or the first of them has waited max_wait seconds, and every batch is tagged by a worker of the pool.
+    The service speaks both HTTP and JSON Lines on the same port (see handle).
+    """
+    def __init__(self, model_path: str, workers: int = 1, max_batch_size: int = 64, max_wait: float = 0.005, cache: bool = False, max_body: int = 1 << 20):
+        """
+        :param model_path: the path to the model saved by pos_store.save_model.
+        :param workers: the number of worker processes; 0 tags in a thread of this process.
+        :param max_batch_size: the maximum number of sentences per batch; a larger request makes a batch by itself.
+        :param max_wait: the maximum seconds a request waits for others to join its batch.
+        :param cache: if True, every worker tags through a CachedTagger.
+        :param max_body: the maximum bytes of an HTTP request body or a JSON line.
+        """
+        self.model_path = model_path
+        self.workers = workers
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.cache = cache
+        self.max_body = max_body
+        self.stats = ServiceStats()
+        self.queue: Optional[asyncio.Queue] = None
+        self.executor: Optional[Executor] = None
+        self._batcher: Optional[asyncio.Task] = None
+        self._slots: Optional[asyncio.Semaphore] = None
+        # the requests taken from the queue by the batcher but not yet handed to a worker
+        self._gathered: List[Tuple[List[List[str]], asyncio.Future]] = []
+        self._carry: Optional[Tuple[List[List[str]], asyncio.Future]] = None
+        # the batches handed to the workers and not yet answered
+        self._running: Set[asyncio.Task] = set()
+
+    async def start(self):
+        if self.workers > 0:
+            # the workers are spawned, not forked, so that they do not inherit the sockets of the connections open at the time
+            context = multiprocessing.get_context('spawn')
+            self.executor = ProcessPoolExecutor(self.workers, context, initializer=_init_worker, initargs=(self.model_path, self.cache))
+        else:
+            _init_worker(self.model_path, self.cache)
+            self.executor = ThreadPoolExecutor(1)
+        self.queue = asyncio.Queue()
+        # one batch in flight per worker, so that the batches keep growing while the workers are busy
+        self._slots = asyncio.Semaphore(max(self.workers, 1))
+        self._batcher = asyncio.create_task(self._batch_loop())
+
+    async def close(self):
+        """
+        Stops batching, fails the requests that have not reached a worker, and waits for the batches in flight.
+        """
+        if self._batcher:
+            self._batcher.cancel()
+            await asyncio.gather(self._batcher, return_exceptions=True)
+        if self.queue:
+            pending = self._gathered + ([self._carry] if self._carry else [])
+            while not self.queue.empty(): pending.append(self.queue.get_nowait())
+            for _, future in pending:
+                if not future.done(): future.set_exception(RuntimeError('The service is closed.'))
+            self._gathered, self._carry = [], None
+        await asyncio.gather(*self._running, return_exceptions=True)
+        # the workers are idle by now, but joining them still blocks, so it runs off the event loop
+        if self.executor: await asyncio.get_running_loop().run_in_executor(None, self.executor.shutdown)
+
+    async def tag(self, sentences: List[List[str]]) -> List[List[Tuple[str, float]]]:
+        """
+        :param sentences: lists of tokens.
+        :return: the (POS, score) pairs of every sentence, tagged with the sentences of other requests in the same batch.
+        """
+        start = time.perf_counter()
+        future = asyncio.get_running_loop().create_future()
+        self.queue.put_nowait((sentences, future))
+        outputs = await future
+        self.stats.record(time.perf_counter() - start, sentences)
+        return outputs
+
+    async def _batch_loop(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            # the request that did not fit into the previous batch starts the next one
+            if self._carry: items, self._carry = [self._carry], None
+            else: items = [await self.queue.get()]
+            self._gathered = items
+            size, deadline = len(items[0][0]), loop.time() + self.max_wait
+            while size < self.max_batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0: break
+                try:
+                    item = await asyncio.wait_for(self.queue.get(), timeout)
+                except asyncio.TimeoutError:
+                    break
+                if size + len(item[0]) > self.max_batch_size:
+                    self._carry = item
+                    break
+                items.append(item)
+                size += len(item[0])
+            await self._slots.acquire()
+            self._gathered = []
+            task = asyncio.create_task(self._run_batch(items))
+            self._running.add(task)
+            task.add_done_callback(self._running.discard)
+
+    async def _run_batch(self, items: List[Tuple[List[List[str]], asyncio.Future]]):
+        try:
+            sentences = [s for ss, _ in items for s in ss]
+            self.stats.batches += 1
+            self.stats.batched_sentences += len(sentences)
+            outputs = await asyncio.get_running_loop().run_in_executor(self.executor, _tag_batch, sentences)
+            offset = 0
+            for ss, future in items:
+                if not future.done(): future.set_result(outputs[offset:offset + len(ss)])
+                offset += len(ss)
+        except Exception as e:
+            for _, future in items:
+                if not future.done(): future.set_exception(e)
+        finally:
+            self._slots.release()
+
+    async def _respond(self, request: Any) -> Dict[str, Any]:
+        # {"tokens": [...]} for one sentence or {"sentences": [[...], ...]} for many; "id" is echoed back
+        if not isinstance(request, dict): raise ValueError('The request must be a JSON object.')
+        if 'tokens' in request:
+            outputs = await self.tag([_tokens(request['tokens'])])
+            response = {'tags': outputs[0]}
+        elif 'sentences' in request:
+            sentences = request['sentences']
+            if not isinstance(sentences, list): raise ValueError('"sentences" must be a list of token lists.')
+            response = {'sentences': await self.tag([_tokens(s) for s in sentences])}
+        else:
+            raise ValueError('The request must have "tokens" or "sentences".')
+        if 'id' in request: response['id'] = request['id']
+        return response
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        """
+        Serves one connection, which is HTTP if it starts with a GET or POST request line and JSON Lines otherwise.
+        A line longer than max_body or a malformed HTTP request closes the connection.
+        """
+        try:
+            line = await reader.readline()
+            if line.split(b' ', 1)[0] in (b'GET', b'POST'):
+                await self._http(line, reader, writer)
+            else:
+                await self._json_lines(line, reader, writer)
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    async def _http(self, line: bytes, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        # POST /tag with a JSON request body and GET /stats; connections are kept alive unless the client closes them
+        while line:
+            method, target, version = line.decode('latin-1').split()
+            headers = dict()
+            while True:
+                h = await reader.readline()
+                if h in (b'\r\n', b'\n', b''): break
+                name, _, value = h.decode('latin-1').partition(':')
+                headers[name.strip().lower()] = value.strip()
+
+            length = int(headers.get('content-length', 0))
+            if length > self.max_body:
+                _write_http(writer, 413, {'error': 'The request body is larger than {} bytes.'.format(self.max_body)}, False)
+                return
+            body = await reader.readexactly(length)
+
+            if method == 'GET' and target == '/stats':
+                status, payload = 200, self.stats.summary()
+            elif method == 'POST' and target == '/tag':
+                try:
+                    status, payload = 200, await self._respond(json.loads(body))
+                except ValueError as e:
+                    self.stats.errors += 1
+                    status, payload = 400, {'error': str(e)}
+                except Exception as e:
+                    # e.g., a broken worker pool; the client still gets an answer
+                    self.stats.errors += 1
+                    status, payload = 500, {'error': _describe(e)}
+            else:
+                status, payload = 404, {'error': 'Not found: {} {}'.format(method, target)}
+
+            keep_alive = version == 'HTTP/1.1' and headers.get('connection', '').lower() != 'close'
+            _write_http(writer, status, payload, keep_alive)
+            await writer.drain()
+            if not keep_alive: return
+            line = await reader.readline()
+
+    async def _json_lines(self, line: bytes, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        # every line is a request answered by one line as soon as its batch is tagged, so the responses may come out of order
+        async def answer(line: bytes):
+            try:
+                response = await self._respond(json.loads(line))
+            except ValueError as e:
+                self.stats.errors += 1
+                response = {'error': str(e)}
+            except Exception as e:
+                self.stats.errors += 1
+                response = {'error': _describe(e)}
+            writer.write(json.dumps(response).encode('utf-8') + b'\n')
+            await writer.drain()
+
+        # only the requests still being answered are kept, however long the connection stays open
+        tasks = set()
+        while line:
+            if line.strip():
+                task = asyncio.create_task(answer(line))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+            line = await reader.readline()
+        await asyncio.gather(*tasks)
+
+
+def _tokens(tokens: Any) -> List[str]:
+    if not isinstance(tokens, list) or not all(isinstance(t, str) for t in tokens): raise ValueError('A sentence must be a list of strings.')
+    return tokens
+
+
+def _describe(e: Exception) -> str:
+    return '{}: {}'.format(type(e).__name__, e) if str(e) else type(e).__name__
+
+
+def _write_http(writer: asyncio.StreamWriter, status: int, payload: Dict[str, Any], keep_alive: bool):
+    reasons = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 413: 'Payload Too Large', 500: 'Internal Server Error'}
+    body = json.dumps(payload).encode('utf-8')
+    head = 'HTTP/1.1 {} {}\r\nContent-Type: application/json\r\nContent-Length: {}\r\nConnection: {}\r\n\r\n'.format(
+        status, reasons[status], len(body), 'keep-alive' if keep_alive else 'close')
+    writer.write(head.encode('latin-1') + body)
+
+
+async def serve(service: TaggingService, host: str = '127.0.0.1', port: int = 8329):
+    """
+    Starts the service and serves connections until cancelled.
+    """
+    await service.start()
+    server = await asyncio.start_server(service.handle, host, port, limit=service.max_body + 1)
+    try:
+        async with server:
+            print('Serving {} on {}:{}'.format(service.model_path, host, port))
+            await server.serve_forever()
+    finally:
+        await service.close()
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='HTTP/JSON Lines tagging service over a model saved by pos_store.save_model.')
+    parser.add_argument('--model', required=True, help='the path to the model file, e.g., quiz3.bin')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8329)
+    parser.add_argument('--workers', type=int, default=1, help='number of worker processes; 0 tags in a thread of the server')
+    parser.add_argument('--max-batch-size', type=int, default=64, help='the maximum number of sentences per batch')
+    parser.add_argument('--max-wait-ms', type=float, default=5.0, help='the maximum milliseconds a request waits for a batch')
+    parser.add_argument('--cache', action='store_true', help='tag through an LRU cache of sentences and positions')
+    args = parser.parse_args()
+
+    service = TaggingService(args.model, args.workers, args.max_batch_size, args.max_wait_ms / 1000, args.cache)
+    try:
+        asyncio.run(serve(service, args.host, args.port))
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,167 @@
+# ========================================================================
+# Copyright 2022 Emory University
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ========================================================================
+import hashlib
+import json
+import mmap
+import struct
+from typing import List, Tuple, Sequence
+
+import numpy as np
+
+from src.pos_models import FeatureTable, TaggerModel
+from src.vector_space_models import Vocabulary, CSRMatrix
+from src.vector_store import StringTable, FrozenVocabulary, _align
+
+# File layout (little-endian), the same as the vector store:
+#   magic (8 bytes) | version (uint32) | header size (uint32) | JSON header | arrays, each aligned to ALIGN bytes
+# The header holds the templates in order with their weights and the (offset, dtype, count) of every array relative to the first array.
+MAGIC = b'POSMODEL'
+VERSION = 1
+
+
+def _hash(b: bytes) -> int:
+    # a 64-bit hash that is stable across processes, unlike hash()
+    return int.from_bytes(hashlib.blake2b(b, digest_size=8).digest(), 'little')
+
+
+class HashedVocabulary(FrozenVocabulary):
+    """
+    Read-only vocabulary whose lookups search a sorted array of 64-bit hashes of the terms instead of comparing the strings by bisection;
+    only the bytes of the terms with the same hash are compared.
+    """
+    def __init__(self, table: StringTable, hashes: np.ndarray, ids: np.ndarray):
+        """
+        :param hashes: the hashes of the terms in ascending order.
+        :param ids: the term id of every hash.
+        """
+        super().__init__(table)
+        self.hashes = hashes
+        self.hash_ids = ids
+
+    def get(self, term: str, default: int = -1) -> int:
+        b = term.encode('utf-8')
+        h = _hash(b)
+        i = int(np.searchsorted(self.hashes, h))
+        while i < len(self.hashes) and self.hashes[i] == h:
+            tid = int(self.hash_ids[i])
+            if self.terms._bytes(tid) == b: return tid
+            i += 1
+        return default
+
+    def get_all(self, terms: Sequence[str], default: int = -1) -> np.ndarray:
+        """
+        :return: the ids of all terms looked up together; default for the terms not in the vocabulary.
+        """
+        encoded = [t.encode('utf-8') for t in terms]
+        if not encoded or len(self.hashes) == 0: return np.full(len(encoded), default, dtype=np.int64)
+        h = np.array([_hash(b) for b in encoded], dtype=np.uint64)
+        i = np.minimum(np.searchsorted(self.hashes, h), len(self.hashes) - 1)
+        ids = np.where(self.hashes[i] == h, self.hash_ids[i], -1)
+
+        # the bytes of every hit are compared with the term so that a hash collision never returns a wrong id
+        hit = np.nonzero(ids >= 0)[0]
+        lengths = np.array([len(b) for b in encoded], dtype=np.int64)
+        starts, ends = self.terms.offsets[ids[hit]], self.terms.offsets[ids[hit] + 1]
+        same = ends - starts == lengths[hit]
+        n = lengths[hit[same]]
+        query = np.frombuffer(b''.join(encoded[j] for j in hit[same]), dtype=np.uint8)
+        offsets = np.cumsum(n) - n
+        segments = np.repeat(np.arange(len(n)), n)
+        mismatches = self.terms.data[starts[same][segments] + np.arange(len(query)) - offsets[segments]] != query
+        same[same] = np.bincount(segments, weights=mismatches, minlength=len(n)) == 0
+        ids[hit[~same]] = [self.get(encoded[j].decode('utf-8')) for j in hit[~same]]
+        return np.where(ids >= 0, ids, default)
+
+    def add(self, term: str) -> int:
+        tid = self.get(term)
+        if tid < 0: raise KeyError('Cannot add a term to a read-only vocabulary: {}'.format(term))
+        return tid
+
+    @staticmethod
+    def arrays(strings: List[str]) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        :return: the (hashes, ids) arrays of the strings.
+        """
+        hashes = np.array([_hash(s.encode('utf-8')) for s in strings], dtype=np.uint64)
+        order = np.argsort(hashes, kind='stable')
+        return hashes[order].astype('<u8'), order.astype('<i8')
+
+
+def save_model(model: TaggerModel, filename: str):
+    """
+    Saves the tagger in the binary format that load_model memory-maps.
+    :param model: the tagger, e.g., the output of quiz3.train.
+    :param filename: the path to the output file.
+    """
+    words = list(model.words.terms)
+    header = {'templates': list(model.tables), 'weights': model.weights, 'tags': list(model.tags.terms)}
+    arrays: List[Tuple[str, np.ndarray]] = []
+
+    for name, a in zip(('data', 'offsets', 'order'), StringTable.arrays(words)):
+        arrays.append(('words_{}'.format(name), a))
+    for name, a in zip(('hashes', 'ids'), HashedVocabulary.arrays(words)):
+        arrays.append(('words_{}'.format(name), a))
+
+    for name, table in model.tables.items():
+        M = table.matrix
+        arrays += [(name + '_keys', table.keys.astype('<i8')), (name + '_indptr', M.indptr.astype('<i8')),
+                   (name + '_indices', M.indices.astype('<i4')), (name + '_data', M.data.astype('<f8'))]
+
+    offset, specs = 0, dict()
+    for name, a in arrays:
+        specs[name] = [offset, a.dtype.str, len(a)]
+        offset = _align(offset + a.nbytes)
+    header['arrays'] = specs
+
+    h = json.dumps(header).encode('utf-8')
+    start = _align(len(MAGIC) + 8 + len(h))
+    with open(filename, 'wb') as fout:
+        fout.write(MAGIC + struct.pack('<II', VERSION, len(h)) + h)
+        for name, a in arrays:
+            fout.write(b'\0' * (start + specs[name][0] - fout.tell()))
+            fout.write(a.tobytes())
+
+
+def load_model(filename: str) -> TaggerModel:
+    """
+    Memory-maps the tagger saved by save_model without copying its tables; processes loading the same file share its pages.
+    :param filename: the path to the file.
+    :return: the tagger whose word vocabulary cannot be extended.
+    """
+    with open(filename, 'rb') as fin:
+        mm = mmap.mmap(fin.fileno(), 0, access=mmap.ACCESS_READ)
+
+    if mm[:len(MAGIC)] != MAGIC: raise ValueError('Not a POS model: {}'.format(filename))
+    version, size = struct.unpack_from('<II', mm, len(MAGIC))
+    if version != VERSION: raise ValueError('Unsupported POS model version {}: {}'.format(version, filename))
+    header = json.loads(mm[len(MAGIC) + 8:len(MAGIC) + 8 + size].decode('utf-8'))
+    start = _align(len(MAGIC) + 8 + size)
+
+    def array(name: str) -> np.ndarray:
+        offset, dtype, count = header['arrays'][name]
+        return np.frombuffer(mm, dtype=dtype, count=count, offset=start + offset)
+
+    words = HashedVocabulary(StringTable(array('words_data'), array('words_offsets'), array('words_order')), array('words_hashes'), array('words_ids'))
+    # the tag set is tiny, so it is kept as a regular vocabulary
+    tags = Vocabulary()
+    for tag in header['tags']: tags.add(tag)
+
+    tables = dict()
+    for name in header['templates']:
+        matrix = CSRMatrix(array(name + '_indptr'), array(name + '_indices'), array(name + '_data'), len(tags))
+        tables[name] = FeatureTable(array(name + '_keys'), matrix)
+
+    return TaggerModel(words, tags, tables, header['weights'])
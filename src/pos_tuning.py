@@ -0,0 +1,224 @@
+# ========================================================================
+# Copyright 2022 Emory University
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ========================================================================
+import json
+import multiprocessing
+import os
+from typing import List, Tuple, Dict, Sequence, Callable, Optional
+
+import numpy as np
+
+from src.pos_models import UNKNOWN_ID, TaggerModel, TokenFeatures, batches
+
+
+class WeightTuner:
+    """
+    Evaluates template weights on a development set without repeating any lookup: the features of every token are
+    looked up once (see TokenFeatures), so each candidate costs one bincount plus a greedy sweep over the positions.
+    """
+    def __init__(self, model: TaggerModel, data: Sequence[Sequence[Tuple[str, str]]], max_cells: int = 1 << 22):
+        """
+        :param model: the model whose weights are tuned; its tables are kept as they are.
+        :param data: the development set, sentences where every token is a (word, pos) pair; read once.
+        :param max_cells: see TokenFeatures.
+        """
+        self.model = model
+        sentences, gold = [], []
+        for sentence in data:
+            sentences.append([w for w, _ in sentence])
+            gold.extend(model.tags.get(p, UNKNOWN_ID) for _, p in sentence)
+        self.features = TokenFeatures(model, sentences, max_cells=max_cells)
+        self.gold = np.array(gold, dtype=np.int64)
+        self.templates = self.features.templates
+        self.n_evaluations = 0
+
+    def accuracy(self, weights: Dict[str, float]) -> float:
+        """
+        :return: the accuracy (%) of greedy decoding with the weights, the same as quiz3.evaluate.
+        """
+        self.n_evaluations += 1
+        pred, _ = self.features.decode(weights)
+        return 100.0 * int(np.count_nonzero((pred == self.gold) & (pred != UNKNOWN_ID))) / max(len(self.gold), 1)
+
+    def coordinate_ascent(self, weights: Dict[str, float], grid: Sequence[float], rounds: int = 3,
+                          callback: Callable[[float, Dict[str, float]], None] = None) -> Tuple[float, Dict[str, float]]:
+        """
+        Tunes one weight at a time over the grid while the others are fixed, until a round makes no improvement.
+        :param weights: the initial weights.
+        :param grid: the candidate values of every weight.
+        :param rounds: the maximum number of passes over all weights.
+        :param callback: called with (accuracy, weights) of every evaluated candidate.
+        :return: a pair of (the best accuracy, the best weights).
+        """
+        best = dict(weights)
+        best_acc = self.accuracy(best)
+        if callback: callback(best_acc, best)
+
+        for _ in range(rounds):
+            improved = False
+            for name in self.templates:
+                for value in grid:
+                    if value == best[name]: continue
+                    candidate = dict(best, **{name: value})
+                    acc = self.accuracy(candidate)
+                    if callback: callback(acc, candidate)
+                    if acc > best_acc: best_acc, best, improved = acc, candidate, True
+            if not improved: break
+
+        return best_acc, best
+
+    def random_search(self, n_trials: int, low: float = 0.0, high: float = 2.0, weights: Dict[str, float] = None, scale: float = 0.0,
+                      seed: int = 0, callback: Callable[[float, Dict[str, float]], None] = None) -> Tuple[float, Dict[str, float]]:
+        """
+        Samples the weights uniformly from [low, high], or around the best weights so far if scale > 0.
+        :param n_trials: the number of sampled candidates.
+        :param weights: the initial weights; the search starts from scratch if not given.
+        :param scale: if positive, every candidate is the best weights so far plus Gaussian noise of this standard deviation, clipped to [low, high].
+        :param seed: the random seed.
+        :param callback: called with (accuracy, weights) of every evaluated candidate.
+        :return: a pair of (the best accuracy, the best weights).
+        """
+        rng = np.random.default_rng(seed)
+        best_acc, best = (self.accuracy(weights), dict(weights)) if weights else (-1.0, None)
+
+        for _ in range(n_trials):
+            if scale > 0 and best:
+                values = np.clip(np.array([best[name] for name in self.templates]) + rng.normal(0, scale, len(self.templates)), low, high)
+            else:
+                values = rng.uniform(low, high, len(self.templates))
+            candidate = dict(zip(self.templates, values.tolist()))
+            acc = self.accuracy(candidate)
+            if callback: callback(acc, candidate)
+            if acc > best_acc: best_acc, best = acc, candidate
+
+        return best_acc, best
+
+
+# the tuner of a worker process, inherited without copying under fork or unpickled once per worker otherwise
+_tuner: Optional[WeightTuner] = None
+
+
+def _init_worker(tuner: WeightTuner):
+    global _tuner
+    _tuner = tuner
+
+
+def _evaluate_block(task: Tuple[List[int], List[str], List[Sequence[float]], Dict[str, float]]) -> List[Tuple[int, float]]:
+    ids, names, grids, base = task
+    return [(i, _tuner.accuracy(_grid_weights(i, names, grids, base))) for i in ids]
+
+
+def _grid_weights(i: int, names: List[str], grids: List[Sequence[float]], base: Dict[str, float]) -> Dict[str, float]:
+    # the i'th combination of the grid in row-major order, where the last template changes the fastest
+    index = np.unravel_index(i, [len(g) for g in grids])
+    return dict(base, **{name: float(g[j]) for name, g, j in zip(names, grids, index)})
+
+
+def _read_checkpoint(checkpoint: str, grids: Dict[str, List[float]]) -> Dict[int, float]:
+    # the first line holds the grids the indices refer to; a line cut off by preemption is ignored and evaluated again
+    done = dict()
+    if not checkpoint or not os.path.exists(checkpoint) or os.path.getsize(checkpoint) == 0: return done
+
+    with open(checkpoint) as fin:
+        header = json.loads(fin.readline())
+        if header.get('grids') != grids: raise ValueError('The checkpoint was made for different grids: {}'.format(checkpoint))
+        for line in fin:
+            try:
+                r = json.loads(line)
+                done[r['i']] = r['accuracy']
+            except (ValueError, KeyError):
+                continue
+    return done
+
+
+def grid_search(tuner: WeightTuner, grids: Dict[str, Sequence[float]], processes: Optional[int] = None, checkpoint: str = None,
+                block_size: int = 16, callback: Callable[[float, Dict[str, float]], None] = None, max_pending: int = 256) -> Tuple[float, Dict[str, float]]:
+    """
+    Evaluates every combination of the grids across a process pool and keeps the best weights as the results stream back.
+    The tuner (the model and the looked-up features) is passed to every worker once, not per task.
+    :param tuner: the tuner over the development set.
+    :param grids: a dictionary of (template name, candidate weights); the other templates keep the weights of the model.
+    :param processes: the number of worker processes; all CPUs if None, and no pool if 1.
+    :param checkpoint: if given, the accuracy of every evaluated combination is appended to this JSON Lines file,
+                       and the combinations already in it are skipped, so that a killed search resumes where it stopped.
+    :param block_size: the number of combinations evaluated by each task.
+    :param callback: called with (accuracy, weights) of every combination evaluated by this call.
+    :param max_pending: the maximum number of tasks handed to the pool at a time.
+    :return: a pair of (the best accuracy, the best weights); ties go to the combination that comes first in the grid.
+    """
+    names, values = list(grids), [list(grids[name]) for name in grids]
+    base = {name: tuner.model.weights[name] for name in tuner.templates}
+    total = int(np.prod([len(v) for v in values]))
+    done = _read_checkpoint(checkpoint, dict(zip(names, values)))
+    best_acc, best_i = -1.0, -1
+
+    for i, acc in done.items():
+        if (acc, -i) > (best_acc, -best_i): best_acc, best_i = acc, i
+
+    # the combinations not in the checkpoint are generated lazily in blocks, since the grid may be too large to list
+    tasks = ((block, names, values, base) for block in batches((i for i in range(total) if i not in done), block_size))
+    fout = None
+    if checkpoint:
+        fout = open(checkpoint, 'a')
+        if fout.tell() == 0:
+            fout.write(json.dumps({'grids': dict(zip(names, values))}) + '\n')
+        else:
+            with open(checkpoint, 'rb') as fin:
+                fin.seek(-1, os.SEEK_END)
+                if fin.read(1) != b'\n': fout.write('\n')
+
+    def collect(results: List[Tuple[int, float]]):
+        nonlocal best_acc, best_i
+        for i, acc in results:
+            if fout: fout.write(json.dumps({'i': i, 'accuracy': acc}) + '\n')
+            if callback: callback(acc, _grid_weights(i, names, values, base))
+            if (acc, -i) > (best_acc, -best_i): best_acc, best_i = acc, i
+        if fout: fout.flush()
+
+    try:
+        if processes == 1:
+            _init_worker(tuner)
+            for task in tasks: collect(_evaluate_block(task))
+        else:
+            with multiprocessing.Pool(processes, initializer=_init_worker, initargs=(tuner,)) as pool:
+                # the pool drains its input eagerly, so the tasks are handed over a window at a time to bound the pending ones
+                for window in batches(tasks, max_pending):
+                    for results in pool.imap_unordered(_evaluate_block, window): collect(results)
+    finally:
+        if fout: fout.close()
+
+    return best_acc, _grid_weights(best_i, names, values, base) if best_i >= 0 else dict(base)
+
+
+if __name__ == '__main__':
+    import argparse
+    from src.pos_models import TEMPLATES
+    from src.quiz.quiz3 import read_data, train
+
+    path = os.path.join(os.path.dirname(__file__), 'quiz', 'res', 'pos')
+    parser = argparse.ArgumentParser(description='Grid search over the template weights of the quiz3 tagger.')
+    parser.add_argument('--trn', default=os.path.join(path, 'wsj-pos.trn.gold.tsv'))
+    parser.add_argument('--dev', default=os.path.join(path, 'wsj-pos.dev.gold.tsv'))
+    parser.add_argument('--templates', nargs='+', default=list(TEMPLATES), choices=TEMPLATES, help='templates whose weights are searched')
+    parser.add_argument('--grid', type=float, nargs='+', default=[0.1, 0.5, 1.0], help='candidate weights of every template')
+    parser.add_argument('--processes', type=int, default=None, help='number of worker processes; all CPUs if not given')
+    parser.add_argument('--checkpoint', help='JSON Lines file to save the results to and resume from')
+    args = parser.parse_args()
+
+    dev_data = read_data(args.dev)
+    tuner = WeightTuner(train(read_data(args.trn), dev_data), dev_data)
+    best_acc, best = grid_search(tuner, {name: args.grid for name in args.templates}, args.processes, args.checkpoint,
+                                 callback=lambda acc, w: print('{:5.4f}% - {}'.format(acc, w)))
+    print('best: {:5.4f}% - {}'.format(best_acc, best))
@@ -14,29 +14,19 @@
 # limitations under the License.
 # ========================================================================
 import os.path
-from collections import Counter
-from typing import List, Tuple, Dict, Any
+from typing import List, Tuple, Dict, Any, Optional
 
 #import nltk
 
+from src.pos_models import FeatureCounts, TaggerModel, read_sentences
 from src.vector_space_models import download
 
 PREV_DUMMY = '!@#$'
 
 
 def read_data(filename: str):
-    data, sentence = [], []
-    fin = open(filename)
-
-    for line in fin:
-        l = line.split()
-        if l:
-            sentence.append((l[0], l[1]))
-        else:
-            data.append(sentence)
-            sentence = []
-
-    return data
+    # use read_sentences to stream large files instead of loading them at once
+    return list(read_sentences(filename))
 
 
 def word_count(data: List[List[Tuple[str, str]]]) -> int:
@@ -47,12 +37,16 @@ def word_count(data: List[List[Tuple[str, str]]]) -> int:
     return sum([len(sentence) for sentence in data])
 
 
-def to_probs(model: Dict[Any, Counter]) -> Dict[str, List[Tuple[str, float]]]:
-    for feature, counter in model.items():
-        ts = counter.most_common()
-        total = sum([count for _, count in ts])
-        model[feature] = [(pos, count / total) for pos, count in ts]
-    return model
+def create_dicts(data: List[List[Tuple[str, str]]], templates: List[str] = ('cw', 'pp', 'pw', 'nw'), min_count: int = 1, top_k: int = 0) -> Dict[str, Dict[Any, List[Tuple[str, float]]]]:
+    """
+    :param data: a list of tuple lists where each inner list represents a sentence and every tuple is a (word, pos) pair.
+    :param templates: the names of the feature templates collected in one pass over the data: 'cw' (uni_pos), 'pp' (bi_pos), 'pw' (bi_wp), 'nw' (bi_wn).
+    :param min_count: the contexts seen fewer times than this are dropped.
+    :param top_k: if positive, only the k most frequent tags of every context are kept, with their unnormalized probabilities.
+    :return: a dictionary of (template name, dictionary where the key is the context and the value is the list of possible POS tags with probabilities in descending order).
+    """
+    counts = FeatureCounts(templates).update_all(data)
+    return {name: counts.to_dict(name, min_count, top_k) for name in templates}
 
 
 def create_uni_pos_dict(data: List[List[Tuple[str, str]]]) -> Dict[str, List[Tuple[str, float]]]:
@@ -60,13 +54,7 @@ def create_uni_pos_dict(data: List[List[Tuple[str, str]]]) -> Dict[str, List[Tup
     :param data: a list of tuple lists where each inner list represents a sentence and every tuple is a (word, pos) pair.
     :return: a dictionary where the key is a word and the value is the list of possible POS tags with probabilities in descending order.
     """
-    model = dict()
-
-    for sentence in data:
-        for word, pos in sentence:
-            model.setdefault(word, Counter()).update([pos])
-
-    return to_probs(model)
+    return create_dicts(data, ['cw'])['cw']
 
 
 def create_bi_pos_dict(data: List[List[Tuple[str, str]]]) -> Dict[str, List[Tuple[str, float]]]:
@@ -74,14 +62,7 @@ def create_bi_pos_dict(data: List[List[Tuple[str, str]]]) -> Dict[str, List[Tupl
     :param data: a list of tuple lists where each inner list represents a sentence and every tuple is a (word, pos) pair.
     :return: a dictionary where the key is the previous POS tag and the value is the list of possible POS tags with probabilities in descending order.
     """
-    model = dict()
-
-    for sentence in data:
-        for i, (_, curr_pos) in enumerate(sentence):
-            prev_pos = sentence[i - 1][1] if i > 0 else PREV_DUMMY
-            model.setdefault(prev_pos, Counter()).update([curr_pos])
-
-    return to_probs(model)
+    return create_dicts(data, ['pp'])['pp']
 
 
 def create_bi_wp_dict(data: List[List[Tuple[str, str]]]) -> Dict[str, List[Tuple[str, float]]]:
@@ -89,14 +70,7 @@ def create_bi_wp_dict(data: List[List[Tuple[str, str]]]) -> Dict[str, List[Tuple
     :param data: a list of tuple lists where each inner list represents a sentence and every tuple is a (word, pos) pair.
     :return: a dictionary where the key is the previous word and the value is the list of possible POS tags with probabilities in descending order.
     """
-    model = dict()
-
-    for sentence in data:
-        for i, (_, curr_pos) in enumerate(sentence):
-            prev_word = sentence[i - 1][0] if i > 0 else PREV_DUMMY
-            model.setdefault(prev_word, Counter()).update([curr_pos])
-
-    return to_probs(model)
+    return create_dicts(data, ['pw'])['pw']
 
 
 def create_bi_wn_dict(data: List[List[Tuple[str, str]]]) -> Dict[str, List[Tuple[str, float]]]:
@@ -104,14 +78,7 @@ def create_bi_wn_dict(data: List[List[Tuple[str, str]]]) -> Dict[str, List[Tuple
     :param data: a list of tuple lists where each inner list represents a sentence and every tuple is a (word, pos) pair.
     :return: a dictionary where the key is the previous word and the value is the list of possible POS tags with probabilities in descending order.
     """
-    model = dict()
-
-    for sentence in data:
-        for i, (_, curr_pos) in enumerate(sentence):
-            next_word = sentence[i + 1][0] if i + 1 < len(sentence) else PREV_DUMMY
-            model.setdefault(next_word, Counter()).update([curr_pos])
-
-    return to_probs(model)
+    return create_dicts(data, ['nw'])['nw']
 
 
 def predict_uni_pos_dict(uni_pos_dict: Dict[str, List[Tuple[str, float]]], tokens: List[str], pprint=False) -> List[Tuple[str, float]]:
@@ -178,7 +145,17 @@ def predict_interporlation(
         bi_pos_weight: float,
         bi_wp_weight: float,
         bi_wn_weight: float,
-        tokens: List[str]) -> List[Tuple[str, float]]:
+        tokens: List[str],
+        width: Optional[int] = 1,
+        prune: bool = False) -> List[Tuple[str, float]]:
+    """
+    :param width: the beam width; 1 decodes greedily, None decodes with Viterbi (see TaggerModel.predict_batch).
+    :param prune: if True, the tags of every known word are restricted to the ones in uni_pos_dict.
+    """
+    if width != 1 or prune:
+        model = cached_interpolation(uni_pos_dict, bi_pos_dict, bi_wp_dict, bi_wn_dict, uni_pos_weight, bi_pos_weight, bi_wp_weight, bi_wn_weight)
+        return model.predict_batch([tokens], width, prune)[0]
+
     output = []
 
     for i in range(len(tokens)):
@@ -200,12 +177,53 @@ def predict_interporlation(
         for pos, prob in bi_wn_dict.get(next_word, dict()):
             scores[pos] = scores.get(pos, 0) + prob * bi_wn_weight
 
-        o = max(scores.items(), key=lambda k, v: v) if scores else ('XX', 0.0)
+        o = max(scores.items(), key=lambda kv: kv[1]) if scores else ('XX', 0.0)
         output.append(o)
 
     return output
 
 
+def compact_interpolation(
+        uni_pos_dict: Dict[str, List[Tuple[str, float]]],
+        bi_pos_dict: Dict[str, List[Tuple[str, float]]],
+        bi_wp_dict: Dict[str, List[Tuple[str, float]]],
+        bi_wn_dict: Dict[str, List[Tuple[str, float]]],
+        uni_pos_weight: float,
+        bi_pos_weight: float,
+        bi_wp_weight: float,
+        bi_wn_weight: float) -> TaggerModel:
+    """
+    :return: the interpolation of the four dictionaries as a TaggerModel, which can decode with a beam or Viterbi.
+    """
+    models = {'cw': uni_pos_dict, 'pp': bi_pos_dict, 'pw': bi_wp_dict, 'nw': bi_wn_dict}
+    return TaggerModel.from_dicts(models, {'cw': uni_pos_weight, 'pp': bi_pos_weight, 'pw': bi_wp_weight, 'nw': bi_wn_weight})
+
+
+# the last compacted model with the dictionaries and weights it was built from
+_compacted = None
+
+
+def cached_interpolation(
+        uni_pos_dict: Dict[str, List[Tuple[str, float]]],
+        bi_pos_dict: Dict[str, List[Tuple[str, float]]],
+        bi_wp_dict: Dict[str, List[Tuple[str, float]]],
+        bi_wn_dict: Dict[str, List[Tuple[str, float]]],
+        uni_pos_weight: float,
+        bi_pos_weight: float,
+        bi_wp_weight: float,
+        bi_wn_weight: float) -> TaggerModel:
+    """
+    :return: the same model as compact_interpolation, compacted again only if other dictionaries or weights are given;
+             the dictionaries are compared by identity, so they must not be modified once passed in.
+    """
+    global _compacted
+    dicts = (uni_pos_dict, bi_pos_dict, bi_wp_dict, bi_wn_dict)
+    weights = (uni_pos_weight, bi_pos_weight, bi_wp_weight, bi_wn_weight)
+    if _compacted is None or any(a is not b for a, b in zip(_compacted[0], dicts)) or _compacted[1] != weights:
+        _compacted = dicts, weights, compact_interpolation(*dicts, *weights)
+    return _compacted[2]
+
+
 def evaluate_interpolation(
         uni_pos_dict: Dict[str, List[Tuple[str, float]]],
         bi_pos_dict: Dict[str, List[Tuple[str, float]]],
@@ -216,11 +234,20 @@ def evaluate_interpolation(
         bi_wp_weight: float,
         bi_wn_weight: float,
         data: List[List[Tuple[str, str]]],
-        pprint=False):
+        pprint=False,
+        width: Optional[int] = 1,
+        prune: bool = False):
     total, correct = 0, 0
-    for sentence in data:
+    sentences = [[w for w, _ in sentence] for sentence in data]
+    if width != 1 or prune:
+        # the dictionaries are compacted once and all sentences are decoded together
+        model = cached_interpolation(uni_pos_dict, bi_pos_dict, bi_wp_dict, bi_wn_dict, uni_pos_weight, bi_pos_weight, bi_wp_weight, bi_wn_weight)
+        outputs = model.predict_batch(sentences, width, prune)
+    else:
+        outputs = [predict_interporlation(uni_pos_dict, bi_pos_dict, bi_wp_dict, bi_wn_dict, uni_pos_weight, bi_pos_weight, bi_wp_weight, bi_wn_weight, tokens) for tokens in sentences]
+    for sentence, output in zip(data, outputs):
         tokens, gold = tuple(zip(*sentence))
-        pred = [t[0] for t in predict_interporlation(uni_pos_dict, bi_pos_dict, bi_wp_dict, bi_wn_dict, uni_pos_weight, bi_pos_weight, bi_wp_weight, bi_wn_weight, tokens)]
+        pred = [t[0] for t in output]
         total += len(tokens)
         correct += len([1 for g, p in zip(gold, pred) if g == p])
     accuracy = 100.0 * correct / total
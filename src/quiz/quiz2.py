@@ -14,10 +14,13 @@
 # limitations under the License.
 # ========================================================================
 import json
-from typing import Dict, Any, List, Tuple
+from typing import Dict, Any, List, Tuple, Mapping, Optional, Set
 from collections import Counter
-from src.vector_space_models import tf_idfs, most_similar, term_frequencies, document_frequencies, euclidean
+from src.vector_space_models import tf_idfs, most_similar, term_frequencies, document_frequencies, frequencies, read_fables, euclidean, DocumentVectors, DocumentView, most_similar_batch, InvertedIndex, as_vectors, as_queries, Vocabulary, CSRMatrix, dot_blocks, top_k, \
+    vectorize_tf_idfs, weigh, weigh_all, raw_tf, sublinear_tf, augmented_tf, idf_weight, capital_boost, bm25
+from src.approximate_search import CosineLSH
 import math
+import numpy as np
 
 FM = {
     'antgrass2.ram': 'TheAntsandtheGrasshopper',
@@ -60,6 +63,9 @@ FM = {
     'TheWolfinSheepsClothing2': 'TheWolfinSheepsClothing'
 }
 
+#Common words/punctuation that are never counted in a pair of words
+COMMON_WORDS = frozenset([".","!","?","\'", ":", ";","\"","and","the","or", ",", "he","she", "that", "I", "you", "him", "to", "in", "of", "his", "a", "had", "been", "did", "not", "they", "were", "was"])
+
 #Method inputs:
     #B is altfable title, A is fable title.
     #X is Dict[altfable title, list of tokens in altfable], and Y is Dict[fable title, list of tokens in fable]
@@ -67,24 +73,70 @@ FM = {
 #Method function
     #num_same_word_pairs returns the number of same pairs of words in a fable and an altfable
     #where the words in the pair have relatively high tf_idfs and are not in a list of common words/punctuation
+    #Every pair of positions with the same word pair is counted, so a word pair counts (# in A) * (# in B) times;
+    #the word pairs of each fable are counted once and only the shared ones are checked, instead of comparing every pair of positions
     #Unfortunately this method, though techincally functional, does not do well as an indiciation of overall document similarity
     #The fables are just too short for this method to be valuable
 def num_same_word_pairs(fable: str, altfable: str, X: Dict[str,list], Y: Dict[str,list], Z1: Dict[str, Dict[str, float]], Z2: Dict[str, Dict[str, float]]) -> int:
-    t=0
     A = X.get(fable)
     B = Y.get(altfable)
-    BB = enumerate(B)
-    P1 = [t for t, score in sorted(Z1[fable].items(), key=lambda x: x[1], reverse=True)[:int(len(A)/5)]]
-    P2 = [t for t, score in sorted(Z2[altfable].items(), key=lambda x: x[1], reverse=True)[:int(len(B)/5)]]
-    for j, word in BB:
-        for i in range (0, len(A)-1):
-            if word==A[i] and j<len(B)-1 and B[j+1]==A[i+1]:
-                if A[i] in P1 or A[i+1] in P1 or word in P2 or B[j+1] in P2:
-                    N = [".","!","?","\'", ":", ";","\"","and","the","or", ",", "he","she", "that", "I", "you", "him", "to", "in", "of", "his", "a", "had", "been", "did", "not", "they", "were", "was"]
-                    if A[i] not in N and A[i+1] not in N: t += 1
+    P = top_terms(Z1[fable], len(A)) | top_terms(Z2[altfable], len(B))
+    CA, CB = word_pairs(A), word_pairs(B)
+    t = sum(c * CB[pair] for pair, c in CA.items() if pair in CB and (pair[0] in P or pair[1] in P))
     if t!=0: print("t: ", t, "fable: ", fable, " altfable: ", altfable)
     return t
 
+#Counts the pairs of consecutive words in the tokens where neither word is in COMMON_WORDS
+def word_pairs(tokens: List[str]) -> Counter:
+    return Counter(pair for pair in zip(tokens, tokens[1:]) if pair[0] not in COMMON_WORDS and pair[1] not in COMMON_WORDS)
+
+#The int(n/5) terms with the highest tf_idfs in the vector, where n is the number of tokens in the fable
+def top_terms(z: Dict[str, float], n: int) -> Set[str]:
+    return {t for t, score in sorted(z.items(), key=lambda x: x[1], reverse=True)[:int(n/5)]}
+
+
+#Precomputed word pairs of a set of fables so that num_same_word_pairs can be scored for many pairs of fables
+#X is Dict[title, list of tokens] and Z is Dict[title, Dict[term, tf_idfs]] as in num_same_word_pairs
+class WordPairs:
+    def __init__(self, X: Dict[str, list], Z: Dict[str, Dict[str, float]]):
+        self.keys = list(X)
+        self.pairs = {k: word_pairs(tokens) for k, tokens in X.items()}
+        self.top = {k: top_terms(Z[k], len(tokens)) for k, tokens in X.items()}
+
+    #Same as num_same_word_pairs(fable, altfable, ...) where self holds the fables and other holds the altfables, without printing
+    def score(self, other: 'WordPairs', fable: str, altfable: str) -> int:
+        CA, CB = self.pairs[fable], other.pairs[altfable]
+        if len(CB) < len(CA): CA, CB = CB, CA
+        P1, P2 = self.top[fable], other.top[altfable]
+        return sum(c * CB[(w1, w2)] for (w1, w2), c in CA.items()
+                   if (w1, w2) in CB and (w1 in P1 or w2 in P1 or w1 in P2 or w2 in P2))
+
+    #Count vectors of the word pairs over the shared vocabulary: one with all pairs and one with only the pairs having a top term
+    def vectors(self, vocab: Vocabulary) -> Tuple[CSRMatrix, CSRMatrix]:
+        rows, top_rows = [], []
+        for k in self.keys:
+            C, P = self.pairs[k], self.top[k]
+            ids = np.array([vocab.add(w1 + ' ' + w2) for w1, w2 in C], dtype=np.int32)
+            counts = np.fromiter(C.values(), dtype=np.float64, count=len(C))
+            has_top = np.fromiter(((w1 in P or w2 in P) for w1, w2 in C), dtype=bool, count=len(C))
+            rows.append((ids, counts))
+            top_rows.append((ids, counts * has_top))
+        return CSRMatrix.from_rows(rows, len(vocab)), CSRMatrix.from_rows(top_rows, len(vocab))
+
+    #Scores num_same_word_pairs for all pairs of fables in self and altfables in other at once
+    #Returns a matrix of shape [len(self.keys), len(other.keys)]
+    #A pair counts if it has a top term of either fable: sum(a*b*[hA or hB]) = (a*hA).b + a.(b*hB) - (a*hA).(b*hB)
+    def scores(self, other: 'WordPairs') -> np.ndarray:
+        vocab = Vocabulary()
+        A, AP = self.vectors(vocab)
+        B, BP = other.vectors(vocab)
+        out = np.zeros((len(A), len(B)), dtype=np.float64)
+        for X, Y, sign in [(AP, B, 1), (A, BP, 1), (AP, BP, -1)]:
+            for bs, block in dot_blocks(X, Y):
+                out[bs:bs + len(block)] += sign * block
+        return np.rint(out).astype(np.int64)
+
+
 #helper method for num_same_word_pairs
 def get_list_tokens(fables) -> Dict[str,list]:
     def key(t): return t[t.rfind('&') + 1:]
@@ -106,11 +158,12 @@ def number_right_matches(Z: Dict[str, str]) -> int:
 
 
 #Method calculates the cosine similarity between two fables
-def cosine(x1: Dict[str, float], x2: Dict[str, float]) -> float:
+#m1 and m2 are the cached norms of x1 and x2, if any, so they do not have to be recomputed for every pair
+def cosine(x1: Dict[str, float], x2: Dict[str, float], m1: Optional[float] = None, m2: Optional[float] = None) -> float:
     t = sum((s1 * x2.get(term,0)) for term, s1 in x1.items())
         #if term is in x2 but not in x1 than we dont need to calculate anyway, since t+=0*s2 = t
-    m1 = math.sqrt(sum(s1 ** 2 for term, s1 in x1.items()))
-    m2 = math.sqrt(sum(s2 ** 2 for term, s2 in x2.items()))
+    if m1 is None: m1 = math.sqrt(sum(s1 ** 2 for term, s1 in x1.items()))
+    if m2 is None: m2 = math.sqrt(sum(s2 ** 2 for term, s2 in x2.items()))
     return t / (m1 * m2)
 
 
@@ -119,29 +172,34 @@ def cosine(x1: Dict[str, float], x2: Dict[str, float]) -> float:
 #This work very badly! This is ecause our documents are small so this method doesn't make practical sense
 #Each document does not have a relatively large number of terms, and the term frequency of each term is generally small
     #thus 1+math.log(tf)
-def sublinear(fables) -> Dict[str,Dict[str,int]]:
-    tfs = term_frequencies(fables)
-    out = dict()
-    for dkey, term_counts in tfs.items():
-        out[dkey] = {t: 1+math.log(tf) for t,tf in term_counts.items()}
+def sublinear(fables) -> Mapping[str, Dict[str, float]]:
+    return weigh(vectorize_tf_idfs(fables), *SCHEMES['sublinear']).to_dict()
             #The sublinear function is if tf>0 then we do 1+math.log(tf). We always have tf>0, otherwise the term wouldn't be in the sparse vector
-    return(out)
 
 #Testing values of alpha
     #Using a for loop in the main method with variable i in range (0, 200), then alpha = 1/x, where x is any number and allows for get float values of alpha
     #I tested different value of alpha. The general range of correct matches of similar documents was 13 to 21 out of 37
     #For example, 0.85 yeilded 21 correct documents. Overall, this is better than using uclidean and tf_idfs, but worse than using cosine and tf_idfs
-def normalize(fables) -> Dict[str,Dict[str,int]]:
-    alpha = 0.2
-    tfs = term_frequencies(fables)
-    dfs = document_frequencies(fables)
-    out = dict()
-    for dkey, term_counts in tfs.items():
-        max_tf = 0
-        for t, tf in term_counts.items():
-            if tf > max_tf: max_tf = tf
-        out[dkey] = {t: alpha+(1-alpha)*(tf/max_tf) for t,tf in term_counts.items()}
-    return out
+def normalize(fables) -> Mapping[str, Dict[str, float]]:
+    return weigh(vectorize_tf_idfs(fables), *SCHEMES['normalize']).to_dict()
+
+
+#N is a list of common but un-important words/punctuation for tf_idfs_with_capitals
+N = [".", "!", "?", "\'", ":", ";", "\"", "and", "the", "or", ",", "he", "she", "that", "i", "you", "him", "to",
+     "in", "of", "his", "a", "had", "been", "did", "not", "they", "were", "was", "is", "of", "to", "in", "you", "have", "at", "by","her"
+     "be", "will", "then", "but", "when", "now", "it", "as", "this", "so", "how", "on", "be", "once", "an","if", "what", "why", "ah",
+     "yes", "do", "an", "yes", "for", "my", "one", "two", "three", "four", "we", "oh", "get", "no", "from", "0", "o", "good", "who", "among", "well"]
+
+#Weighting schemes as transforms over the term/document frequencies (see vector_space_models.weigh)
+#alpha = 0.2 for normalize and a 0.5 boost for capitals, as tested above and below
+SCHEMES = {
+    'raw': [raw_tf],
+    'sublinear': [sublinear_tf],
+    'normalize': [augmented_tf(0.2)],
+    'tf_idfs': [idf_weight],
+    'capitals': [idf_weight, capital_boost(0.5, frozenset(N))],
+    'bm25': bm25(),
+}
 
 
 #Input: all fables, Output: returns a Dict[fable title, Dict[term, calculated idfs of the term]]
@@ -149,50 +207,76 @@ def normalize(fables) -> Dict[str,Dict[str,int]]:
     #if a term has first letter capitalized and is not in a list of common/non-important words/punctuation, then that term's tf_idfs score is increased
     #by 0.5. I experimented some and found that 0.2-0.5 seemed the best range.
     # This addition does not improve the accuracy the method/program, perhaps because of the short lengthes of the documents
-def tf_idfs_with_capitals(fables) -> Dict[str, Dict[str, int]]:
-    tfs = term_frequencies(fables)
-    dfs = document_frequencies(fables)
-    out = dict()
-    D = len(tfs)
-    #N is a list of common but un-important words/punctuation
-    N = [".", "!", "?", "\'", ":", ";", "\"", "and", "the", "or", ",", "he", "she", "that", "i", "you", "him", "to",
-         "in", "of", "his", "a", "had", "been", "did", "not", "they", "were", "was", "is", "of", "to", "in", "you", "have", "at", "by","her"
-         "be", "will", "then", "but", "when", "now", "it", "as", "this", "so", "how", "on", "be", "once", "an","if", "what", "why", "ah",
-         "yes", "do", "an", "yes", "for", "my", "one", "two", "three", "four", "we", "oh", "get", "no", "from", "0", "o", "good", "who", "among", "well"]
-    for dkey, term_counts in tfs.items():
-        dic = dict()
-        for t, tf in term_counts.items():
-            x = tf*math.log(D/dfs[t])
-            if t[0].isupper() and t.lower() not in N:
-                x=x+0.5
-            dic[t] = x
-        out[dkey] = dic
-    return out
-
-
-def vectorize(documents: List[Dict[str, Any]]) -> Dict[str, Dict[str, int]]:
-    return tf_idfs_with_capitals(documents)
+#Returns a read-only view over the vectors that caches their norms; if normalize, the vectors are stored L2-normalized
+def tf_idfs_with_capitals(fables, normalize: bool = False) -> Mapping[str, Dict[str, float]]:
+    return weigh(vectorize_tf_idfs(fables), *SCHEMES['capitals'], normalize=normalize).to_dict()
+
+
+#Vectorizes the fables with several weighting schemes while counting the terms only once
+#schemes is a list of names in SCHEMES; returns Dict[scheme name, output like vectorize]
+def vectorize_all(documents: List[Dict[str, Any]], schemes: Tuple[str, ...] = tuple(SCHEMES), normalize: bool = False) -> Dict[str, Mapping[str, Dict[str, float]]]:
+    out = weigh_all(vectorize_tf_idfs(documents), {name: SCHEMES[name] for name in schemes}, normalize)
+    return {name: v.to_dict() for name, v in out.items()}
+
+
+def vectorize(documents: List[Dict[str, Any]], normalize: bool = False) -> Mapping[str, Dict[str, float]]:
+    return tf_idfs_with_capitals(documents, normalize)
 
 
 
 def similar_documents(X: Dict[str, Dict[str, float]], Y: Dict[str, Dict[str, float]]) -> Dict[str, str]:
             #X is Dict[titles altfables, Dict[terms in altfables, tf_idfs]]
             #Y is Dict[titles fables, Dict[terms in fables, tf_idfs]]
-    return {k: most_similar1(Y, x) for k, x in X.items()} #use the method which compares cosine similarity
+    #compares cosine similarity for all pairs at once; gives the same matches as most_similar1 for each x in X
+    #the outputs of vectorize are reused with their cached norms, only the term ids of X are mapped onto Y's without changing Y's vocabulary
+    Y = as_vectors(Y)
+    X = as_queries(X, Y)
+    return {k: t[0][0] if t else None for k, t in most_similar_batch(Y, X, metric='cosine').items()}
   #similar_documents takes the outputs of vectorize/tf_idfs of fables and altfables
   #Input to most_similar is Dict[titles fables, Dict[terms in fables, tf_idfs]], Dict[terms in altfables,tf_idfs]
   #returns the fable of all fables that is most similar to the alt fable
 
 
+#Approximate version of similar_documents that only compares fables falling in the same LSH buckets as each alt fable
+#bands/rows trade recall for speed (see CosineLSH); an alt fable gets None if no fable shares a bucket with it
+#The alt fables are not very similar to their closest fables, so the bands are shorter than the default of CosineLSH:
+#64 x 8 compares about a quarter of the fables and finds the exact match for about 3/4 of the alt fables (see approximate_search.benchmark);
+#more bands or fewer rows raise recall toward comparing every fable
+def similar_documents_approx(X: Dict[str, Dict[str, float]], Y: Dict[str, Dict[str, float]], bands: int = 64, rows: int = 8, **kwargs) -> Dict[str, str]:
+    lsh = CosineLSH(Y, bands=bands, rows=rows, **kwargs)
+    return {k: t[0][0] if t else None for k, t in lsh.search_batch(X).items()}
+
+
 #Use cosine similarity instead of Euclidean distance
+#If Y is the output of vectorize, x is scored against its matrix and cached norms without building the dictionaries of the fables
 def most_similar1(Y: Dict[str, Dict[str, float]], x: Dict[str, float]) -> str:
+    if isinstance(Y, DocumentView):
+        v = Y.vectors
+        if len(v) == 0: return None
+        #the terms of x that are not in Y add nothing to the dot products; they only count toward the norm of x
+        X = as_queries({None: x}, v)
+        ids, _ = top_k(X.matrix, v.matrix, 1, 'cosine', x_norms=X.norms, y_norms=Y.norms, Yt=v.transposed)
+        return v.keys[int(ids[0, 0])]
+
     m, t = -1, None
+    m1 = math.sqrt(sum(s1 ** 2 for s1 in x.values()))
     for title, y in Y.items():
-        d = cosine(x,y)
+        d = cosine(x, y, m1)
         if m < 0 or d > m:
             m, t = d, title
     return t
 
+#Builds an inverted index over the outputs of vectorize/tf_idfs of fables for most_similar2
+def index_documents(Y: Dict[str, Dict[str, float]]) -> InvertedIndex:
+    return InvertedIndex(as_vectors(Y))
+
+
+#Same as most_similar1 for one query at a time, but only scores the fables that share a term with x
+#Returns None if no fable shares a term with x
+def most_similar2(index: InvertedIndex, x: Dict[str, float]) -> str:
+    t = index.search(x, 1)
+    return t[0][0] if t else None
+
 #Uses Euclidean distance
 def most_similar(Y: Dict[str, Dict[str, float]], x: Dict[str, float]) -> str:
     m, t = -1, None
@@ -209,11 +293,8 @@ def most_similar(Y: Dict[str, Dict[str, float]], x: Dict[str, float]) -> str:
 
 
 if __name__ == '__main__':
-    fables = json.load(open('res/vsm/aesopfables.json'))
-    fables_alt = json.load(open('res/vsm/aesopfables-alt.json'))
-
-    v_fables = vectorize(fables)
-    v_fables_alt = vectorize(fables_alt)
+    v_fables = vectorize(read_fables('res/vsm/aesopfables.json'))
+    v_fables_alt = vectorize(read_fables('res/vsm/aesopfables-alt.json'))
 
     for x, y in similar_documents(v_fables_alt, v_fables).items():
         print('{} -> {}'.format(x, y))
@@ -13,26 +13,18 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 # ========================================================================
-import pickle
-from collections import Counter
-from typing import List, Tuple, Dict, Any
+from typing import List, Tuple, Dict, Any, Iterable, Iterator
+
+from src.pos_models import TEMPLATES, FeatureCounts, TaggerModel, read_sentences, batches
+from src.pos_store import save_model, load_model
+from src.pos_tuning import WeightTuner
 
 DUMMY = '!@#$'
 
 
 def read_data(filename: str):
-    data, sentence = [], []
-    fin = open(filename)
-
-    for line in fin:
-        l = line.split()
-        if l:
-            sentence.append((l[0], l[1]))
-        else:
-            data.append(sentence)
-            sentence = []
-
-    return data
+    # use read_sentences to stream large files instead of loading them at once
+    return list(read_sentences(filename))
 
 
 def word_count(data: List[List[Tuple[str, str]]]) -> int:
@@ -43,14 +35,16 @@ def word_count(data: List[List[Tuple[str, str]]]) -> int:
     return sum([len(sentence) for sentence in data])
 
 
-def to_probs(model: Dict[Any, Counter]) -> Dict[str, List[Tuple[str, float]]]:
-    probs = dict()
-    for feature, counter in model.items():
-        ts = counter.most_common()
-        total = sum([count for _, count in ts])
-        probs[feature] = [(label, count/total) for label, count in ts]
-    return probs
-
+def create_dicts(data: List[List[Tuple[str, str]]], templates: List[str] = TEMPLATES, min_count: int = 1, top_k: int = 0) -> Dict[str, Dict[Any, List[Tuple[str, float]]]]:
+    """
+    :param data: a list of tuple lists where each inner list represents a sentence and every tuple is a (word, pos) pair.
+    :param templates: the names of the feature templates (e.g., 'cw', 'pp', 'pw_cw_nw'), whose counts are all collected in one pass over the data.
+    :param min_count: the contexts seen fewer times than this are dropped.
+    :param top_k: if positive, only the k most frequent tags of every context are kept, with their unnormalized probabilities.
+    :return: a dictionary of (template name, the dictionary created by the corresponding create_*_dict function).
+    """
+    counts = FeatureCounts(templates).update_all(data)
+    return {name: counts.to_dict(name, min_count, top_k) for name in templates}
 
 
 def create_cw_dict(data: List[List[Tuple[str, str]]]) -> Dict[str, List[Tuple[str, float]]]:
@@ -58,11 +52,7 @@ def create_cw_dict(data: List[List[Tuple[str, str]]]) -> Dict[str, List[Tuple[st
     :param data: a list of tuple lists where each inner list represents a sentence and every tuple is a (word, pos) pair.
     :return: a dictionary where the key is a word and the value is the list of possible POS tags with probabilities in descending order.
     """
-    model = dict()
-    for sentence in data:
-        for word, pos in sentence:
-            model.setdefault(word, Counter()).update([pos])
-    return to_probs(model)
+    return create_dicts(data, ['cw'])['cw']
 
 
 def create_pp_dict(data: List[List[Tuple[str, str]]]) -> Dict[str, List[Tuple[str, float]]]:
@@ -70,12 +60,7 @@ def create_pp_dict(data: List[List[Tuple[str, str]]]) -> Dict[str, List[Tuple[st
     :param data: a list of tuple lists where each inner list represents a sentence and every tuple is a (word, pos) pair.
     :return: a dictionary where the key is the previous POS tag and the value is the list of possible POS tags with probabilities in descending order.
     """
-    model = dict()
-    for sentence in data:
-        for i, (_, curr_pos) in enumerate(sentence):
-            prev_pos = sentence[i-1][1] if i > 0 else DUMMY
-            model.setdefault(prev_pos, Counter()).update([curr_pos])
-    return to_probs(model)
+    return create_dicts(data, ['pp'])['pp']
 
 
 def create_pw_dict(data: List[List[Tuple[str, str]]]) -> Dict[str, List[Tuple[str, float]]]:
@@ -83,12 +68,7 @@ def create_pw_dict(data: List[List[Tuple[str, str]]]) -> Dict[str, List[Tuple[st
     :param data: a list of tuple lists where each inner list represents a sentence and every tuple is a (word, pos) pair.
     :return: a dictionary where the key is the previous word and the value is the list of possible POS tags with probabilities in descending order.
     """
-    model = dict()
-    for sentence in data:
-        for i, (_, curr_pos) in enumerate(sentence):
-            prev_word = sentence[i-1][0] if i > 0 else DUMMY
-            model.setdefault(prev_word, Counter()).update([curr_pos])
-    return to_probs(model)
+    return create_dicts(data, ['pw'])['pw']
 
 
 def create_nw_dict(data: List[List[Tuple[str, str]]]) -> Dict[str, List[Tuple[str, float]]]:
@@ -96,12 +76,7 @@ def create_nw_dict(data: List[List[Tuple[str, str]]]) -> Dict[str, List[Tuple[st
     :param data: a list of tuple lists where each inner list represents a sentence and every tuple is a (word, pos) pair.
     :return: a dictionary where the key is the next word and the value is the list of possible POS tags with probabilities in descending order.
     """
-    model = dict()
-    for sentence in data:
-        for i, (_, curr_pos) in enumerate(sentence):
-            next_word = sentence[i+1][0] if i+1 < len(sentence) else DUMMY
-            model.setdefault(next_word, Counter()).update([curr_pos])
-    return to_probs(model)
+    return create_dicts(data, ['nw'])['nw']
 
 
 
@@ -110,12 +85,7 @@ def create_cw_pp_dict(data: List[List[Tuple[str, str]]]) -> Dict[Tuple[str,str],
     :param data: a list of tuple lists where each inner list represents a sentence and every tuple is a (word, pos) pair.
     :return: a dictionary where the key is a tuple (current word, previous POS) and the value is the list of possible POS tags with probabilities in descending order.
     """
-    model = dict()
-    for sentence in data:
-        for i, (word, curr_pos) in enumerate(sentence):
-            prev_pos = sentence[i-1][1] if i > 0 else DUMMY
-            model.setdefault((word, prev_pos), Counter()).update([curr_pos])
-    return to_probs(model)
+    return create_dicts(data, ['cw_pp'])['cw_pp']
 
 
 def create_cw_pw_dict(data: List[List[Tuple[str, str]]]) -> Dict[Tuple[str,str], List[Tuple[str, float]]]:
@@ -123,12 +93,7 @@ def create_cw_pw_dict(data: List[List[Tuple[str, str]]]) -> Dict[Tuple[str,str],
     :param data: a list of tuple lists where each inner list represents a sentence and every tuple is a (word, pos) pair.
     :return: a dictionary where the key is a tuple of (current word, previous word) and the value is the list of possible POS tags with probabilities in descending order.
     """
-    model = dict()
-    for sentence in data:
-        for i, (word, curr_pos) in enumerate(sentence):
-            prev_word = sentence[i-1][0] if i > 0 else DUMMY
-            model.setdefault((word, prev_word), Counter()).update([curr_pos])
-    return to_probs(model)
+    return create_dicts(data, ['cw_pw'])['cw_pw']
 
 
 def create_cw_nw_dict(data: List[List[Tuple[str, str]]]) -> Dict[Tuple[str,str], List[Tuple[str, float]]]:
@@ -136,12 +101,7 @@ def create_cw_nw_dict(data: List[List[Tuple[str, str]]]) -> Dict[Tuple[str,str],
     :param data: a list of tuple lists where each inner list represents a sentence and every tuple is a (word, pos) pair.
     :return: a dictionary where the key is a tuple of the (current word, next word) and the value is the list of possible POS tags with probabilities in descending order.
     """
-    model = dict()
-    for sentence in data:
-        for i, (word, curr_pos) in enumerate(sentence):
-            next_word = sentence[i+1][0] if i+1 < len(sentence) else DUMMY
-            model.setdefault((word,next_word), Counter()).update([curr_pos])
-    return to_probs(model)
+    return create_dicts(data, ['cw_nw'])['cw_nw']
 
 
 def create_pw_cw_nw_dict(data: List[List[Tuple[str, str]]]) -> Dict[Tuple[str,str,str], List[Tuple[str, float]]]:
@@ -149,13 +109,7 @@ def create_pw_cw_nw_dict(data: List[List[Tuple[str, str]]]) -> Dict[Tuple[str,st
     :param data: a list of tuple lists where each inner list represents a sentence and every tuple is a (word, pos) pair.
     :return: a dictionary where the key is a tuple of the (previous word, current word, next word) and the value is the list of possible POS tags with probabilities in descending order.
     """
-    model = dict()
-    for sentence in data:
-        for i, (word, curr_pos) in enumerate(sentence):
-            prev_word = sentence[i - 1][0] if i > 0 else DUMMY
-            next_word = sentence[i+1][0] if i+1 < len(sentence) else DUMMY
-            model.setdefault((prev_word,word,next_word), Counter()).update([curr_pos])
-    return to_probs(model)
+    return create_dicts(data, ['pw_cw_nw'])['pw_cw_nw']
 
 
 def create_pp_cw_nw_dict(data: List[List[Tuple[str, str]]]) -> Dict[Tuple[str,str,str], List[Tuple[str, float]]]:
@@ -163,13 +117,7 @@ def create_pp_cw_nw_dict(data: List[List[Tuple[str, str]]]) -> Dict[Tuple[str,st
     :param data: a list of tuple lists where each inner list represents a sentence and every tuple is a (word, pos) pair.
     :return: a dictionary where the key is a tuple of the (previous pos, current word, next word) and the value is the list of possible POS tags with probabilities in descending order.
     """
-    model = dict()
-    for sentence in data:
-        for i, (word, curr_pos) in enumerate(sentence):
-            prev_pos = sentence[i - 1][1] if i > 0 else DUMMY
-            next_word = sentence[i+1][0] if i+1 < len(sentence) else DUMMY
-            model.setdefault((prev_pos,word,next_word), Counter()).update([curr_pos])
-    return to_probs(model)
+    return create_dicts(data, ['pp_cw_nw'])['pp_cw_nw']
 
 
 
@@ -177,22 +125,19 @@ def create_pp_cw_nw_dict(data: List[List[Tuple[str, str]]]) -> Dict[Tuple[str,st
 
 
 
-def train(trn_data: List[List[Tuple[str, str]]], dev_data: List[List[Tuple[str, str]]]) -> Tuple:
+def train(trn_data: Iterable[List[Tuple[str, str]]], dev_data: Iterable[List[Tuple[str, str]]], tune: bool = False, counts: FeatureCounts = None,
+          min_count: int = 1, top_k: int = 0) -> TaggerModel:
     """
-    :param trn_data: the training set
-    :param dev_data: the development set
-    :return: a tuple of all parameters necessary to perform part-of-speech tagging
+    :param trn_data: the training set, read once (e.g., a stream from read_sentences)
+    :param dev_data: the development set, loaded in memory only if tune is True
+    :param tune: if True, the weights below are tuned further on the development set
+    :param counts: the counts of all nine templates already collected from the training set, which is then not read
+    :param min_count: the contexts seen fewer times than this are dropped from the feature tables
+    :param top_k: if positive, only the k most frequent tags of every context are kept in the feature tables
+    :return: the model with all parameters necessary to perform part-of-speech tagging
     """
-    cw_dict = create_cw_dict(trn_data)
-    pp_dict = create_pp_dict(trn_data)
-    pw_dict = create_pw_dict(trn_data)
-    nw_dict = create_nw_dict(trn_data)
-    cw_pw_dict = create_cw_pw_dict(trn_data)
-    cw_nw_dict = create_cw_nw_dict(trn_data)
-    cw_pp_dict = create_cw_pp_dict(trn_data)
-    pw_cw_nw_dict = create_pw_cw_nw_dict(trn_data)
-    pp_cw_nw_dict = create_pp_cw_nw_dict(trn_data)
-    best_acc, best_args = -1, None
+    # the counts of all nine templates are collected in one pass over the training set
+    if counts is None: counts = FeatureCounts(TEMPLATES).update_all(trn_data)
 
     cw_weight = 0.75
     pp_weight = 0.275
@@ -204,61 +149,83 @@ def train(trn_data: List[List[Tuple[str, str]]], dev_data: List[List[Tuple[str,
     pw_cw_nw_weight = 0.55
     pp_cw_nw_weight = 0.800
 
+    weights = dict(zip(TEMPLATES, (cw_weight, pp_weight, pw_weight, nw_weight, cw_pw_weight, cw_nw_weight, cw_pp_weight, pw_cw_nw_weight, pp_cw_nw_weight)))
+    model = TaggerModel.from_counts(counts, weights, min_count=min_count, top_k=top_k)
+
+    #Do a sparse grid search just like in class. I did it before adding the final/trigram dictionaries
+    #Helped to find a general range for values
     #After getting a general sense of the values whic should be associated with each weight from the sparse grid search,
     #I did a fine grain search of each inividual weight to extract the greatest values
     #My final highest training result score on the development data was 95.1% accuracy
-    """
-    grid = [0.0, 0.1, 0.15, 0.2, 0.25, 0.3, 0.35, 0.4, 0.45, 0.5, 0.55, 0.6 ,0.65, 0.7, 0.75, 0.8,0.85,0.9, 0.95,1.0, 1.05, 1.1, 1.2, 1.3, 1.4, 1.5, 2.0]
-    for some_weight in grid:
-         args = (cw_dict, pp_dict, pw_dict, nw_dict, cw_pw_dict, cw_nw_dict, cw_pp_dict, pw_cw_nw_dict, pp_cw_nw_dict, cw_weight,pp_weight, pw_weight, nw_weight, cw_pw_weight, cw_nw_weight, cw_pp_weight, pw_cw_nw_weight, pp_cw_nw_weight)
-         acc = evaluate(dev_data, *args)
-         print('{:5.6f}% - cw: {:3.3f}, pp: {:3.3f}, pw: {:3.3f}, nw: {:3.3f}, cw_pw: {:3.3f}, cw_nw: {:3.3f}, cw_pp: {:3.3f}, pw_cw_nw: {:3.3f}, pp_cw_nw: {:3.3f}'.format(acc, cw_weight, pp_weight, pw_weight, nw_weight, cw_pw_weight, cw_nw_weight,cw_pp_weight, pw_cw_nw_weight, pp_cw_nw_weight))
-         if acc > best_acc: best_acc, best_args = acc, args
-    """
+    #The features of the development set are now looked up once, so every weight combination takes one sweep over the tokens
+    if tune:
+        dev_data = list(dev_data)
+        tuner = WeightTuner(model, dev_data)
+        grid = [0.0, 0.1, 0.15, 0.2, 0.25, 0.3, 0.35, 0.4, 0.45, 0.5, 0.55, 0.6 ,0.65, 0.7, 0.75, 0.8,0.85,0.9, 0.95,1.0, 1.05, 1.1, 1.2, 1.3, 1.4, 1.5, 2.0]
+        _, model.weights = tuner.coordinate_ascent(weights, grid, callback=lambda acc, w: print(_format(acc, w, 6)))
+
+    best_acc = evaluate(dev_data, model)
+    print("  ")
+    print(_format(best_acc, model.weights, 10))
+    return model
 
-    #Do a sparse grid search just like in class. I did it before adding the final/trigram dictionaries
-    #Helped to find a general range for values
-    #Obviously a more dense grid search with all dictionaries would have yeilded the highest result, but that would require too much time and memory
+
+def _format(accuracy: float, weights: Dict[str, float], precision: int) -> str:
+    return '{:5.{}f}% - '.format(accuracy, precision) + ', '.join('{}: {:3.3f}'.format(name, weight) for name, weight in weights.items())
+
+
+def running_accuracy(data: Iterable[List[Tuple[str, str]]], *args, batch_size: int = 1000) -> Iterator[Tuple[int, int]]:
     """
-    grid = [0.1, 0.5, 1.0]
-    for cw_weight in grid:
-        for pp_weight in grid:
-            for pw_weight in grid:
-                for nw_weight in grid:
-                    for cw_pw_weight in grid:
-                        for cw_nw_weight in grid:
-                            for cw_pp_weight in grid:
-                                args = (cw_dict, pp_dict, pw_dict, nw_dict, cw_pw_dict, cw_nw_dict, cw_pp_dict, cw_weight, pp_weight, pw_weight, nw_weight, cw_pw_weight, cw_nw_weight, cw_pp_weight)
-                                acc = evaluate(dev_data, *args)
-                                print('{:5.2f}% - cw: {:3.1f}, pp: {:3.1f}, pw: {:3.1f}, nw: {:3.1f}, cw_pw: {:3.1f}, cw_new: {:3.1f}, cw_pp: {:3.1f}'.format(acc, cw_weight, pp_weight, pw_weight, nw_weight, cw_pw_weight, cw_nw_weight, cw_pp_weight))
-                                if acc > best_acc: best_acc, best_args = acc, args
-                                """
-
-    best_args = (cw_dict, pp_dict, pw_dict, nw_dict, cw_pw_dict, cw_nw_dict, cw_pp_dict, pw_cw_nw_dict, pp_cw_nw_dict, cw_weight, pp_weight, pw_weight, nw_weight, cw_pw_weight, cw_nw_weight, cw_pp_weight, pw_cw_nw_weight, pp_cw_nw_weight)
-    best_acc = evaluate(dev_data, *best_args)
-    print("  ")
-    print('{:5.10f}% - cw: {:3.3f}, pp: {:3.3f}, pw: {:3.3f}, nw: {:3.3f}, cw_pw: {:3.3f}, cw_new: {:3.3f}, cw_pp: {:3.3f}, pw_cw_nw: {:3.3f}, pp_cw_nw: {:3.3f}'.format(best_acc, best_args[9], best_args[10], best_args[11], best_args[12], best_args[13], best_args[14], best_args[15], best_args[16], best_args[17]))
-    return best_args
+    :param data: sentences of (word, pos) pairs, e.g., a stream from read_sentences; a batch of sentences is tagged at a time.
+    :param args: the same arguments as predict.
+    :return: an iterator of (number of correct tags, number of tokens) so far after every batch.
+    """
+    total, correct = 0, 0
+    for batch in batches(data, batch_size):
+        outputs = predict_batch([[word for word, _ in sentence] for sentence in batch], *args)
+        for sentence, output in zip(batch, outputs):
+            gold = [pos for _, pos in sentence]
+            pred = [t[0] for t in output]
+            total += len(gold)
+            correct += len([1 for g, p in zip(gold, pred) if g == p])
+        yield correct, total
 
 
-def evaluate(data: List[List[Tuple[str, str]]], *args):
+def evaluate(data: Iterable[List[Tuple[str, str]]], *args):
     total, correct = 0, 0
-    for sentence in data:
-        tokens, gold = tuple(zip(*sentence))
-        pred = [t[0] for t in predict(tokens, *args)]
-        total += len(tokens)
-        correct += len([1 for g, p in zip(gold, pred) if g == p])
+    for correct, total in running_accuracy(data, *args): pass
     accuracy = 100.0 * correct / total
     return accuracy
 
 
+def compact(args: Tuple) -> TaggerModel:
+    """
+    :param args: the tuple of the nine dictionaries created by the create_*_dict functions followed by their nine weights.
+    :return: the same model with interned word/tag ids and array-backed probability tables, which is much smaller to keep and to pickle.
+    """
+    return TaggerModel.from_dicts(dict(zip(TEMPLATES, args[:9])), dict(zip(TEMPLATES, args[9:])))
+
+
+def predict_batch(sentences: List[List[str]], *args, width: int = 1, prune: bool = False) -> List[List[Tuple[str, float]]]:
+    """
+    :param sentences: a list of sentences where each sentence is a list of tokens.
+    :param args: the same arguments as predict.
+    :param width: the beam width; 1 decodes greedily like predict, None decodes with Viterbi (see TaggerModel.predict_batch).
+    :param prune: if True, the tags of every known word are restricted to the ones in cw_dict.
+    :return: the output of predict for every sentence with the defaults; a TaggerModel tags all sentences together.
+    """
+    if len(args) == 1: return args[0].predict_batch(sentences, width, prune)
+    if width != 1 or prune: return compact(args).predict_batch(sentences, width, prune)
+    return [predict(tokens, *args) for tokens in sentences]
+
 
 def predict(tokens: List[str], *args) -> List[Tuple[str, float]]:
     """
         :param tokens: a list of tokens.
-        :param args: a variable number of arguments
+        :param args: a variable number of arguments; either the nine dictionaries followed by their nine weights or a single TaggerModel (see train and compact), which can be wrapped by pos_cache.CachedTagger for repeated traffic or by pos_profile.TaggerProfiler to profile the templates.
         :return: a list of tuple where each tuple represents a pair of (POS, score) of the corresponding token.
         """
+    if len(args) == 1: return args[0].predict(tokens)
     cw_dict, pp_dict, pw_dict, nw_dict, cw_pw_dict, cw_nw_dict, cw_pp_dict, pw_cw_nw_dict, pp_cw_nw_dict, cw_weight, pp_weight, pw_weight, nw_weight, cw_pw_weight, cw_nw_weight, cw_pp_weight, pw_cw_nw_weight, pp_cw_nw_weight = args
     output = []
 
@@ -309,14 +276,14 @@ def predict(tokens: List[str], *args) -> List[Tuple[str, float]]:
 if __name__ == '__main__':
 
     path = './'  # path to the cs329 directory
-    trn_data = read_data(path + 'res/pos/wsj-pos.trn.gold.tsv')
+    trn_data = read_sentences(path + 'res/pos/wsj-pos.trn.gold.tsv')
     dev_data = read_data(path + 'res/pos/wsj-pos.dev.gold.tsv')
-    #model_path = path + 'src/quiz/quiz3.pkl'
-    model_path = path + 'quiz3.pkl'
+    #model_path = path + 'src/quiz/quiz3.bin'
+    model_path = path + 'quiz3.bin'
 
     # save model
-    args = train(trn_data, dev_data)
-    pickle.dump(args, open(model_path, 'wb'))
+    model = train(trn_data, dev_data)
+    save_model(model, model_path)
     # load model
-    args = pickle.load(open(model_path, 'rb'))
-    print(evaluate(dev_data, *args))
\ No newline at end of file
+    model = load_model(model_path)
+    print(evaluate(dev_data, model))
\ No newline at end of file
@@ -16,11 +16,15 @@
 
 __author__ = 'Jinho D. Choi'
 
+import itertools
 import json
+import multiprocessing
 from collections import Counter
-from typing import Dict, Tuple
+from functools import cached_property
+from typing import Dict, Tuple, List, Iterable, Iterator, Mapping, Optional, Any, Callable, Sequence, Collection
 
 import math
+import numpy as np
 import requests
 
 
@@ -30,40 +34,665 @@ def download(remote_addr: str, local_addr: str):
     fin.write(r.content)
 
 
-def term_frequencies(fables) -> Dict[str, Counter]:
+def term_frequencies(fables, processes: int = 1) -> Dict[str, Counter]:
     def key(t): return t[t.rfind('&') + 1:]
 
+    if processes > 1: return parallel_frequencies(fables, processes)[0]
     return {key(fable['source']): Counter(fable['tokens'].split()) for fable in fables}
 
 
-def document_frequencies(fables) -> Dict[str, int]:
+def document_frequencies(fables, processes: int = 1) -> Dict[str, int]:
+    if processes > 1: return parallel_frequencies(fables, processes)[1]
     dfs = Counter()
     for fable in fables:
         dfs.update(set(fable['tokens'].split()))
     return dfs
 
 
-def tf_idfs(fables) -> Dict[str, Dict[str, int]]:
-    tfs = term_frequencies(fables)
-    dfs = document_frequencies(fables)
-    out = dict()
-    D = len(tfs)
+def frequencies(fables, processes: int = 1) -> Tuple[Dict[str, Counter], Counter]:
+    """
+    Same as (term_frequencies(fables), document_frequencies(fables)) but reads the fables only once,
+    so it can consume a stream such as read_fables.
+    :param processes: if > 1, the counting is sharded across this many processes (see parallel_frequencies).
+    """
+    if processes > 1: return parallel_frequencies(fables, processes)
+    tfs, dfs = dict(), Counter()
+    for fable in fables:
+        term_counts = Counter(fable['tokens'].split())
+        tfs[fable_key(fable['source'])] = term_counts
+        dfs.update(term_counts.keys())
+    return tfs, dfs
+
+
+def _shards(fables: Iterable[Dict[str, Any]], shard_size: int) -> Iterator[List[Dict[str, Any]]]:
+    it = iter(fables)
+    while True:
+        shard = [{'source': fable['source'], 'tokens': fable['tokens']} for fable in itertools.islice(it, shard_size)]
+        if not shard: return
+        yield shard
+
+
+def _merge_frequencies(left: Tuple[Dict[str, Counter], Counter], right: Tuple[Dict[str, Counter], Counter]) -> Tuple[Dict[str, Counter], Counter]:
+    # the right shard comes later in the corpus, so its documents override the left ones with the same keys
+    left[0].update(right[0])
+    left[1].update(right[1])
+    return left
+
+
+def parallel_frequencies(fables, processes: Optional[int] = None, shard_size: int = 1000) -> Tuple[Dict[str, Counter], Counter]:
+    """
+    Counts term and document frequencies in shards of consecutive fables across a process pool and folds
+    the partial counts of every shard into one accumulator as they arrive in order; the output is identical to frequencies(fables).
+    :param processes: the number of worker processes; all CPUs if None.
+    :param shard_size: the number of fables counted by each task.
+    """
+    counts = dict(), Counter()
+    with multiprocessing.Pool(processes) as pool:
+        # the workers keep counting the next shards while the parent folds each partial once
+        for partial in pool.imap(frequencies, _shards(fables, shard_size)):
+            counts = _merge_frequencies(counts, partial)
+    return counts
+
+
+def read_fables(filename: str, fields: Tuple[str, ...] = ('source', 'tokens'), chunk_size: int = 1 << 16) -> Iterator[Dict[str, Any]]:
+    """
+    Reads fables one at a time from either a JSON array or JSON Lines without loading the whole file.
+    :param filename: the path to the JSON or JSON Lines file.
+    :param fields: the fields to keep in every fable; the other fields are discarded as soon as each fable is read.
+    :param chunk_size: the number of characters to read at a time.
+    :return: an iterator of fables, each containing only the specified fields that exist.
+    """
+    decoder = json.JSONDecoder()
+    buf, i, eof = '', 0, False
+
+    with open(filename) as fin:
+        while True:
+            # skip whitespaces and the array delimiters between objects
+            while i < len(buf) and buf[i] in ' \t\r\n[],': i += 1
+            if i == len(buf):
+                if eof: return
+                buf, i = fin.read(chunk_size), 0
+                eof = not buf
+                continue
+
+            try:
+                obj, j = decoder.raw_decode(buf, i)
+            except json.JSONDecodeError:
+                if eof: raise
+                chunk = fin.read(chunk_size)
+                buf, i, eof = buf[i:] + chunk, 0, not chunk
+                continue
+
+            if not isinstance(obj, dict): raise ValueError('Expected a JSON object at {}: {}'.format(filename, obj))
+            i = j
+            yield {f: obj[f] for f in fields if f in obj}
+
+
+def tf_idfs(fables) -> Mapping[str, Dict[str, float]]:
+    return vectorize_tf_idfs(fables).to_dict()
+
+
+def fable_key(source: str) -> str:
+    # the key of a fable is the part of its source after the last '&'
+    return source[source.rfind('&') + 1:]
+
+
+class Vocabulary:
+    """
+    Term <-> id table; matrices vectorized against the same vocabulary share their column ids.
+    """
+    frozen = False
+
+    def __init__(self):
+        self.ids: Dict[str, int] = dict()
+        self.terms: List[str] = []
+
+    def __len__(self) -> int:
+        return len(self.terms)
+
+    def __contains__(self, term: str) -> bool:
+        return term in self.ids
+
+    def add(self, term: str) -> int:
+        """
+        :return: the id of the term; a new id is assigned if the term has not been seen.
+        """
+        tid = self.ids.get(term)
+        if tid is None:
+            tid = self.ids[term] = len(self.terms)
+            self.terms.append(term)
+        return tid
+
+    def get(self, term: str, default: int = -1) -> int:
+        return self.ids.get(term, default)
+
+
+class CSRMatrix:
+    """
+    Compressed sparse rows: the columns of row i are indices[indptr[i]:indptr[i+1]] with the values in data.
+    """
+    def __init__(self, indptr: np.ndarray, indices: np.ndarray, data: np.ndarray, n_cols: int):
+        self.indptr = indptr
+        self.indices = indices
+        self.data = data
+        self.n_cols = n_cols
+
+    def __len__(self) -> int:
+        return len(self.indptr) - 1
+
+    @property
+    def shape(self) -> Tuple[int, int]:
+        return len(self), self.n_cols
+
+    def row(self, i: int) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        :return: a pair of (column ids, values) of the i'th row.
+        """
+        s, e = self.indptr[i], self.indptr[i + 1]
+        return self.indices[s:e], self.data[s:e]
+
+    def slice_rows(self, start: int, end: int) -> 'CSRMatrix':
+        """
+        :return: the matrix of the consecutive rows in [start, end), sharing the arrays of this matrix.
+        """
+        s, e = self.indptr[start], self.indptr[end]
+        return CSRMatrix(self.indptr[start:end + 1] - s, self.indices[s:e], self.data[s:e], self.n_cols)
+
+    def row_ids(self) -> np.ndarray:
+        """
+        :return: the row id of every stored value.
+        """
+        return np.repeat(np.arange(len(self), dtype=np.int64), np.diff(self.indptr))
+
+    def positions(self, rows: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        :param rows: row ids, possibly repeated.
+        :return: a pair of (the positions of the stored values of the rows concatenated in order, the number of values per row).
+        """
+        starts = self.indptr[rows]
+        lengths = self.indptr[rows + 1] - starts
+        offsets = np.cumsum(lengths) - lengths
+        return np.repeat(starts - offsets, lengths) + np.arange(lengths.sum(), dtype=np.int64), lengths
+
+    def squared_norms(self) -> np.ndarray:
+        return np.bincount(self.row_ids(), weights=self.data ** 2, minlength=len(self))
+
+    def transpose(self) -> 'CSRMatrix':
+        """
+        :return: the transposed matrix, i.e., the posting list of (row, value) for every column.
+        """
+        order = np.argsort(self.indices, kind='stable')
+        indptr = np.zeros(self.n_cols + 1, dtype=np.int64)
+        indptr[1:] = np.cumsum(np.bincount(self.indices, minlength=self.n_cols))
+        return CSRMatrix(indptr, self.row_ids()[order].astype(np.int32), self.data[order], len(self))
+
+    @staticmethod
+    def from_rows(rows: List[Tuple[np.ndarray, np.ndarray]], n_cols: int, dtype=np.float64) -> 'CSRMatrix':
+        indptr = np.zeros(len(rows) + 1, dtype=np.int64)
+        indptr[1:] = np.cumsum([len(ids) for ids, _ in rows])
+        indices = np.concatenate([ids for ids, _ in rows]).astype(np.int32) if rows else np.zeros(0, dtype=np.int32)
+        data = np.concatenate([values for _, values in rows]).astype(dtype) if rows else np.zeros(0, dtype=dtype)
+        return CSRMatrix(indptr, indices, data, n_cols)
+
+
+class DocumentVectors:
+    """
+    Sparse document vectors where row i of the CSR matrix represents the document keys[i].
+    - norms: L2 norms of the vectors, computed once.
+    - normalized: if True, the rows of the matrix are the vectors divided by their norms.
+    """
+    def __init__(self, keys: List[str], vocab: Vocabulary, matrix: CSRMatrix, norms: Optional[np.ndarray] = None, normalized: bool = False,
+                 rows: Optional[Mapping[str, int]] = None):
+        """
+        :param norms: the L2 norms of the vectors; required if the matrix is normalized, computed otherwise.
+        :param normalized: True if the rows of the matrix are already L2-normalized.
+        :param rows: the row id of every key; built from the keys if not given.
+        """
+        if norms is None:
+            if normalized: raise ValueError('The norms of normalized vectors must be given')
+            norms = np.sqrt(matrix.squared_norms())
+        self.keys = keys
+        self.vocab = vocab
+        self.matrix = matrix
+        self.norms = norms
+        self.normalized = normalized
+        self.rows = {key: i for i, key in enumerate(keys)} if rows is None else rows
+
+    def __len__(self) -> int:
+        return len(self.keys)
+
+    def vector(self, key: str) -> Dict[str, float]:
+        """
+        :return: the vector of the document as a dictionary of (term, weight).
+        """
+        ids, values = self.matrix.row(self.rows[key])
+        terms = self.vocab.terms
+        return {terms[i]: v for i, v in zip(ids.tolist(), values.tolist())}
+
+    def row_norms(self) -> np.ndarray:
+        """
+        :return: the L2 norms of the rows as stored in the matrix (1 or 0 if normalized).
+        """
+        return (self.norms > 0).astype(np.float64) if self.normalized else self.norms
+
+    @cached_property
+    def transposed(self) -> CSRMatrix:
+        """
+        :return: the matrix transposed once, i.e., the posting list of every term, for the queries scored one at a time.
+        """
+        return self.matrix.transpose()
+
+    def normalize(self) -> 'DocumentVectors':
+        """
+        :return: the same vectors whose rows are stored L2-normalized so that cosine similarity is a dot product.
+        """
+        if self.normalized: return self
+        return DocumentVectors(self.keys, self.vocab, _normalize(self.matrix, self.norms), self.norms, True, self.rows)
+
+    def reindex(self, vocab: Vocabulary, grow: bool = True) -> 'DocumentVectors':
+        """
+        :param grow: if False, the vocabulary is only read, e.g., to map queries onto the vocabulary of the documents.
+        :return: the same vectors whose column ids follow the vocabulary; new terms are added to it,
+                 or dropped if the vocabulary is frozen or grow is False (the cached norms still cover them).
+        """
+        if vocab is self.vocab: return self
+        M = self.matrix
+        if grow and not vocab.frozen:
+            ids = np.array([vocab.add(t) for t in self.vocab.terms], dtype=np.int32)
+            return DocumentVectors(self.keys, vocab, CSRMatrix(M.indptr, ids[M.indices], M.data, len(vocab)), self.norms, self.normalized, self.rows)
+
+        ids = np.array([vocab.get(t) for t in self.vocab.terms], dtype=np.int32)[M.indices]
+        return DocumentVectors(self.keys, vocab, _keep_values(M, ids, ids >= 0, len(vocab)), self.norms, self.normalized, self.rows)
+
+    def to_dict(self) -> 'DocumentView':
+        return DocumentView(self)
+
+    @staticmethod
+    def from_dicts(vectors: Mapping[str, Dict[str, float]], vocab: Optional[Vocabulary] = None, normalize: bool = False, grow: bool = True) -> 'DocumentVectors':
+        """
+        :param vectors: a dictionary of (document key, dictionary of (term, weight)).
+        :param vocab: the vocabulary to share with other matrices; new terms are added to it.
+        :param normalize: if True, the vectors are stored L2-normalized.
+        :param grow: if False, the terms not in the vocabulary are dropped instead of added to it (the norms still cover them).
+        """
+        if vocab is None: vocab = Vocabulary()
+        if grow and not vocab.frozen:
+            keys, rows = [], []
+            for key, x in vectors.items():
+                keys.append(key)
+                ids = np.array([vocab.add(t) for t in x], dtype=np.int32)
+                rows.append((ids, np.fromiter(x.values(), dtype=np.float64, count=len(x))))
+            v = DocumentVectors(keys, vocab, CSRMatrix.from_rows(rows, len(vocab)))
+            return v.normalize() if normalize else v
+
+        keys, rows, norms = [], [], []
+        for key, x in vectors.items():
+            keys.append(key)
+            ids = np.array([vocab.get(t) for t in x], dtype=np.int32)
+            values = np.fromiter(x.values(), dtype=np.float64, count=len(x))
+            norms.append(math.sqrt(float(values @ values)))
+            rows.append((ids[ids >= 0], values[ids >= 0]))
+        v = DocumentVectors(keys, vocab, CSRMatrix.from_rows(rows, len(vocab)), np.array(norms, dtype=np.float64))
+        return v.normalize() if normalize else v
+
+
+def _keep_values(M: CSRMatrix, indices: np.ndarray, keep: np.ndarray, n_cols: int) -> CSRMatrix:
+    # the matrix of the stored values where keep is True, whose column ids are taken from indices
+    indptr = np.zeros(len(M.indptr), dtype=np.int64)
+    indptr[1:] = np.cumsum(np.bincount(M.row_ids()[keep], minlength=len(M)))
+    return CSRMatrix(indptr, indices[keep], M.data[keep], n_cols)
+
+
+def _normalize(X: CSRMatrix, norms: np.ndarray) -> CSRMatrix:
+    n = norms[X.row_ids()]
+    return CSRMatrix(X.indptr, X.indices, np.divide(X.data, n, out=np.zeros_like(X.data), where=n > 0), X.n_cols)
+
+
+def as_vectors(Y: Mapping[str, Dict[str, float]], vocab: Optional[Vocabulary] = None, grow: bool = True) -> DocumentVectors:
+    """
+    :param Y: document vectors, a view over them, or a dictionary of (document key, dictionary of (term, weight)).
+    :param vocab: if given, the column ids of the returned vectors follow this vocabulary.
+    :param grow: if False, the terms not in the vocabulary are dropped instead of added to it (see DocumentVectors.reindex).
+    :return: the document vectors of Y; the cached norms are reused if Y already has them.
+    """
+    if isinstance(Y, DocumentView): Y = Y.vectors
+    if isinstance(Y, DocumentVectors): return Y.reindex(vocab, grow) if vocab is not None else Y
+    return DocumentVectors.from_dicts(Y, vocab, grow=grow)
+
+
+def as_queries(X: Mapping[str, Dict[str, float]], docs: DocumentVectors) -> DocumentVectors:
+    """
+    :return: the vectors of X whose column ids follow the vocabulary of the documents, which is left unchanged;
+             the terms the documents do not have are dropped as they add nothing to the dot products.
+    """
+    X = as_vectors(X, docs.vocab, grow=False)
+    M, n_cols = X.matrix, docs.matrix.n_cols
+    # the vocabulary may have grown with terms added after the documents, e.g., by the queries themselves
+    if M.n_cols <= n_cols: return X
+    return DocumentVectors(X.keys, X.vocab, _keep_values(M, M.indices, M.indices < n_cols, n_cols), X.norms, X.normalized, X.rows)
+
+
+class TfIdfMatrix(DocumentVectors):
+    """
+    TF-IDF vectors of a corpus, where the rows of the CSR matrices follow the document keys.
+    - counts: raw term frequencies.
+    - dfs: document frequencies indexed by term id.
+    - idf: inverse document frequencies indexed by term id.
+    - matrix: TF-IDF weights (counts * idf), L2-normalized if requested.
+    """
+    def __init__(self, keys: List[str], vocab: Vocabulary, counts: CSRMatrix, dfs: np.ndarray, D: int, normalize: bool = False):
+        self.counts = counts
+        self.dfs = dfs
+        self.D = D
+        self.idf = np.array([math.log(D / df) if df else 0.0 for df in dfs.tolist()], dtype=np.float64)
+        M = CSRMatrix(counts.indptr, counts.indices, counts.data * self.idf[counts.indices], counts.n_cols)
+        norms = np.sqrt(M.squared_norms())
+        if normalize: M = _normalize(M, norms)
+        super().__init__(keys, vocab, M, norms, normalize)
+
+    @cached_property
+    def doc_lengths(self) -> np.ndarray:
+        """
+        :return: the number of tokens in every document.
+        """
+        return np.bincount(self.counts.row_ids(), weights=self.counts.data, minlength=len(self.counts))
+
+    @cached_property
+    def max_tfs(self) -> np.ndarray:
+        """
+        :return: the highest term frequency in every document (0 for empty documents).
+        """
+        out = np.zeros(len(self.counts), dtype=np.float64)
+        np.maximum.at(out, self.counts.row_ids(), self.counts.data)
+        return out
+
+
+class DocumentView(Mapping):
+    """
+    Read-only Dict[key, Dict[term, weight]] over document vectors; each vector is built on access.
+    """
+    def __init__(self, vectors: DocumentVectors):
+        self.vectors = vectors
+        self.norms = vectors.row_norms()
+
+    def __getitem__(self, key: str) -> Dict[str, float]:
+        return self.vectors.vector(key)
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self.vectors.keys)
+
+    def __len__(self) -> int:
+        return len(self.vectors)
+
+    def norm(self, key: str) -> float:
+        """
+        :return: the cached L2 norm of the vector returned for the key.
+        """
+        return float(self.norms[self.vectors.rows[key]])
+
+
+def _count(tokens: str, vocab: Vocabulary) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    :return: a pair of (term ids, term frequencies) of the whitespace-separated tokens; new terms are added to the vocabulary.
+    """
+    term_counts = Counter(tokens.split())
+    ids = np.array([vocab.add(t) for t in term_counts], dtype=np.int32)
+    return ids, np.fromiter(term_counts.values(), dtype=np.int32, count=len(term_counts))
+
+
+def vectorize_tf_idfs(fables: Iterable[Dict[str, Any]], vocab: Optional[Vocabulary] = None, normalize: bool = False) -> TfIdfMatrix:
+    """
+    Tokenizes every fable once and builds its TF-IDF matrix.
+    :param fables: a collection of fables where each fable has the 'source' and 'tokens' fields.
+    :param vocab: the vocabulary to share with other matrices; new terms are added to it.
+    :param normalize: if True, the TF-IDF vectors are stored L2-normalized.
+    :return: the TF-IDF matrix, where a document whose key appears again is replaced by the later one.
+    """
+    if vocab is None: vocab = Vocabulary()
+    keys, rows, positions, seen = [], [], dict(), []
+
+    for fable in fables:
+        row = _count(fable['tokens'], vocab)
+        seen.append(row[0])
 
+        key = fable_key(fable['source'])
+        i = positions.get(key)
+        if i is None:
+            positions[key] = len(keys)
+            keys.append(key)
+            rows.append(row)
+        else:
+            rows[i] = row
 
-    for dkey, term_counts in tfs.items():
-        out[dkey] = {t: tf * math.log(D / dfs[t]) for t, tf in term_counts.items()}
+    V = len(vocab)
+    dfs = np.bincount(np.concatenate(seen), minlength=V) if seen else np.zeros(V, dtype=np.int64)
+    return TfIdfMatrix(keys, vocab, CSRMatrix.from_rows(rows, V, np.int32), dfs, len(keys), normalize)
+
+
+class IncrementalTfIdf:
+    """
+    TF-IDF index that keeps raw term and document frequencies so that documents can be added, removed,
+    or updated without rebuilding the corpus; IDFs are recomputed lazily the next time they are needed.
+    """
+    def __init__(self, vocab: Optional[Vocabulary] = None):
+        self.vocab = Vocabulary() if vocab is None else vocab
+        self.docs: Dict[str, Tuple[np.ndarray, np.ndarray]] = dict()
+        self.dfs = np.zeros(max(len(self.vocab), 16), dtype=np.int64)
+        self._idf: Optional[np.ndarray] = None
+        self._matrix: Optional[TfIdfMatrix] = None
+
+    def __len__(self) -> int:
+        return len(self.docs)
+
+    def __contains__(self, key: str) -> bool:
+        return key in self.docs
+
+    def _changed(self):
+        self._idf = None
+        self._matrix = None
+
+    def add(self, fable: Dict[str, Any]) -> str:
+        """
+        :param fable: a fable with the 'source' and 'tokens' fields.
+        :return: the key of the added document.
+        """
+        key = fable_key(fable['source'])
+        if key in self.docs: raise KeyError('Document already exists: {}'.format(key))
+        ids, counts = _count(fable['tokens'], self.vocab)
+        if len(self.vocab) > len(self.dfs):
+            self.dfs = np.concatenate((self.dfs, np.zeros(max(len(self.vocab), 2 * len(self.dfs)) - len(self.dfs), dtype=np.int64)))
+        self.dfs[ids] += 1
+        self.docs[key] = (ids, counts)
+        self._changed()
+        return key
+
+    def remove(self, key: str):
+        """
+        :param key: the key of the document to be removed.
+        """
+        ids, _ = self.docs.pop(key)
+        self.dfs[ids] -= 1
+        self._changed()
+
+    def update(self, fable: Dict[str, Any]) -> str:
+        """
+        Replaces the document with the same key, or adds it if it does not exist.
+        :param fable: a fable with the 'source' and 'tokens' fields.
+        :return: the key of the updated document.
+        """
+        key = fable_key(fable['source'])
+        if key in self.docs: self.remove(key)
+        return self.add(fable)
+
+    @property
+    def idf(self) -> np.ndarray:
+        """
+        :return: the inverse document frequencies indexed by term id, as of the current documents.
+        """
+        if self._idf is None:
+            D = len(self.docs)
+            self._idf = np.array([math.log(D / df) if df else 0.0 for df in self.dfs[:len(self.vocab)].tolist()], dtype=np.float64)
+        return self._idf
+
+    def vector(self, key: str) -> Dict[str, float]:
+        """
+        :return: the TF-IDF vector of the document as a dictionary of (term, weight).
+        """
+        ids, counts = self.docs[key]
+        terms = self.vocab.terms
+        return {terms[i]: w for i, w in zip(ids.tolist(), (counts * self.idf[ids]).tolist())}
+
+    def query(self, tokens: str) -> Dict[str, float]:
+        """
+        :param tokens: whitespace-separated tokens of a query that is not added to the index.
+        :return: the TF-IDF vector of the query; terms not in the index are dropped.
+        """
+        term_counts = Counter(tokens.split())
+        idf, ids = self.idf, self.vocab.ids
+        return {t: tf * float(idf[ids[t]]) for t, tf in term_counts.items() if t in ids and ids[t] < len(idf)}
+
+    def to_matrix(self) -> TfIdfMatrix:
+        """
+        :return: the TF-IDF matrix of the current documents, rebuilt only if the index has changed since the last call.
+        """
+        if self._matrix is None:
+            V = len(self.vocab)
+            counts = CSRMatrix.from_rows(list(self.docs.values()), V, np.int32)
+            self._matrix = TfIdfMatrix(list(self.docs), self.vocab, counts, self.dfs[:V].copy(), len(self.docs))
+        return self._matrix
+
+
+# A weighting transform maps the values of the counts matrix in the statistics (starting from the raw term frequencies)
+# to new values; transforms are composed by applying them in order, e.g., weigh(stats, sublinear_tf, idf_weight).
+Transform = Callable[[TfIdfMatrix, np.ndarray], np.ndarray]
+
+
+def raw_tf(stats: TfIdfMatrix, values: np.ndarray) -> np.ndarray:
+    return values
+
+
+def sublinear_tf(stats: TfIdfMatrix, values: np.ndarray) -> np.ndarray:
+    """
+    1 + log(tf); every stored term frequency is positive.
+    """
+    return 1 + np.log(values)
+
+
+def augmented_tf(alpha: float = 0.5) -> Transform:
+    """
+    :return: the transform alpha + (1 - alpha) * tf / (the highest tf in the document).
+    """
+    def transform(stats: TfIdfMatrix, values: np.ndarray) -> np.ndarray:
+        return alpha + (1 - alpha) * (values / stats.max_tfs[stats.counts.row_ids()])
+    return transform
+
+
+def idf_weight(stats: TfIdfMatrix, values: np.ndarray) -> np.ndarray:
+    """
+    Multiplies by log(D / df).
+    """
+    return values * stats.idf[stats.counts.indices]
+
+
+def bm25_tf(k1: float = 1.2, b: float = 0.75) -> Transform:
+    """
+    :return: the transform tf * (k1 + 1) / (tf + k1 * (1 - b + b * |d| / avgdl)).
+    """
+    def transform(stats: TfIdfMatrix, values: np.ndarray) -> np.ndarray:
+        lengths = stats.doc_lengths
+        avgdl = lengths.mean() if len(lengths) else 0.0
+        norms = k1 * (1 - b + b * lengths / avgdl) if avgdl > 0 else np.full(len(lengths), k1)
+        return values * (k1 + 1) / (values + norms[stats.counts.row_ids()])
+    return transform
+
+
+def bm25_idf(stats: TfIdfMatrix, values: np.ndarray) -> np.ndarray:
+    """
+    Multiplies by log((D - df + 0.5) / (df + 0.5) + 1).
+    """
+    return values * _bm25_idf(stats.D, stats.dfs)[stats.counts.indices]
+
+
+def _bm25_idf(D: int, dfs: np.ndarray) -> np.ndarray:
+    return np.log((D - dfs + 0.5) / (dfs + 0.5) + 1)
+
+
+def bm25(k1: float = 1.2, b: float = 0.75) -> List[Transform]:
+    """
+    :return: the transforms of the BM25 term weight.
+    """
+    return [bm25_tf(k1, b), bm25_idf]
+
+
+def capital_boost(boost: float = 0.5, stopwords: Collection[str] = ()) -> Transform:
+    """
+    :return: the transform that adds the boost to every term whose first letter is capitalized and whose lowercase is not a stopword.
+    """
+    def transform(stats: TfIdfMatrix, values: np.ndarray) -> np.ndarray:
+        terms = stats.vocab.terms
+        capital = np.array([terms[i][0].isupper() and terms[i].lower() not in stopwords for i in range(stats.counts.n_cols)], dtype=bool)
+        return values + boost * capital[stats.counts.indices]
+    return transform
+
+
+def weigh(stats: TfIdfMatrix, *transforms: Transform, normalize: bool = False) -> DocumentVectors:
+    """
+    :param stats: the term and document frequencies of a corpus, e.g., the output of vectorize_tf_idfs.
+    :param transforms: the transforms applied in order to the raw term frequencies.
+    :param normalize: if True, the weighted vectors are stored L2-normalized.
+    :return: the weighted document vectors.
+    """
+    return weigh_all(stats, {None: transforms}, normalize)[None]
+
+
+def weigh_all(stats: TfIdfMatrix, schemes: Mapping[Any, Sequence[Transform]], normalize: bool = False) -> Dict[Any, DocumentVectors]:
+    """
+    Weighs the same statistics with several schemes; the statistics are computed once and
+    the schemes sharing a prefix of transforms share its values.
+    :param schemes: a dictionary of (scheme name, transforms applied in order to the raw term frequencies).
+    :return: a dictionary of (scheme name, weighted document vectors).
+    """
+    C = stats.counts
+    cache = {(): C.data.astype(np.float64)}
+    out = dict()
+
+    for name, transforms in schemes.items():
+        transforms = tuple(transforms)
+        for i in range(1, len(transforms) + 1):
+            if transforms[:i] not in cache:
+                cache[transforms[:i]] = transforms[i - 1](stats, cache[transforms[:i - 1]])
+        v = DocumentVectors(stats.keys, stats.vocab, CSRMatrix(C.indptr, C.indices, cache[transforms], C.n_cols), rows=stats.rows)
+        out[name] = v.normalize() if normalize else v
 
     return out
 
 
+def euclidean(x1: Dict[str, float], x2: Dict[str, float], m1: Optional[float] = None, m2: Optional[float] = None) -> float:
+    """
+    :param m1: the cached L2 norm of x1, if any.
+    :param m2: the cached L2 norm of x2, if any.
+    If either norm is given, the distance is computed through ||x1||^2 + ||x2||^2 - 2 * x1.x2.
+    """
+    if m1 is None and m2 is None:
+        t = sum(((s1 - x2.get(term, 0)) ** 2 for term, s1 in x1.items()))
+        t += sum((s2 ** 2 for term, s2 in x2.items() if term not in x1))
+        return math.sqrt(t)
 
-def euclidean(x1: Dict[str, float], x2: Dict[str, float]) -> float:
-    t = sum(((s1 - x2.get(term, 0)) ** 2 for term, s1 in x1.items()))
-    t += sum((s2 ** 2 for term, s2 in x2.items() if term not in x1))
-    return math.sqrt(t)
+    if m1 is None: m1 = math.sqrt(sum(s1 ** 2 for s1 in x1.values()))
+    if m2 is None: m2 = math.sqrt(sum(s2 ** 2 for s2 in x2.values()))
+    t = sum(s1 * x2.get(term, 0) for term, s1 in x1.items())
+    return math.sqrt(max(m1 ** 2 + m2 ** 2 - 2 * t, 0))
 
 
 def most_similar(Y: Dict[str, Dict[str, float]], x: Dict[str, float]) -> str:
+    if isinstance(Y, DocumentView):
+        # a view is scored against its matrix and cached norms without building the dictionary of every document
+        v = Y.vectors
+        if len(v) == 0: return None
+        X = as_queries({None: x}, v)
+        ids, _ = top_k(X.matrix, v.matrix, 1, 'euclidean', x_norms=X.norms, y_norms=Y.norms, Yt=v.transposed)
+        return v.keys[int(ids[0, 0])]
+
     m, t = -1, None
     for title, y in Y.items():
         d = euclidean(x, y)
@@ -71,6 +700,223 @@ def most_similar(Y: Dict[str, Dict[str, float]], x: Dict[str, float]) -> str:
             m, t = d, title
     return t
 
+
+def dot_blocks(X: CSRMatrix, Y: CSRMatrix, max_cells: int = 1 << 22, Yt: Optional[CSRMatrix] = None) -> Iterator[Tuple[int, np.ndarray]]:
+    """
+    Computes the sparse-by-sparse product X * Y^T in blocks of consecutive rows in X.
+    :param X: the query matrix.
+    :param Y: the document matrix whose column ids are shared with X.
+    :param max_cells: the maximum number of cells in each dense block.
+    :param Yt: Y.transpose() if it is kept across calls; computed otherwise.
+    :return: an iterator of (the first row in X, dense block of dot products in the shape of [rows, len(Y)]).
+    """
+    n = len(Y)
+    if Yt is None: Yt = Y.transpose()
+    size = max(1, max_cells // max(n, 1))
+
+    for bs in range(0, len(X), size):
+        be = min(bs + size, len(X))
+        s, e = X.indptr[bs], X.indptr[be]
+        terms, weights = X.indices[s:e].astype(np.int64), X.data[s:e]
+        rows = np.repeat(np.arange(be - bs, dtype=np.int64), np.diff(X.indptr[bs:be + 1]))
+
+        # drop the terms that do not appear in Y
+        mask = terms < Y.n_cols
+        terms, weights, rows = terms[mask], weights[mask], rows[mask]
+
+        # gather the posting lists of all query terms at once
+        postings, lengths = Yt.positions(terms)
+        cells = np.repeat(rows * n, lengths) + Yt.indices[postings]
+        values = np.repeat(weights, lengths) * Yt.data[postings]
+        yield bs, np.bincount(cells, weights=values, minlength=(be - bs) * n).reshape(be - bs, n)
+
+
+def top_k(X: CSRMatrix, Y: CSRMatrix, k: int = 1, metric: str = 'euclidean', max_cells: int = 1 << 22,
+          x_norms: Optional[np.ndarray] = None, y_norms: Optional[np.ndarray] = None, Yt: Optional[CSRMatrix] = None) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Finds the k most similar rows in Y for every row in X.
+    :param X: the query matrix.
+    :param Y: the document matrix whose column ids are shared with X.
+    :param k: the number of matches per query.
+    :param metric: 'euclidean' (smaller is closer) or 'cosine' (larger is closer; 0 for zero vectors).
+    :param max_cells: the maximum number of cells in each dense block of scores.
+    :param x_norms: the cached L2 norms of the rows in X, computed if not given.
+    :param y_norms: the cached L2 norms of the rows in Y, computed if not given.
+    :param Yt: Y.transpose() if it is kept across calls; computed otherwise.
+    :return: a pair of (row ids in Y, scores) matrices in the shape of [len(X), min(k, len(Y))];
+             ties are broken by the smaller row id.
+    """
+    if metric not in {'euclidean', 'cosine'}: raise ValueError('Unknown metric: {}'.format(metric))
+    k = min(k, len(Y))
+    ids = np.zeros((len(X), k), dtype=np.int64)
+    scores = np.zeros((len(X), k), dtype=np.float64)
+    if k == 0: return ids, scores
+
+    xn = np.sqrt(X.squared_norms()) if x_norms is None else x_norms
+    yn = np.sqrt(Y.squared_norms()) if y_norms is None else y_norms
+    if metric == 'euclidean': xn, yn = xn ** 2, yn ** 2
+
+    for bs, block in dot_blocks(X, Y, max_cells, Yt):
+        be = bs + len(block)
+        if metric == 'euclidean':
+            block = np.sqrt(np.maximum(xn[bs:be, None] + yn[None, :] - 2 * block, 0))
+            keys = block
+        else:
+            norms = xn[bs:be, None] * yn[None, :]
+            block = np.divide(block, norms, out=np.zeros_like(block), where=norms > 0)
+            keys = -block
+
+        # keep every column tied with the k'th key so that ties are broken by row id
+        kth = np.partition(keys, k - 1, axis=1)[:, k - 1]
+        for i in range(len(block)):
+            c = np.flatnonzero(keys[i] <= kth[i])
+            c = c[np.lexsort((c, keys[i, c]))][:k]
+            ids[bs + i], scores[bs + i] = c, block[i, c]
+
+    return ids, scores
+
+
+def most_similar_batch(Y: DocumentVectors, X: DocumentVectors, k: int = 1, metric: str = 'euclidean') -> Dict[str, List[Tuple[str, float]]]:
+    """
+    Batch version of most_similar; X and Y must be vectorized against the same vocabulary.
+    :param Y: the document vectors to search.
+    :param X: the query vectors.
+    :return: a dictionary of (query key, list of (document key, score)) sorted from the closest.
+    """
+    if metric == 'euclidean' and (X.normalized or Y.normalized):
+        raise ValueError('Euclidean distances need vectors that are not normalized')
+    ids, scores = top_k(X.matrix, Y.matrix, k, metric, x_norms=X.row_norms(), y_norms=Y.row_norms(), Yt=Y.transposed)
+    return {key: [(Y.keys[j], s) for j, s in zip(r.tolist(), t.tolist())] for key, r, t in zip(X.keys, ids, scores)}
+
+
+class InvertedIndex:
+    """
+    Posting lists of (document id, weight) for every term over L2-normalized document vectors.
+    Cosine top-k retrieval only touches the documents sharing a term with the query and
+    skips the rest with MaxScore pruning; weights are assumed to be non-negative (e.g., TF-IDF).
+    """
+    def __init__(self, docs: DocumentVectors):
+        self.keys = docs.keys
+        self.vocab = docs.vocab
+        X = docs.normalize().matrix
+        self.postings = X.transpose()
+        self.max_weights = np.zeros(X.n_cols, dtype=np.float64)
+        np.maximum.at(self.max_weights, X.indices, X.data)
+
+    def __len__(self) -> int:
+        return len(self.keys)
+
+    def posting(self, tid: int) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        :return: a pair of (document ids in ascending order, weights) for the term id.
+        """
+        return self.postings.row(tid)
+
+    def search(self, x: Dict[str, float], k: int = 1) -> List[Tuple[str, float]]:
+        """
+        :param x: the query vector as a dictionary of (term, weight).
+        :param k: the number of documents to retrieve.
+        :return: the k documents with the highest cosine similarities that share at least one term with the query,
+                 as a list of (document key, score); ties are broken by the order of documents in the index.
+        """
+        qnorm = math.sqrt(sum(w ** 2 for w in x.values()))
+        terms = [(tid, w / qnorm) for tid, w in ((self.vocab.get(t), w) for t, w in x.items())
+                 if 0 <= tid < len(self.max_weights) and w != 0] if qnorm > 0 else []
+        docs, scores = max_score(self.postings, self.max_weights, terms, k)
+        return [(self.keys[d], s) for d, s in zip(docs.tolist(), scores.tolist())]
+
+
+def max_score(postings: CSRMatrix, max_weights: np.ndarray, terms: List[Tuple[int, float]], k: int) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Top-k retrieval of sum(w * posting weight) over the query terms with MaxScore pruning; weights must be non-negative.
+    :param postings: the posting list of (document ids in ascending order, weights) for every term id.
+    :param max_weights: the highest posting weight of every term id.
+    :param terms: the query as a list of (term id, weight).
+    :param k: the number of documents to retrieve.
+    :return: a pair of (document ids, scores) of the top-k documents sharing at least one term with the query,
+             sorted by descending scores and then by document ids.
+    """
+    docs = np.zeros(0, dtype=np.int32)
+    scores = np.zeros(0, dtype=np.float64)
+    if k <= 0 or not terms: return docs, scores
+
+    # visit the terms with the largest score upper bounds first
+    bounds = [w * max_weights[tid] for tid, w in terms]
+    order = sorted(range(len(terms)), key=lambda i: -bounds[i])
+    rest = np.cumsum([bounds[i] for i in reversed(order)])[::-1].tolist() + [0.0]
+
+    for n, i in enumerate(order):
+        tid, w = terms[i]
+        theta = np.partition(scores, len(scores) - k)[len(scores) - k] if len(scores) >= k else -1.0
+        p_docs, p_weights = postings.row(tid)
+
+        if theta > rest[n]:
+            # documents not yet scored cannot reach the top-k: update the candidates only and drop the hopeless
+            docs, scores = docs[scores + rest[n] >= theta], scores[scores + rest[n] >= theta]
+            pos = np.searchsorted(p_docs, docs)
+            hit = pos < len(p_docs)
+            hit[hit] = p_docs[pos[hit]] == docs[hit]
+            scores[hit] += w * p_weights[pos[hit]]
+        else:
+            docs, inverse = np.unique(np.concatenate((docs, p_docs)), return_inverse=True)
+            scores = np.bincount(inverse, weights=np.concatenate((scores, w * p_weights)), minlength=len(docs))
+
+    top = np.lexsort((docs, -scores))[:k]
+    return docs[top], scores[top]
+
+
+class BM25:
+    """
+    BM25 ranking over the term and document frequencies of a corpus with an inverted index for top-k retrieval.
+    The length normalization of every document is computed once: each posting stores
+    tf * (k1 + 1) / (tf + k1 * (1 - b + b * |d| / avgdl)) + delta, where delta > 0 gives BM25+,
+    and a query term t contributes qtf(t) * idf(t) * posting weight with idf(t) = log((D - df + 0.5) / (df + 0.5) + 1).
+    """
+    def __init__(self, stats: TfIdfMatrix, k1: float = 1.2, b: float = 0.75, delta: float = 0.0):
+        """
+        :param stats: the term and document frequencies of a corpus, e.g., the output of vectorize_tf_idfs.
+        """
+        self.keys = stats.keys
+        self.vocab = stats.vocab
+        self.k1, self.b, self.delta = k1, b, delta
+        C = stats.counts
+
+        weights = bm25_tf(k1, b)(stats, C.data.astype(np.float64)) + delta
+        self.idf = _bm25_idf(stats.D, stats.dfs[:C.n_cols])
+        self.postings = CSRMatrix(C.indptr, C.indices, weights, C.n_cols).transpose()
+        self.max_weights = np.zeros(C.n_cols, dtype=np.float64)
+        np.maximum.at(self.max_weights, C.indices, weights)
+
+    def __len__(self) -> int:
+        return len(self.keys)
+
+    def query(self, tokens: Iterable[str]) -> List[Tuple[int, float]]:
+        """
+        :param tokens: the query tokens, or a string of whitespace-separated tokens.
+        :return: a list of (term id, qtf * idf) for the query terms in the index.
+        """
+        if isinstance(tokens, str): tokens = tokens.split()
+        terms = [(self.vocab.get(t), qtf) for t, qtf in Counter(tokens).items()]
+        return [(tid, qtf * self.idf[tid]) for tid, qtf in terms if 0 <= tid < len(self.idf)]
+
+    def search(self, tokens: Iterable[str], k: int = 10) -> List[Tuple[str, float]]:
+        """
+        :param tokens: the query tokens, or a string of whitespace-separated tokens.
+        :param k: the number of documents to retrieve.
+        :return: the top-k documents as a list of (document key, BM25 score), sorted by descending scores;
+                 only documents sharing at least one term with the query are retrieved.
+        """
+        docs, scores = max_score(self.postings, self.max_weights, self.query(tokens), k)
+        return [(self.keys[d], s) for d, s in zip(docs.tolist(), scores.tolist())]
+
+    def search_batch(self, queries: Mapping[str, Iterable[str]], k: int = 10) -> Dict[str, List[Tuple[str, float]]]:
+        """
+        :param queries: a dictionary of (query key, query tokens).
+        :return: a dictionary of (query key, the output of search).
+        """
+        return {key: self.search(tokens, k) for key, tokens in queries.items()}
+
+
 if __name__ == '__main__':
     # download aesop's fables
     aesop_link = 'https://raw.githubusercontent.com/emory-courses/computational-linguistics/master/res/vsm/aesopfables.json'
@@ -114,8 +960,11 @@ if __name__ == '__main__':
     # download(link, file)
 
     fables_alt = json.load(open(file))
-    tfidf_alt = tf_idfs(fables_alt)
 
-    for k, x in tfidf_alt.items():
-        t = most_similar(tfidfs, x)
-        print('{} -> {}'.format(k, t))
\ No newline at end of file
+    # match all alternative fables at once against a shared vocabulary
+    vocab = Vocabulary()
+    Y = vectorize_tf_idfs(fables, vocab)
+    X = vectorize_tf_idfs(fables_alt, vocab)
+
+    for k, t in most_similar_batch(Y, X).items():
+        print('{} -> {}'.format(k, t[0][0]))
@@ -0,0 +1,200 @@
+# ========================================================================
+# Copyright 2022 Emory University
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ========================================================================
+import json
+import mmap
+import struct
+from typing import Dict, List, Tuple, Iterator, Mapping, Sequence
+
+import numpy as np
+
+from src.vector_space_models import Vocabulary, CSRMatrix, DocumentVectors, TfIdfMatrix, as_vectors
+
+# File layout (little-endian):
+#   magic (8 bytes) | version (uint32) | header size (uint32) | JSON header | arrays, each aligned to ALIGN bytes
+# The header holds the scalar fields and the (offset, dtype, count) of every array relative to the first array.
+MAGIC = b'VSMSTORE'
+VERSION = 1
+ALIGN = 64
+
+
+class StringTable(Sequence):
+    """
+    Read-only sequence of strings stored as concatenated UTF-8 bytes with their offsets,
+    plus the ids in the sorted order of their bytes so that a string can be found by binary search.
+    """
+    def __init__(self, data: np.ndarray, offsets: np.ndarray, order: np.ndarray):
+        self.data = data
+        self.offsets = offsets
+        self.order = order
+
+    def __len__(self) -> int:
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i: int) -> str:
+        return self._bytes(i).decode('utf-8')
+
+    def _bytes(self, i: int) -> bytes:
+        if i < 0: i += len(self)
+        if not 0 <= i < len(self): raise IndexError(i)
+        return self.data[self.offsets[i]:self.offsets[i + 1]].tobytes()
+
+    def find(self, s: str) -> int:
+        """
+        :return: the id of the string; -1 if it does not exist.
+        """
+        b = s.encode('utf-8')
+        lo, hi = 0, len(self)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._bytes(int(self.order[mid])) < b: lo = mid + 1
+            else: hi = mid
+        if lo < len(self):
+            i = int(self.order[lo])
+            if self._bytes(i) == b: return i
+        return -1
+
+    @property
+    def ids(self) -> 'StringIds':
+        return StringIds(self)
+
+    @staticmethod
+    def arrays(strings: Sequence[str]) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """
+        :return: the (data, offsets, order) arrays of the strings.
+        """
+        encoded = [s.encode('utf-8') for s in strings]
+        offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum([len(b) for b in encoded])
+        data = np.frombuffer(b''.join(encoded), dtype=np.uint8)
+        order = np.array(sorted(range(len(encoded)), key=encoded.__getitem__), dtype=np.int64)
+        return data, offsets, order
+
+
+class StringIds(Mapping):
+    """
+    Read-only Dict[string, id] over a string table.
+    """
+    def __init__(self, table: StringTable):
+        self.table = table
+
+    def __getitem__(self, s: str) -> int:
+        i = self.table.find(s)
+        if i < 0: raise KeyError(s)
+        return i
+
+    def __contains__(self, s) -> bool:
+        return isinstance(s, str) and self.table.find(s) >= 0
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self.table)
+
+    def __len__(self) -> int:
+        return len(self.table)
+
+
+class FrozenVocabulary(Vocabulary):
+    """
+    Read-only vocabulary over a string table; adding a term that does not exist raises KeyError.
+    """
+    frozen = True
+
+    def __init__(self, table: StringTable):
+        self.terms = table
+        self.ids = StringIds(table)
+
+    def add(self, term: str) -> int:
+        tid = self.terms.find(term)
+        if tid < 0: raise KeyError('Cannot add a term to a read-only vocabulary: {}'.format(term))
+        return tid
+
+    def get(self, term: str, default: int = -1) -> int:
+        tid = self.terms.find(term)
+        return default if tid < 0 else tid
+
+
+def _align(n: int) -> int:
+    return (n + ALIGN - 1) // ALIGN * ALIGN
+
+
+def save_vectors(vectors: Mapping[str, Dict[str, float]], filename: str):
+    """
+    Saves document vectors (e.g., the output of vectorize_tf_idfs or quiz2.vectorize) in the binary format that load_vectors memory-maps.
+    :param vectors: document vectors, a view over them, or a dictionary of (document key, dictionary of (term, weight)).
+    :param filename: the path to the output file.
+    """
+    v = as_vectors(vectors)
+    M = v.matrix
+    header = {'type': 'vectors', 'normalized': v.normalized, 'n_cols': M.n_cols}
+    arrays: List[Tuple[str, np.ndarray]] = []
+
+    for prefix, strings in (('vocab', v.vocab.terms), ('keys', v.keys)):
+        for name, a in zip(('data', 'offsets', 'order'), StringTable.arrays(strings)):
+            arrays.append(('{}_{}'.format(prefix, name), a))
+
+    arrays += [('indptr', M.indptr.astype('<i8')), ('indices', M.indices.astype('<i4')), ('data', M.data.astype('<f8')), ('norms', v.norms.astype('<f8'))]
+    if isinstance(v, TfIdfMatrix):
+        header.update(type='tfidf', D=v.D)
+        arrays += [('counts', v.counts.data.astype('<i4')), ('dfs', v.dfs.astype('<i8')), ('idf', v.idf.astype('<f8'))]
+
+    offset, specs = 0, dict()
+    for name, a in arrays:
+        specs[name] = [offset, a.dtype.str, len(a)]
+        offset = _align(offset + a.nbytes)
+    header['arrays'] = specs
+
+    h = json.dumps(header).encode('utf-8')
+    start = _align(len(MAGIC) + 8 + len(h))
+    with open(filename, 'wb') as fout:
+        fout.write(MAGIC + struct.pack('<II', VERSION, len(h)) + h)
+        for name, a in arrays:
+            fout.write(b'\0' * (start + specs[name][0] - fout.tell()))
+            fout.write(a.tobytes())
+
+
+def load_vectors(filename: str) -> DocumentVectors:
+    """
+    Memory-maps the document vectors saved by save_vectors without copying them; processes loading the same file share its pages.
+    :param filename: the path to the file.
+    :return: the read-only document vectors (TfIdfMatrix if TF-IDF vectors were saved) whose vocabulary cannot be extended.
+    """
+    with open(filename, 'rb') as fin:
+        mm = mmap.mmap(fin.fileno(), 0, access=mmap.ACCESS_READ)
+
+    if mm[:len(MAGIC)] != MAGIC: raise ValueError('Not a vector store: {}'.format(filename))
+    version, size = struct.unpack_from('<II', mm, len(MAGIC))
+    if version != VERSION: raise ValueError('Unsupported vector store version {}: {}'.format(version, filename))
+    header = json.loads(mm[len(MAGIC) + 8:len(MAGIC) + 8 + size].decode('utf-8'))
+    start = _align(len(MAGIC) + 8 + size)
+
+    def array(name: str) -> np.ndarray:
+        offset, dtype, count = header['arrays'][name]
+        return np.frombuffer(mm, dtype=dtype, count=count, offset=start + offset)
+
+    vocab = FrozenVocabulary(StringTable(array('vocab_data'), array('vocab_offsets'), array('vocab_order')))
+    keys = StringTable(array('keys_data'), array('keys_offsets'), array('keys_order'))
+    indptr, indices = array('indptr'), array('indices')
+    matrix = CSRMatrix(indptr, indices, array('data'), header['n_cols'])
+
+    if header['type'] == 'tfidf':
+        # restore the stored fields as they are instead of recomputing them in TfIdfMatrix.__init__
+        v = TfIdfMatrix.__new__(TfIdfMatrix)
+        v.counts = CSRMatrix(indptr, indices, array('counts'), header['n_cols'])
+        v.dfs, v.idf, v.D = array('dfs'), array('idf'), header['D']
+    else:
+        v = DocumentVectors.__new__(DocumentVectors)
+
+    DocumentVectors.__init__(v, keys, vocab, matrix, array('norms'), header['normalized'], keys.ids)
+    return v